@@ -1,13 +1,24 @@
+import hashlib
+import json
+import logging
+import threading
 from functools import update_wrapper
+from uuid import uuid4
 
 from django.conf.urls import patterns, url
 from django.contrib import admin
 from django.contrib.admin import helpers
 from django.contrib.admin.util import model_ngettext, unquote
 from django.contrib import messages
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
 from django.core.urlresolvers import reverse
-from django.http import HttpResponseRedirect
+from django.db import connections, IntegrityError
+from django.db.models import Aggregate, Count
+from django.db.models.sql import aggregates as sql_aggregates
+from django.http import HttpResponse, HttpResponseRedirect
 from django.template.response import TemplateResponse
 from django.utils.encoding import force_unicode
 from django.utils.translation import ugettext_lazy
@@ -16,12 +27,90 @@ from django.contrib.admin import SimpleListFilter
 from django.template.defaultfilters import escape
 from django.http import Http404
 
+from logicaldelete.archive import is_archived
+from logicaldelete.schema import estimated_count
+
+logger = logging.getLogger('logicaldelete')
+
+
+class SQLCountNull(sql_aggregates.Aggregate):
+    is_ordinal = True
+    sql_function = 'SUM'
+    sql_template = '%(function)s(CASE WHEN %(field)s IS NULL THEN 1 ELSE 0 END)'
+
+
+class CountNull(Aggregate):
+    """
+    Counts the NULL values of a field, with a conditional SUM.
+    """
+    name = 'CountNull'
+
+    def add_to_query(self, query, alias, col, source, is_summary):
+        query.aggregates[alias] = SQLCountNull(col, source=source, is_summary=is_summary,
+                                               **self.extra)
+
+
+def active_counts(queryset, timeout=60):
+    """
+    Returns the numbers of active and deleted objects in ``queryset``,
+    counted with a single query and cached for ``timeout`` seconds.
+    """
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    key = 'logicaldelete.active_counts.%s' % hashlib.md5(
+        (u'%s|%s|%r' % (queryset.db, sql, params)).encode('utf-8')).hexdigest()
+    counts = cache.get(key)
+    if counts is None:
+        result = queryset.order_by().aggregate(total=Count('pk'), active=CountNull('date_removed'))
+        active = result['active'] or 0
+        counts = (active, result['total'] - active)
+        cache.set(key, counts, timeout)
+    return counts
+
+
+def run_in_thread(func, *args):
+    """
+    Calls ``func`` with ``args`` in a daemon thread, closing the database
+    connections of the thread when it is done.
+    """
+    def run():
+        try:
+            func(*args)
+        finally:
+            for connection in connections.all():
+                connection.close()
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator of admin changelists using the row count estimated by the
+    database (see ``estimated_count``) for unfiltered querysets.
+    """
+
+    def _get_count(self):
+        if self._count is None:
+            queryset = self.object_list
+            if not queryset.query.where and not queryset.query.having:
+                self._count = estimated_count(queryset.model, queryset.db)
+        return super(EstimatedCountPaginator, self)._get_count()
+    count = property(_get_count)
+
 
 class ActiveListFilter(SimpleListFilter):
     title = _('Active')
     parameter_name = 'active'
 
     def lookups(self, request, model_admin):
+        if getattr(model_admin, 'active_counts', False):
+            counts = active_counts(model_admin.queryset(request),
+                                   model_admin.active_counts_timeout)
+            return (
+                ('1', u'%s (%d)' % (_('Yes'), counts[0])),
+                ('0', u'%s (%d)' % (_('No'), counts[1]))
+                )
         return (
             ('1', _('Yes')),
             ('0', _('No'))
@@ -39,11 +128,93 @@ class ActiveListFilter(SimpleListFilter):
             return queryset.filter(date_removed__isnull=False)
 
 
+class ArchiveAdmin(admin.ModelAdmin):
+    """
+    Admin of the archived objects of a model with archive storage,
+    registered with ``register_archive_admin`` for its archive model.
+    ``model_admin`` is the ModelAdmin of the model. The objects can be listed, viewed and undeleted with the
+    permissions of the model, but not changed.
+    """
+    actions = ['undelete_selected']
+    model_admin = None
+
+    def get_actions(self, request):
+        actions = super(ArchiveAdmin, self).get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+    def get_readonly_fields(self, request, obj=None):
+        return [f.name for f in self.opts.local_fields]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return self.model_admin.has_change_permission(request)
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def undelete_selected(self, request, queryset):
+        """
+        Action which undeletes the selected archived objects, logged like
+        with ModelAdmin.undelete_selected().
+        """
+        if not self.model_admin.has_undelete_permission(request):
+            raise PermissionDenied
+        count = queryset.count()
+        try:
+            self.model_admin.undelete_objects(request.user.pk, queryset)
+        except IntegrityError, e:
+            # primary keys given to new objects, see restore_rows()
+            messages.error(request, force_unicode(e))
+            return None
+        self.message_user(request, _("Successfully undeleted %(count)d %(items)s.") % {
+            "count": count, "items": model_ngettext(self.opts, count)
+        })
+
+    undelete_selected.short_description = ugettext_lazy("Undelete selected %(verbose_name_plural)s")
+
+
+def register_archive_admin(model, site=None):
+    """
+    Registers an admin for the archive model of ``model``, a model with
+    archive storage registered on ``site`` (``admin.site`` by default) with
+    a ModelAdmin. It is the ``archive_admin`` of that ModelAdmin.
+    """
+    if site is None:
+        site = admin.site
+    if not is_archived(model):
+        raise ValueError("%s doesn't have archive storage" % model._meta.object_name)
+    if model not in site._registry:
+        raise admin.sites.NotRegistered('The model %s is not registered' % model.__name__)
+    model_admin = site._registry[model]
+    archive_admin = type('%sArchiveAdmin' % model.__name__,
+                         (model_admin.archive_admin,), {'model_admin': model_admin})
+    site.register(model._logicaldelete_archive, archive_admin)
+
+
 class ModelAdmin(admin.ModelAdmin):
     actions = ['undelete_selected']
     undelete_selected_confirmation_template = None
     undelete_confirmation_template = None
     change_form_template = 'admin/change_form_logicaldeleted.html'
+    # show the numbers of active and deleted objects in the Active filter,
+    # cached for active_counts_timeout seconds
+    active_counts = False
+    active_counts_timeout = 60
+    # use the row count estimated by the database for unfiltered changelists
+    estimated_counts = False
+    # undelete_selected: number of objects undeleted and logged at once,
+    # fields loaded for their representation (all of them if None), number
+    # of objects per page of the confirmation page, and number of objects
+    # above which they are undeleted in a background thread (never if None)
+    undelete_batch_size = 500
+    undelete_repr_fields = None
+    undelete_preview_size = 100
+    undelete_background_threshold = None
+    # admin of the archived objects for models with archive storage
+    archive_admin = ArchiveAdmin
 
     def __init__(self, *args, **kwargs):
         super(ModelAdmin, self).__init__(*args, **kwargs)
@@ -57,6 +228,12 @@ class ModelAdmin(admin.ModelAdmin):
         else:
             self.list_filter = (ActiveListFilter, )
 
+    def get_paginator(self, request, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        if self.estimated_counts:
+            return EstimatedCountPaginator(queryset, per_page, orphans, allow_empty_first_page)
+        return super(ModelAdmin, self).get_paginator(request, queryset, per_page, orphans,
+                                                     allow_empty_first_page)
+
     def has_undelete_permission(self, request, obj=None):
         opts = self.opts
         return request.user.has_perm('%s.undelete_%s' %
@@ -89,6 +266,8 @@ class ModelAdmin(admin.ModelAdmin):
             raise PermissionDenied
 
         undeletable_objects = queryset.only_deleted()
+        if self.undelete_repr_fields:
+            undeletable_objects = undeletable_objects.only(*self.undelete_repr_fields)
         count = undeletable_objects.count()
         if count == 0:
             messages.error(request, _("No objects for undelete."))
@@ -97,21 +276,39 @@ class ModelAdmin(admin.ModelAdmin):
         # The user has already confirmed the undeletion.
         # Do the undeletion and return a None to display the change list view again.
         if request.POST.get('post'):
-            for obj in undeletable_objects:
-                obj_display = force_unicode(obj)
-                self.log_change(request, obj, _("Undeleted %s") % obj_display)
-            undeletable_objects.undelete()
+            threshold = self.undelete_background_threshold
+            if threshold is not None and count > threshold:
+                task_id = self.undelete_in_background(request, undeletable_objects, count)
+                self.message_user(request, _("Undeleting %(count)d %(items)s in the background, "
+                                             "see %(url)s for the progress.") % {
+                    "count": count, "items": model_ngettext(self.opts, count),
+                    "url": reverse('admin:%s_%s_undelete_progress' % (app_label, opts.module_name),
+                                   args=(task_id,), current_app=self.admin_site.name),
+                })
+                return None
+            self.undelete_objects(request.user.pk, undeletable_objects)
             self.message_user(request, _("Successfully undeleted %(count)d %(items)s.") % {
                 "count": count, "items": model_ngettext(self.opts, count)
             })
             # Return None to display the change list page again.
             return None
 
+        # only a page of the objects is shown
+        paginator = Paginator(undeletable_objects.order_by('pk'), self.undelete_preview_size)
+        try:
+            preview_page = paginator.page(request.POST.get('preview_page', 1))
+        except (EmptyPage, PageNotAnInteger):
+            preview_page = paginator.page(1)
+
         context = {
             "title": _("Are you sure?"),
             "objects_name": force_unicode(model_ngettext(self.opts, count)),
-            "undeletable_objects": [undeletable_objects],
+            "undeletable_objects": [list(preview_page.object_list)],
+            "preview_page": preview_page,
+            "count": count,
             "queryset": queryset,
+            "selected": request.POST.getlist(helpers.ACTION_CHECKBOX_NAME),
+            "select_across": request.POST.get('select_across') == '1',
             "opts": opts,
             "app_label": app_label,
             'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
@@ -126,6 +323,82 @@ class ModelAdmin(admin.ModelAdmin):
 
     undelete_selected.short_description = ugettext_lazy("Undelete selected %(verbose_name_plural)s")
 
+    def undelete_objects(self, user_id, queryset, progress=None):
+        """
+        Undeletes the objects of ``queryset`` and logs a change by the user
+        ``user_id`` for each of them, ``undelete_batch_size`` objects at a
+        time with a single INSERT of the log entries. ``progress`` is called
+        with the number of undeleted objects after each batch.
+        """
+        from django.contrib.admin.models import LogEntry, CHANGE
+
+        content_type_id = ContentType.objects.get_for_model(self.model).pk
+        done = 0
+        batch = []
+        objects = queryset.order_by('pk').iterator()
+        while True:
+            obj = next(objects, None)
+            if obj is not None:
+                batch.append(obj)
+                if len(batch) < self.undelete_batch_size:
+                    continue
+            if not batch:
+                break
+            entries = []
+            for obj in batch:
+                obj_display = force_unicode(obj)
+                entries.append(LogEntry(
+                    user_id=user_id,
+                    content_type_id=content_type_id,
+                    object_id=force_unicode(obj.pk),
+                    object_repr=obj_display[:200],
+                    action_flag=CHANGE,
+                    change_message=_("Undeleted %s") % obj_display,
+                ))
+            # logged once undeleted, a batch failing to undelete is not logged
+            queryset.filter(pk__in=[obj.pk for obj in batch]).undelete()
+            LogEntry.objects.using(queryset.db).bulk_create(entries)
+            done += len(batch)
+            batch = []
+            if progress is not None:
+                progress(done)
+
+    def undelete_in_background(self, request, queryset, count):
+        """
+        Undeletes the objects of ``queryset`` with ``undelete_objects`` in a
+        background thread, and returns the ID of the task. Its progress is
+        kept in the cache, see ``undelete_progress``.
+        """
+        task_id = uuid4().hex
+        key = 'logicaldelete.undelete.%s' % task_id
+        cache.set(key, {'total': count, 'done': 0, 'finished': False}, 86400)
+
+        def undelete():
+            state = {'total': count, 'done': 0, 'finished': False}
+
+            def progress(done):
+                state['done'] = done
+                cache.set(key, state, 86400)
+            try:
+                self.undelete_objects(request.user.pk, queryset, progress)
+            except Exception, e:
+                logger.exception("Undeleting %s failed" % self.model._meta.object_name)
+                state['error'] = force_unicode(e)
+            state['finished'] = True
+            cache.set(key, state, 86400)
+
+        run_in_thread(undelete)
+        return task_id
+
+    def undelete_progress(self, request, task_id):
+        "Returns the progress of a background undeletion as JSON."
+        if not self.has_undelete_permission(request):
+            raise PermissionDenied
+        state = cache.get('logicaldelete.undelete.%s' % task_id)
+        if state is None:
+            raise Http404
+        return HttpResponse(json.dumps(state), content_type='application/json')
+
     def undelete_model(self, request, obj):
         obj.undelete()
 
@@ -192,6 +465,9 @@ class ModelAdmin(admin.ModelAdmin):
             return update_wrapper(wrapper, view)
 
         urlpatterns = patterns('',
+            url(r'^undelete-progress/(\w+)/$', wrap(self.undelete_progress),
+                name='%s_%s_undelete_progress' % (self.model._meta.app_label,
+                self.model._meta.module_name)),
             url(r'^(.+)/undelete/$', wrap(self.undelete_view),
                 name='%s_%s_undelete' % (self.model._meta.app_label,
                 self.model._meta.module_name))
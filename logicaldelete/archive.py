@@ -0,0 +1,256 @@
+# -*- coding: utf-8; -*-
+"""
+Archive storage: models with ``storage = 'archive'`` in their
+LogicalDeleteMeta keep logically deleted rows in a shadow table with the
+same columns instead of in their own table.
+"""
+import copy
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, models, transaction, IntegrityError
+from django.db.backends.util import truncate_name
+from django.db.models import query
+from django.db.models.deletion import DO_NOTHING
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE
+from django.utils.translation import string_concat
+
+from logicaldelete.cache import objects_undeleted
+from logicaldelete.signals import pre_undelete_batch, post_undelete_batch
+
+
+def is_archived(model):
+    """
+    Returns True if ``model`` keeps its logically deleted rows in an archive
+    table.
+    """
+    logicaldelete_meta = getattr(model, '_logicaldelete_meta', None)
+    return logicaldelete_meta is not None and logicaldelete_meta.storage == 'archive'
+
+
+def create_archive_model(model):
+    """
+    Returns an unmanaged model for the archive table of ``model``, with a
+    copy of each of its fields. Foreign keys keep their columns, but have no
+    reverse accessor and are ignored when the related objects are deleted.
+    """
+    opts = model._meta
+    if opts.parents:
+        raise ImproperlyConfigured("%s: archive storage is not supported for "
+                                   "inherited models." % opts.object_name)
+
+    class Meta:
+        app_label = opts.app_label
+        db_table = truncate_name('%s_archive' % opts.db_table)
+        managed = False
+        verbose_name = string_concat(opts.verbose_name, ' (archived)')
+        verbose_name_plural = string_concat(opts.verbose_name_plural, ' (archived)')
+
+    attrs = {
+        'Meta': Meta,
+        '__module__': model.__module__,
+        'objects': ArchiveManager(),
+        '__unicode__': lambda self: unicode(to_model_instance(self._logicaldelete_model, self)),
+    }
+    for field in opts.local_fields:
+        field = copy.deepcopy(field)
+        if not field.primary_key:
+            field._unique = False
+        if field.rel is not None:
+            field.rel.related_name = '+'
+            field.rel.on_delete = DO_NOTHING
+        if field.name == 'date_removed':
+            field.db_index = True
+        attrs[field.name] = field
+    return type('%sArchive' % opts.object_name, (models.Model,), attrs)
+
+
+# the (model, alias) pairs checked by check_archive_storage()
+checked_storage = set()
+
+
+def has_autoincrement(model, connection):
+    """
+    Returns True if the SQLite table of ``model`` has an AUTOINCREMENT
+    primary key, which is never given again to a new row.
+    """
+    cursor = connection.cursor()
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = %s",
+                   [model._meta.db_table])
+    row = cursor.fetchone()
+    return row is not None and 'AUTOINCREMENT' in row[0].upper()
+
+
+def check_archive_storage(model, using):
+    """
+    Raises ImproperlyConfigured if the rows of ``model`` cannot be moved to
+    its archive table on the database ``using``: foreign keys (including
+    the intermediary tables of many-to-many fields) referencing them would
+    be left dangling, and on SQLite the primary keys of archived rows would
+    be given again to new rows without AUTOINCREMENT.
+    """
+    if (model, using) in checked_storage:
+        return
+    opts = model._meta
+    for related in opts.get_all_related_objects(include_hidden=True):
+        # foreign keys of the archive table itself are ignored
+        if not hasattr(related.model, '_logicaldelete_model'):
+            raise ImproperlyConfigured(
+                "%s: archive storage is not supported for models referenced by "
+                "foreign keys, like %s.%s." % (opts.object_name,
+                                              related.model._meta.object_name,
+                                              related.field.name))
+    connection = connections[using]
+    if (connection.vendor == 'sqlite' and isinstance(opts.pk, models.AutoField) and
+            not has_autoincrement(model, connection)):
+        raise ImproperlyConfigured(
+            "%s: archive storage needs an AUTOINCREMENT primary key on SQLite, "
+            "see the sqlactiveindexes command for the statements rebuilding the "
+            "table %s." % (opts.object_name, opts.db_table))
+    checked_storage.add((model, using))
+
+
+def move_rows(model, from_table, to_table, pk_list, values, using):
+    """
+    Moves the rows of ``model`` with the primary keys in ``pk_list`` from
+    ``from_table`` to ``to_table`` with INSERT ... SELECT and DELETE
+    statements, setting the fields in ``values`` on the way.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    fields = model._meta.local_fields
+    columns = ', '.join(qn(f.column) for f in fields)
+    select, select_params = [], []
+    for f in fields:
+        if f.name in values:
+            select.append('%s')
+            select_params.append(f.get_db_prep_save(values[f.name], connection=connection))
+        else:
+            select.append(qn(f.column))
+    pk_column = qn(model._meta.pk.column)
+    cursor = connection.cursor()
+    for offset in range(0, len(pk_list), GET_ITERATOR_CHUNK_SIZE):
+        chunk = pk_list[offset:offset + GET_ITERATOR_CHUNK_SIZE]
+        placeholders = ', '.join(['%s'] * len(chunk))
+        cursor.execute('INSERT INTO %s (%s) SELECT %s FROM %s WHERE %s IN (%s)' % (
+            qn(to_table), columns, ', '.join(select), qn(from_table),
+            pk_column, placeholders), select_params + list(chunk))
+        cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+            qn(from_table), pk_column, placeholders), list(chunk))
+
+
+def archive_rows(model, pk_list, values, using):
+    """
+    Moves the rows of ``model`` to its archive table, ``values`` are the
+    field values marking them as deleted. See ``check_archive_storage``.
+    """
+    check_archive_storage(model, using)
+    move_rows(model, model._meta.db_table,
+              model._logicaldelete_archive._meta.db_table, pk_list, values, using)
+
+
+def restore_rows(model, pk_list, values, using):
+    """
+    Moves the rows of ``model`` back from its archive table, ``values`` are
+    the field values marking them as not deleted.
+
+    Raises IntegrityError before moving any row if one of the primary keys
+    was given to a new row meanwhile, as MySQL does with the largest
+    primary keys after a restart (before MySQL 8.0).
+    """
+    queryset = query.QuerySet(model, using=using)
+    for offset in range(0, len(pk_list), GET_ITERATOR_CHUNK_SIZE):
+        reused = list(queryset.filter(pk__in=pk_list[offset:offset + GET_ITERATOR_CHUNK_SIZE])
+                      .values_list('pk', flat=True))
+        if reused:
+            raise IntegrityError(
+                "Cannot undelete the archived %s objects with the primary keys %s: "
+                "they were given to new objects." % (
+                    model._meta.object_name, ', '.join(map(unicode, sorted(reused)))))
+    move_rows(model, model._logicaldelete_archive._meta.db_table,
+              model._meta.db_table, pk_list, values, using)
+
+
+def to_model_instance(model, archived):
+    """
+    Returns an instance of ``model`` with the field values of the archived
+    object ``archived``.
+    """
+    return model(**dict((f.attname, getattr(archived, f.attname))
+                        for f in model._meta.local_fields))
+
+
+class ArchiveQuerySet(query.QuerySet):
+    """
+    QuerySet of the archived objects of a model with archive storage.
+    ``source_model`` is the model they were requested for, which may be a
+    proxy of it.
+    """
+    source_model = None
+
+    def _clone(self, *args, **kwargs):
+        clone = super(ArchiveQuerySet, self)._clone(*args, **kwargs)
+        clone.source_model = self.source_model
+        return clone
+
+    def undelete(self, using='default', cascade=False, *args, **kwargs):
+        """
+        Moves the archived objects back to the table of their model.
+        With ``cascade=True`` the objects deleted by the same deletion
+        operations are undeleted too, see LogicalDeleteQuerySet.undelete().
+        """
+        from logicaldelete.deletion import batch_signal_senders, send_batch_signal
+        from logicaldelete.querysets import undelete_operations
+
+        model = self.model._logicaldelete_model
+        operations = []
+        if cascade:
+            if not model._logicaldelete_meta.track_operations:
+                raise ValueError("Cascading undelete requires the track_operations "
+                                 "option of %s." % model._meta.object_name)
+            operations = list(self.exclude(deletion_op=None)
+                              .values_list('deletion_op', flat=True).distinct())
+        pk_list = list(self.values_list('pk', flat=True))
+        if pk_list:
+            values = {'date_removed': None}
+            if model._logicaldelete_meta.track_operations:
+                values['deletion_op'] = None
+            senders = batch_signal_senders(self.source_model or model)
+            send_batch_signal(pre_undelete_batch, senders, pk_list=pk_list, using=self.db)
+            self._execute(restore_rows, model, pk_list, values)
+            objects_undeleted(model, self.db)
+            send_batch_signal(post_undelete_batch, senders, pk_list=pk_list, using=self.db)
+        if operations:
+            undelete_operations(operations, self.db)
+
+    undelete.alters_data = True
+
+    def remove(self):
+        """
+        Deletes the archived objects in the current QuerySet.
+        """
+        query.QuerySet.delete(self)
+
+    remove.alters_data = True
+
+    def _execute(self, func, *args):
+        using = self.db
+        if not transaction.is_managed(using=using):
+            transaction.enter_transaction_management(using=using)
+            forced_managed = True
+        else:
+            forced_managed = False
+        try:
+            func(*args + (using,))
+            if forced_managed:
+                transaction.commit(using=using)
+            else:
+                transaction.commit_unless_managed(using=using)
+        finally:
+            if forced_managed:
+                transaction.leave_transaction_management(using=using)
+
+
+class ArchiveManager(models.Manager):
+
+    def get_query_set(self):
+        return ArchiveQuerySet(self.model, using=self._db)
@@ -9,6 +9,15 @@ class LogicalDeleteOptions(object):
     delete_related = True
     safe_deletion = True
     delete_batches = False
+    retain_for = None
+    max_tombstones = None
+    active_indexes = ()
+    index_date_removed = False
+    track_operations = False
+    instance_signals = True
+    storage = 'table'
+    cache_deleted = False
+    cache_deleted_capacity = 10000
 
     def __init__(self, opts):
         if opts:
@@ -27,11 +36,29 @@ class LogicalDeleteModelBase(models.base.ModelBase):
     """
 
     def __new__(cls, name, bases, attrs):
+        if getattr(attrs.get('LogicalDeleteMeta'), 'track_operations', False):
+            attrs['deletion_op'] = models.CharField(max_length=32, null=True, blank=True,
+                                                    editable=False, db_index=True)
         new = super(LogicalDeleteModelBase, cls).__new__(cls, name, bases, attrs)
+        if new._deferred:
+            # classes created by only() and defer() share the options and
+            # permissions of their model
+            return new
+        logicaldelete_opts = attrs.pop('LogicalDeleteMeta', None)
+        if new._meta.proxy:
+            # proxy models share the table, the options and the archive of
+            # their model
+            new._logicaldelete_meta = new._meta.concrete_model._logicaldelete_meta
+            new._meta.permissions += (("undelete_%s" % new._meta.module_name,
+                                       u'Can undelete %s' % new._meta.verbose_name_raw),)
+            return new
         if not new._meta.abstract:
             logicaldelete_models_registry.append(new)
-        logicaldelete_opts = attrs.pop('LogicalDeleteMeta', None)
         setattr(new, '_logicaldelete_meta', LogicalDeleteOptions(logicaldelete_opts))
+        if new._logicaldelete_meta.storage == 'archive' and not new._meta.abstract:
+            from logicaldelete.archive import create_archive_model
+            new._logicaldelete_archive = create_archive_model(new)
+            new._logicaldelete_archive._logicaldelete_model = new
         new._meta.permissions += (("undelete_%s" % new._meta.module_name,
                                    u'Can undelete %s' % new._meta.verbose_name_raw),)
         return new
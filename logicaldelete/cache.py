@@ -0,0 +1,300 @@
+# -*- coding: utf-8; -*-
+"""
+Cache of the primary keys of logically deleted objects, for the models with
+the ``cache_deleted`` option, used by ``objects.is_deleted(pk)``.
+
+Each process keeps, per model and database, a Bloom filter of the deleted
+primary keys and an LRU of exact answers: a key missing from the filter is
+not deleted, without querying the database. The filter is loaded from the
+database on first use, then only the objects deleted since the last
+``date_removed`` seen are read.
+
+Deletions and undeletions bump generation counters in a backend shared by
+the processes (``LOGICALDELETE_CACHE_BACKEND``, the process memory by
+default, or the Django cache with ``logicaldelete.cache.DjangoCacheBackend``):
+the filters read the new deletions when the deletion counter changes, and
+are rebuilt when the undeletion counter changes, and periodically to catch
+deletions committed late.
+"""
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.utils.encoding import force_unicode
+from django.utils.importlib import import_module
+
+
+class BloomFilter(object):
+    """
+    A set of ``capacity`` keys answering ``key in bloom`` with false
+    positives at a rate of about ``error_rate``, and no false negative.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(int(round(self.size * math.log(2) / capacity)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        digest = hashlib.md5(force_unicode(key).encode('utf-8')).hexdigest()
+        # double hashing: the i-th position is h1 + i * h2
+        h1, h2 = int(digest[:16], 16), int(digest[16:], 16) | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self.positions(key))
+
+
+class LRUCache(object):
+    """
+    A dict of at most ``size`` items, dropping the least recently used ones.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            return default
+        self.items[key] = value
+        return value
+
+    def set(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        if len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def discard(self, key):
+        self.items.pop(key, None)
+
+    def clear(self):
+        self.items.clear()
+
+
+class LocalMemoryBackend(object):
+    """
+    Generation counters in the memory of the process, for tests and
+    single process deployments.
+    """
+
+    def __init__(self):
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def get(self, keys):
+        return [self.generations.get(key, 0) for key in keys]
+
+    def incr(self, key):
+        with self.lock:
+            self.generations[key] = self.generations.get(key, 0) + 1
+            return self.generations[key]
+
+
+class DjangoCacheBackend(object):
+    """
+    Generation counters in the Django cache ``LOGICALDELETE_CACHE_ALIAS``
+    (``default`` by default), shared by the processes using it.
+    """
+    timeout = 30 * 24 * 3600
+
+    def __init__(self):
+        self.cache = get_cache(getattr(settings, 'LOGICALDELETE_CACHE_ALIAS', 'default'))
+
+    def get(self, keys):
+        values = self.cache.get_many(keys)
+        return [values.get(key, 0) for key in keys]
+
+    def incr(self, key):
+        while True:
+            try:
+                return self.cache.incr(key)
+            except ValueError:
+                # a missing counter is 0, the filters see it changed
+                if self.cache.add(key, 1, self.timeout):
+                    return 1
+
+
+class DeletedCache(object):
+    """
+    The Bloom filter and LRU of the deleted primary keys of ``model`` in
+    the database ``using``.
+    """
+    error_rate = 0.01
+    lru_size = 10000
+    # objects deleted up to this long before the last date_removed seen are
+    # read again, for transactions committed late
+    overlap = timedelta(minutes=1)
+    # the filter is rebuilt at least this often (in seconds): a transaction
+    # committed later than the overlap is missed by the incremental loads
+    rebuild_interval = 300
+
+    def __init__(self, model, using, backend):
+        self.model = model
+        self.using = using
+        self.backend = backend
+        key = 'logicaldelete.deleted.%s.%s.%s' % (model._meta.app_label,
+                                                 model._meta.object_name, using)
+        self.keys = [key + '.deleted', key + '.undeleted']
+        self.lock = threading.RLock()
+        self.lru = LRUCache(self.lru_size)
+        self.bloom = None
+        self.generations = None
+        self.watermark = None
+        self.built = 0
+
+    def queryset(self):
+        return self.model._default_manager.db_manager(self.using).only_deleted()
+
+    def key(self, pk):
+        return force_unicode(self.model._meta.pk.to_python(pk))
+
+    def refresh(self):
+        """
+        Reads the objects deleted since the last refresh, or rebuilds the
+        filter if objects were undeleted or it is older than
+        ``rebuild_interval``.
+        """
+        generations = self.backend.get(self.keys)
+        with self.lock:
+            if (self.bloom is None or generations[1] != self.generations[1] or
+                    time.time() - self.built > self.rebuild_interval):
+                self.rebuild()
+            elif generations[0] != self.generations[0]:
+                self.load(self.watermark - self.overlap if self.watermark else None)
+            self.generations = generations
+
+    def rebuild(self):
+        capacity = max(self.model._logicaldelete_meta.cache_deleted_capacity,
+                       self.queryset().count() * 2)
+        self.bloom = BloomFilter(capacity, self.error_rate)
+        self.lru.clear()
+        self.watermark = None
+        self.load(None)
+        self.built = time.time()
+
+    def load(self, since):
+        queryset = self.queryset()
+        if since is not None:
+            queryset = queryset.filter(date_removed__gte=since)
+        for pk, date_removed in queryset.values_list('pk', 'date_removed').iterator():
+            key = self.key(pk)
+            self.bloom.add(key)
+            self.lru.discard(key)
+            if self.watermark is None or date_removed > self.watermark:
+                self.watermark = date_removed
+
+    def is_deleted(self, pk):
+        """
+        Returns True if the object with the primary key ``pk`` is marked as
+        deleted. Only keys in the Bloom filter missing from the LRU are
+        checked in the database.
+        """
+        self.refresh()
+        key = self.key(pk)
+        with self.lock:
+            if key not in self.bloom:
+                return False
+            deleted = self.lru.get(key)
+        if deleted is None:
+            deleted = self.queryset().filter(pk=pk).exists()
+            with self.lock:
+                self.lru.set(key, deleted)
+        return deleted
+
+    def deleted(self, pk_list=None):
+        """
+        Adds the primary keys in ``pk_list`` to the filter and bumps the
+        deletion counter.
+        """
+        generation = self.backend.incr(self.keys[0])
+        with self.lock:
+            if self.bloom is None or pk_list is None:
+                return
+            for pk in pk_list:
+                key = self.key(pk)
+                self.bloom.add(key)
+                self.lru.discard(key)
+            if generation == self.generations[0] + 1:
+                # nothing else to read
+                self.generations = [generation, self.generations[1]]
+
+    def undeleted(self):
+        """
+        Bumps the undeletion counter, rebuilding all the filters.
+        """
+        self.backend.incr(self.keys[1])
+
+
+deleted_caches = {}
+_lock = threading.Lock()
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'LOGICALDELETE_CACHE_BACKEND',
+                       'logicaldelete.cache.LocalMemoryBackend')
+        module, name = path.rsplit('.', 1)
+        _backend = getattr(import_module(module), name)()
+    return _backend
+
+
+def set_backend(backend):
+    """
+    Replaces the generation backend, dropping the caches.
+    """
+    global _backend
+    with _lock:
+        _backend = backend
+        deleted_caches.clear()
+
+
+def is_cached(model):
+    logicaldelete_meta = getattr(model, '_logicaldelete_meta', None)
+    return logicaldelete_meta is not None and logicaldelete_meta.cache_deleted
+
+
+def get_deleted_cache(model, using):
+    """
+    Returns the DeletedCache of ``model`` in the database ``using``.
+    """
+    try:
+        return deleted_caches[model, using]
+    except KeyError:
+        with _lock:
+            return deleted_caches.setdefault((model, using),
+                                             DeletedCache(model, using, get_backend()))
+
+
+def objects_deleted(model, using, pk_list=None):
+    """
+    Records that objects of ``model`` were marked as deleted, with their
+    primary keys ``pk_list`` if known.
+    """
+    if is_cached(model):
+        get_deleted_cache(model, using).deleted(pk_list)
+
+
+def objects_undeleted(model, using):
+    """
+    Records that objects of ``model`` are no longer marked as deleted
+    (undeleted or removed).
+    """
+    if is_cached(model):
+        get_deleted_cache(model, using).undeleted()
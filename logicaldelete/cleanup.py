@@ -0,0 +1,441 @@
+# -*- coding: utf-8; -*-
+import json
+import os
+import Queue
+import re
+import sys
+import threading
+import time
+from datetime import timedelta
+from uuid import uuid4
+
+from django.db import IntegrityError, connections, router, transaction
+from django.db.models import Q
+from django.utils.timezone import now
+
+from logicaldelete.cache import objects_undeleted
+from logicaldelete.models import CleanupLease
+
+
+class Checkpoint(object):
+    """
+    Stores the last purged primary key per model in a JSON file, so an
+    interrupted cleanup resumes where it stopped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+        # models may be purged by several threads
+        self.lock = threading.RLock()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+
+    def get(self, key):
+        return self.state.get(key)
+
+    def set(self, key, value):
+        with self.lock:
+            self.state[key] = value
+            self.save()
+
+    def discard(self, key):
+        with self.lock:
+            if self.state.pop(key, None) is not None:
+                self.save()
+
+    def save(self):
+        with self.lock:
+            tmp_path = '%s.tmp' % self.path
+            with open(tmp_path, 'w') as f:
+                json.dump(self.state, f)
+            os.rename(tmp_path, self.path)
+
+
+TIMEDELTA_UNITS = {
+    's': 'seconds',
+    'm': 'minutes',
+    'h': 'hours',
+    'd': 'days',
+    'w': 'weeks',
+}
+
+timedelta_re = re.compile(r'^(\d+)([%s]?)$' % ''.join(TIMEDELTA_UNITS))
+
+
+def parse_timedelta(value):
+    """
+    Parses strings like ``'90'`` (seconds), ``'15m'``, ``'12h'``, ``'30d'``
+    or ``'2w'`` into a timedelta. Returns None for invalid values.
+    """
+    match = timedelta_re.match(value.strip())
+    if match is None:
+        return None
+    amount, unit = match.groups()
+    return timedelta(**{TIMEDELTA_UNITS[unit or 's']: int(amount)})
+
+
+def model_key(model, using):
+    return '%s:%s.%s' % (using, model._meta.app_label, model._meta.object_name)
+
+
+class Throttle(object):
+    """
+    Sleeps between chunks for a fixed time and, if ``max_rows_per_second``
+    is given, as long as needed to keep the purge rate below that limit.
+    """
+
+    def __init__(self, sleep=0, max_rows_per_second=None):
+        self.sleep = sleep
+        self.max_rows_per_second = max_rows_per_second
+        self.started = time.time()
+        self.rows = 0
+
+    def __call__(self, rows):
+        self.rows += rows
+        delay = self.sleep
+        if self.max_rows_per_second:
+            elapsed = time.time() - self.started
+            delay = max(delay, float(self.rows) / self.max_rows_per_second - elapsed)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def purgeable(model, using, older_than=None):
+    """
+    Returns the logically deleted objects of ``model`` that may be removed
+    according to the ``retain_for`` and ``max_tombstones`` options of the
+    model and to ``older_than``, a timedelta. When both ``retain_for`` and
+    ``older_than`` are given the longer one is used.
+    """
+    queryset = model._default_manager.only_deleted().using(using)
+    logicaldelete_meta = model._logicaldelete_meta
+    cutoff = None
+    retain_for = [period for period in (logicaldelete_meta.retain_for, older_than)
+                  if period is not None]
+    if retain_for:
+        cutoff = now() - max(retain_for)
+    if logicaldelete_meta.max_tombstones is not None:
+        # the newest purgeable object, ties on date_removed (objects deleted
+        # together) are broken by the primary key
+        first = queryset.order_by('-date_removed', '-pk').values_list('date_removed', 'pk')
+        first = list(first[logicaldelete_meta.max_tombstones:
+                           logicaldelete_meta.max_tombstones + 1])
+        if not first:
+            return queryset.none()
+        date_removed, pk = first[0]
+        queryset = queryset.filter(Q(date_removed__lt=date_removed) |
+                                   Q(date_removed=date_removed, pk__lte=pk))
+    if cutoff is not None:
+        queryset = queryset.filter(date_removed__lt=cutoff)
+    return queryset
+
+
+def supports_skip_locked(connection):
+    """
+    Returns True if the database of ``connection`` supports SELECT ... FOR
+    UPDATE SKIP LOCKED, which PostgreSQL has since 9.5.
+    """
+    if connection.vendor != 'postgresql':
+        return False
+    # pg_version is read when connecting
+    connection.cursor()
+    return connection.pg_version >= 90500
+
+
+def keyset_chunks(queryset, using, batch_size, last_pk=None):
+    """
+    Removes the objects of ``queryset`` in chunks of ``batch_size`` objects
+    after ``last_pk``, in primary key order, and yields the primary keys of
+    each removed chunk.
+    """
+    while True:
+        chunk = queryset
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        pk_list = list(chunk.order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not pk_list:
+            break
+        with transaction.commit_on_success(using=using):
+            queryset.filter(pk__in=pk_list).remove()
+        last_pk = pk_list[-1]
+        yield pk_list
+
+
+def skip_locked_chunks(queryset, using, batch_size):
+    """
+    Like ``keyset_chunks``, but the objects of each chunk are locked with
+    SELECT ... FOR UPDATE SKIP LOCKED, so other processes purging the same
+    model take other objects.
+    """
+    select = queryset.order_by('pk').values_list('pk', flat=True)[:batch_size]
+    sql, params = select.query.get_compiler(using).as_sql()
+    while True:
+        with transaction.commit_on_success(using=using):
+            cursor = connections[using].cursor()
+            cursor.execute('%s FOR UPDATE SKIP LOCKED' % sql, params)
+            pk_list = [row[0] for row in cursor.fetchall()]
+            if pk_list:
+                queryset.filter(pk__in=pk_list).remove()
+        if not pk_list:
+            break
+        yield pk_list
+
+
+def claim_lease(resource, bucket, owner, lease_timeout, using):
+    """
+    Claims the chunk ``bucket`` of ``resource`` for ``owner`` for
+    ``lease_timeout`` seconds. Returns False if the chunk is claimed by
+    another owner whose lease has not expired.
+    """
+    expires = now() + timedelta(seconds=lease_timeout)
+    leases = CleanupLease.objects.using(using)
+    try:
+        with transaction.commit_on_success(using=using):
+            leases.create(resource=resource, bucket=bucket, owner=owner, expires=expires)
+        return True
+    except IntegrityError:
+        pass
+    # take over an expired lease
+    with transaction.commit_on_success(using=using):
+        taken = leases.filter(resource=resource, bucket=bucket, expires__lt=now())\
+            .update(owner=owner, expires=expires)
+    return taken == 1
+
+
+def release_lease(resource, bucket, owner, using):
+    with transaction.commit_on_success(using=using):
+        CleanupLease.objects.using(using)\
+            .filter(resource=resource, bucket=bucket, owner=owner).delete()
+
+
+def leased_chunks(queryset, using, batch_size, resource, lease_timeout):
+    """
+    Like ``skip_locked_chunks``, for databases without SKIP LOCKED: the
+    objects are split in chunks of ``batch_size`` consecutive primary keys,
+    and a chunk is removed only after claiming it in the CleanupLease table.
+    Chunks claimed by other processes are skipped. Requires integer primary
+    keys.
+    """
+    pk = queryset.model._meta.pk
+    if pk.get_internal_type() not in ('AutoField', 'IntegerField', 'BigIntegerField',
+                                      'PositiveIntegerField'):
+        raise ValueError("Coordinated cleanup of %s requires an integer primary key."
+                         % queryset.model._meta.object_name)
+    owner = uuid4().hex
+    last_pk = None
+    while True:
+        chunk = queryset
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        first_pk = list(chunk.order_by('pk').values_list('pk', flat=True)[:1])
+        if not first_pk:
+            break
+        bucket = first_pk[0] // batch_size
+        start, end = bucket * batch_size, (bucket + 1) * batch_size
+        last_pk = end - 1
+        if not claim_lease(resource, bucket, owner, lease_timeout, using):
+            continue
+        try:
+            with transaction.commit_on_success(using=using):
+                pk_list = list(queryset.filter(pk__gte=start, pk__lt=end)
+                               .order_by('pk').values_list('pk', flat=True))
+                if pk_list:
+                    queryset.filter(pk__in=pk_list).remove()
+        finally:
+            release_lease(resource, bucket, owner, using)
+        if pk_list:
+            yield pk_list
+
+
+def purge(model, using, batch_size=1000, sleep=0, max_rows_per_second=None,
+          checkpoint=None, older_than=None, coordinated=False, lease_timeout=300):
+    """
+    Removes the logically deleted objects of ``model`` that are past their
+    retention (see ``purgeable``) in chunks of ``batch_size`` primary keys,
+    committing after each chunk. Chunks are read with keyset pagination on
+    the primary key, and the last purged primary key is stored in
+    ``checkpoint`` (if given) after each chunk.
+
+    With ``coordinated=True`` several processes can purge the same model at
+    once: chunks are claimed with SELECT ... FOR UPDATE SKIP LOCKED, or with
+    leases of ``lease_timeout`` seconds in the CleanupLease table on
+    databases without SKIP LOCKED (see ``leased_chunks``). Checkpoints are
+    not used then.
+
+    Returns the number of purged objects.
+    """
+    key = model_key(model, using)
+    throttle = Throttle(sleep, max_rows_per_second)
+    queryset = purgeable(model, using, older_than)
+    if coordinated:
+        checkpoint = None
+        if supports_skip_locked(connections[using]):
+            chunks = skip_locked_chunks(queryset, using, batch_size)
+        else:
+            chunks = leased_chunks(queryset, using, batch_size, key, lease_timeout)
+    else:
+        last_pk = checkpoint.get(key) if checkpoint is not None else None
+        chunks = keyset_chunks(queryset, using, batch_size, last_pk)
+    purged = 0
+    for pk_list in chunks:
+        purged += len(pk_list)
+        if checkpoint is not None:
+            checkpoint.set(key, pk_list[-1])
+        throttle(len(pk_list))
+    if checkpoint is not None:
+        checkpoint.discard(key)
+    if purged:
+        objects_undeleted(model, using)
+    return purged
+
+
+def referencing_models(model):
+    """
+    Returns the set of the models referencing ``model``, directly or
+    through other models.
+    """
+    seen = set([model])
+    stack = [model]
+    while stack:
+        current = stack.pop()
+        for related in current._meta.get_all_related_objects(include_hidden=True):
+            if related.model not in seen:
+                seen.add(related.model)
+                stack.append(related.model)
+    seen.discard(model)
+    return seen
+
+
+def dependency_graph(models):
+    """
+    Returns a dict mapping each model in ``models`` to the set of the other
+    models in ``models`` that reference it, directly or through other
+    models. Removing an object removes the objects referencing it, so these
+    models are purged first and never at the same time as the model.
+    """
+    return dict((model, referencing_models(model) & set(models)) for model in models)
+
+
+def conflicting_models(models):
+    """
+    Returns a dict mapping each model in ``models`` to the set of the other
+    models in ``models`` whose objects are referenced by the same models.
+    Removing their objects removes or updates the same rows, which may
+    deadlock, so they are never purged at the same time.
+    """
+    removed = dict((model, referencing_models(model) | set([model])) for model in models)
+    return dict((model, set(other for other in models
+                            if other is not model and removed[model] & removed[other]))
+                for model in models)
+
+
+def model_sort_key(model):
+    return model._meta.app_label, model._meta.object_name
+
+
+def run_in_order(graph, func, jobs=1, sort_key=model_sort_key, conflicts=None):
+    """
+    Calls ``func(model)`` for each model of ``graph`` (see
+    ``dependency_graph``) once ``func`` returned for the models it depends
+    on, running up to ``jobs`` calls at once in threads. Models in a
+    dependency cycle are run one at a time, and so are the models mapped to
+    each other by ``conflicts`` (see ``conflicting_models``). Models that
+    are ready at the same time are started in ``sort_key`` order.
+
+    Returns a dict mapping each model to the value returned by ``func``. If
+    a call raises, no more calls are started and the exception is raised
+    once the running calls are finished.
+    """
+    pending = dict((model, set(dependencies))
+                   for model, dependencies in graph.iteritems())
+    running = set()
+    finished = Queue.Queue()
+    results = {}
+    errors = []
+
+    def call(model):
+        try:
+            finished.put((model, func(model), None))
+        except Exception:
+            finished.put((model, None, sys.exc_info()))
+
+    while pending or running:
+        if errors:
+            pending.clear()
+        ready = sorted((model for model, dependencies in pending.iteritems()
+                        if not dependencies), key=sort_key)
+        if pending and not ready and not running:
+            # a dependency cycle
+            ready = sorted(pending, key=sort_key)[:1]
+        for model in ready:
+            if len(running) >= jobs:
+                break
+            if conflicts and conflicts[model] & running:
+                continue
+            del pending[model]
+            running.add(model)
+            if jobs > 1:
+                threading.Thread(target=call, args=(model,)).start()
+            else:
+                call(model)
+        if not running:
+            break
+        model, result, exc_info = finished.get()
+        running.discard(model)
+        if exc_info is not None:
+            errors.append(exc_info)
+            continue
+        results[model] = result
+        for dependencies in pending.itervalues():
+            dependencies.discard(model)
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+def purge_models(models, using, jobs=1, **kwargs):
+    """
+    Purges the logically deleted objects of ``models`` (see ``purge``) in
+    up to ``jobs`` threads, each with its own database connection. Models
+    are purged after the models referencing them, and models that depend on
+    each other or are referenced by the same models are never purged at the
+    same time.
+
+    Returns a dict mapping each model to the number of purged objects.
+    """
+    def purge_model(model):
+        try:
+            return purge(model, using, **kwargs)
+        finally:
+            if jobs > 1:
+                # the connection of the worker thread
+                connections[using].close()
+
+    return run_in_order(dependency_graph(models), purge_model, jobs,
+                        conflicts=conflicting_models(models))
+
+
+def purge_databases(models, databases, jobs=1, routed=True, **kwargs):
+    """
+    Purges ``models`` (see ``purge_models``) on each database alias in
+    ``databases`` at once, in a thread per alias. With ``routed=True`` only
+    the models the router allows syncdb for are purged on each alias.
+
+    Returns a dict mapping each alias to a (purged, seconds) tuple, where
+    ``purged`` is the dict returned by ``purge_models``.
+    """
+    def purge_database(using):
+        started = time.time()
+        try:
+            purged = purge_models([model for model in models
+                                   if not routed or router.allow_syncdb(using, model)],
+                                  using, jobs=jobs, **kwargs)
+        finally:
+            if len(databases) > 1:
+                connections[using].close()
+        return purged, time.time() - started
+
+    return run_in_order(dict((using, ()) for using in databases), purge_database,
+                        len(databases), sort_key=None)
@@ -1,143 +1,730 @@
 # -*- coding: utf-8; -*-
-from operator import attrgetter
+import logging
+from operator import attrgetter, or_
+from uuid import uuid4
 
+from django.conf import settings
+from django.dispatch.dispatcher import _make_id
 from django.utils.timezone import now
 from django.db.models.deletion import Collector, force_managed, sql, signals
-from django.db.models.deletion import ProtectedError
+from django.db.models.deletion import CASCADE, ProtectedError
+from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.query import QuerySet
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE
+from django.utils.datastructures import SortedDict
 
 from base import LogicalDeleteOptions
+from logicaldelete.archive import archive_rows, is_archived
+from logicaldelete.cache import objects_deleted
+from logicaldelete.fields import is_logical_through
+from logicaldelete.signals import pre_logical_delete_batch, post_logical_delete_batch
+from logicaldelete.signals import collector_stats
+from logicaldelete.stats import CollectorStats
+
+# receives the CollectorStats of each deletion at debug level, in the
+# ``stats`` attribute of the log record
+stats_logger = logging.getLogger('logicaldelete.stats')
+
+
+def has_listeners(signal, sender):
+    """
+    Returns True if ``signal`` has live receivers for ``sender``.
+    """
+    if not signal.receivers:
+        return False
+    return bool(signal._live_receivers(_make_id(sender)))
+
+
+def undeferred_model(model):
+    """
+    Returns the model of the deferred class ``model`` created by only() or
+    defer(), which receivers are connected to, or ``model`` itself.
+    """
+    while model._deferred:
+        model = model._meta.proxy_for_model
+    return model
+
+
+def batch_signal_senders(model):
+    """
+    Returns the models the batch signals for objects of ``model`` are sent
+    for: its concrete model, and ``model`` itself if it is a proxy model.
+    """
+    model = undeferred_model(model)
+    concrete_model = model._meta.concrete_model
+    return [concrete_model] if model is concrete_model else [concrete_model, model]
+
+
+def has_batch_listeners(signal, senders):
+    return any(has_listeners(signal, sender) for sender in senders)
+
+
+def send_batch_signal(signal, senders, **kwargs):
+    """
+    Sends ``signal`` for each model of ``senders`` having receivers.
+    """
+    for sender in senders:
+        if has_listeners(signal, sender):
+            signal.send(sender=sender, **kwargs)
+
+
+def logical_delete_values(model, date_removed, operation_id):
+    """
+    Returns the field values that mark an object of ``model`` as deleted by
+    the deletion operation ``operation_id``.
+    """
+    values = {'date_removed': date_removed}
+    if model._logicaldelete_meta.track_operations:
+        values['deletion_op'] = operation_id
+    return values
+
+
+class DeleteImpact(dict):
+    """
+    The impact of a deletion returned by ``LogicalDeleteCollector.estimate``.
+    ``truncated`` is True when relations deeper than ``max_depth`` were not
+    followed, so the counts may be too low.
+    """
+    truncated = False
 
 
 class LogicalDeleteCollector(Collector):
 
-    def __init__(self, *args, **kwargs):
-        super(LogicalDeleteCollector, self).__init__(*args, **kwargs)
-        self.edges = {}  # {from_instance: [to_instances]}
+    def __init__(self, using, date_removed=None, operation_id=None):
+        super(LogicalDeleteCollector, self).__init__(using)
+        # when set, used instead of the time of the deletion
+        self.date_removed = date_removed
+        # stamped on the objects marked as deleted by models with the
+        # track_operations option, see LogicalDeleteQuerySet.undelete()
+        self.operation_id = operation_id or uuid4().hex
+        # {from_node: [to_nodes]}, a node is a (concrete model, pk) tuple
+        self.edges = {}
         self.protected = set()
-        # key - instance, val: True - logical delete (not delete for plain
-        # models), False - delete ordinary
-        self.objs_for_delete = {}
+        # {concrete model: set([pks])} of objects to logical delete (not
+        # delete for plain models) and of objects to delete ordinary
+        self.logical_pks = {}
+        self.delete_pks = {}
+        # {concrete model: [models]} batch signals are sent for, with the
+        # proxy models objects were collected through
+        self.senders = {}
+        self.stats = CollectorStats(using, count_queries=settings.DEBUG or
+                                    self.stats_requested())
 
     def add_edge(self, source, target):
         self.edges.setdefault(source, []).append(target)
 
+    def get_node(self, obj):
+        """
+        Returns the node representing ``obj`` in the edge graph.
+        """
+        return obj._meta.concrete_model, obj._get_pk_val()
+
+    def add_senders(self, model):
+        senders = batch_signal_senders(model)
+        known = self.senders.setdefault(senders[0], [senders[0]])
+        known.extend(sender for sender in senders if sender not in known)
+
+    def get_senders(self, model):
+        """
+        Returns the models the batch signals for objects of the concrete
+        ``model`` are sent for.
+        """
+        return self.senders.get(model, [model])
+
+    def get_source_node_getter(self, model, source, source_attr):
+        """
+        Returns a function that gives the node of the object which caused
+        the collection of an instance of ``model`` through ``source_attr``.
+
+        When ``source_attr`` is a foreign key to the primary key of
+        ``source`` the node is built from the already loaded column value,
+        so the related object is never fetched.
+        """
+        try:
+            field = model._meta.get_field(source_attr)
+        except FieldDoesNotExist:
+            field = None
+        if (field is not None and source is not None and
+                getattr(field, 'rel', None) is not None and
+                field.rel.get_related_field() == source._meta.pk):
+            concrete_model = source._meta.concrete_model
+            attname = field.attname
+            return lambda obj: (concrete_model, getattr(obj, attname))
+        return lambda obj: self.get_node(getattr(obj, source_attr))
+
+    def stats_requested(self):
+        """
+        Returns True if the collector_stats signal or the stats logger have
+        receivers, so SQL statements have to be counted.
+        """
+        return (has_listeners(collector_stats, self.__class__) or
+                stats_logger.isEnabledFor(logging.DEBUG))
+
+    def report_stats(self):
+        """
+        Sends the statistics of the deletion with collector_stats and logs
+        them to the ``logicaldelete.stats`` logger.
+        """
+        if has_listeners(collector_stats, self.__class__):
+            collector_stats.send(sender=self.__class__, stats=self.stats, using=self.using)
+        if stats_logger.isEnabledFor(logging.DEBUG):
+            stats_logger.debug("Deletion stats: %r", self.stats,
+                               extra={'stats': self.stats.as_dict()})
+
     def collect(self, objs, source_attr=None, **kwargs):
-        for obj in objs:
-            if source_attr:
-                self.add_edge(getattr(obj, source_attr), obj)
+        with self.stats.phase('collect'):
+            get_source_node = None
+            if objs:
+                self.add_senders(objs[0].__class__)
+            for obj in objs:
+                if source_attr:
+                    if get_source_node is None:
+                        get_source_node = self.get_source_node_getter(
+                            obj.__class__, kwargs.get('source'), source_attr)
+                    self.add_edge(get_source_node(obj), self.get_node(obj))
+                else:
+                    self.add_edge(None, self.get_node(obj))
+            try:
+                return super(LogicalDeleteCollector, self).\
+                collect(objs, source_attr=source_attr, **kwargs)
+            except ProtectedError, e:
+                self.protected.update(e.protected_objects)
+
+    def get_collected_fields(self, model):
+        """
+        Returns the names of the fields to load for collected objects of
+        ``model``: the primary key, the foreign keys needed for the edges and
+        date_removed. Returns None when pre_delete or post_delete receivers
+        need the full objects.
+        """
+        logicaldelete_meta = getattr(model, '_logicaldelete_meta', None)
+        if ((logicaldelete_meta is None or logicaldelete_meta.instance_signals) and
+                (has_listeners(signals.pre_delete, model) or
+                 has_listeners(signals.post_delete, model))):
+            return None
+        opts = model._meta
+        fields = [opts.pk.name]
+        fields.extend(f.name for f in opts.fields
+                      if f.rel is not None and f is not opts.pk)
+        if logicaldelete_meta is not None:
+            fields.append('date_removed')
+        return fields
+
+    def only_collected_fields(self, objs):
+        """
+        Restricts the queryset ``objs`` to the fields returned by
+        ``get_collected_fields``.
+        """
+        fields = self.get_collected_fields(objs.model)
+        if fields is None:
+            return objs
+        return objs.only(*fields)
+
+    def related_objects(self, related, objs):
+        return self.only_collected_fields(
+            super(LogicalDeleteCollector, self).related_objects(related, objs))
+
+    def can_fast_update(self, objs):
+        """
+        Determines if the objects in ``objs`` can be marked as deleted with a
+        single UPDATE, without collecting them first. This is possible when
+        ``objs`` is a queryset of a logical deletion model, no pre_delete or
+        post_delete receivers are connected for that model and there are no
+        related objects that the collector would have to handle.
+
+        Receivers of pre_delete and post_delete are ignored when the model
+        has the instance_signals option set to False.
+        """
+        if not hasattr(objs, 'query'):
+            return False
+        model = objs.model
+        if not hasattr(model, '_logicaldelete_meta'):
+            return False
+        opts = model._meta
+        if opts.parents:
+            return False
+        logicaldelete_meta = model._logicaldelete_meta
+        if logicaldelete_meta.instance_signals and (
+                has_listeners(signals.pre_delete, model) or
+                has_listeners(signals.post_delete, model)):
+            return False
+        for related in opts.get_all_related_objects(
+                include_hidden=True, include_proxy_eq=True):
+            if related.model._meta.auto_created:
+                if logicaldelete_meta.delete_batches:
+                    return False
+            elif (logicaldelete_meta.delete_related and
+                    related.field.rel.on_delete is CASCADE):
+                return False
+        if logicaldelete_meta.delete_related:
+            for relation in opts.many_to_many:
+                if not relation.rel.through:
+                    return False
+        return True
+
+    def fast_update(self, objs):
+        """
+        Marks the objects in ``objs`` as deleted with a single UPDATE
+        statement. Returns the number of marked rows.
+
+        If the batch signals have receivers, or the model has archive
+        storage, only the primary keys are fetched first.
+        """
+        model = objs.model._meta.concrete_model
+        self.add_senders(objs.model)
+        senders = self.get_senders(model)
+        date_removed = self.date_removed or now()
+        with self.stats.phase('fast_update'):
+            if not is_archived(model) and not (
+                    has_batch_listeners(pre_logical_delete_batch, senders) or
+                    has_batch_listeners(post_logical_delete_batch, senders)):
+                count = QuerySet.update(objs, **logical_delete_values(
+                    model, date_removed, self.operation_id))
+                objects_deleted(model, self.using)
             else:
-                self.add_edge(None, obj)
-        try:
-            return super(LogicalDeleteCollector, self).\
-            collect(objs, source_attr=source_attr, **kwargs)
-        except ProtectedError, e:
-            self.protected.update(e.protected_objects)
-
-    def _determine_object_delete_method(self, obj, seen,
-                safe_deletion=LogicalDeleteOptions.safe_deletion,
-                delete_related=LogicalDeleteOptions.delete_related,
-                was_plain_object=False):
-        if obj in seen:
-            return []
-        seen.add(obj)
-        model = obj.__class__
-        child_safe_deletion = safe_deletion
-        if hasattr(model, '_logicaldelete_meta'):
-            delete_related = model._logicaldelete_meta.delete_related
-            child_safe_deletion = model._logicaldelete_meta.safe_deletion
-        else:
-            was_plain_object = True
-
-        if delete_related:
-            for child in self.edges.get(obj, ()):
-                self._determine_object_delete_method(child, seen,
-                        child_safe_deletion, delete_related, was_plain_object)
-
-        if hasattr(model, '_logicaldelete_meta') and not was_plain_object:
-            self.objs_for_delete[obj] = True
-        else:
-            self.objs_for_delete[obj] = safe_deletion
+                pk_list = list(objs.values_list('pk', flat=True))
+                self.mark_deleted([(model, pk_list)], date_removed)
+                count = len(pk_list)
+        self.stats.add_count(model, 'logical', count)
+        self.report_stats()
+        return count
+
+    @force_managed
+    def mark_deleted(self, batches, date_removed):
+        """
+        Marks as deleted the objects in ``batches``, a list of (model,
+        pk_list) pairs, sending pre_logical_delete_batch and
+        post_logical_delete_batch around each update. Objects of models with
+        archive storage are moved to the archive table.
+        """
+        for model, pk_list in batches:
+            if not pk_list:
+                continue
+            senders = self.get_senders(model)
+            send_batch_signal(pre_logical_delete_batch, senders, pk_list=pk_list,
+                              date_removed=date_removed, using=self.using)
+            values = logical_delete_values(model, date_removed, self.operation_id)
+            if is_archived(model):
+                archive_rows(model, pk_list, values, self.using)
+            else:
+                sql.UpdateQuery(model).update_batch(pk_list, values, self.using)
+            objects_deleted(model, self.using, pk_list)
+            send_batch_signal(post_logical_delete_batch, senders, pk_list=pk_list,
+                              date_removed=date_removed, using=self.using)
+
+    def mark_removed(self, model, field, pk_list, date_removed):
+        """
+        Marks as removed the rows of ``model``, the intermediary model of a
+        LogicalManyToManyField, whose foreign key ``field`` points to an
+        object in ``pk_list``.
+        """
+        for offset in range(0, len(pk_list), GET_ITERATOR_CHUNK_SIZE):
+            QuerySet(model, using=self.using).filter(**{
+                '%s__in' % field.name: pk_list[offset:offset + GET_ITERATOR_CHUNK_SIZE],
+                'date_removed': None,
+            }).update(date_removed=date_removed)
+
+    def send_instance_signals(self, signal):
+        """
+        Sends ``signal`` (pre_delete or post_delete) for every collected
+        object affected by the deletion, except objects marked as deleted
+        by models with the instance_signals option set to False.
+        """
+        for model, instances in self.data.iteritems():
+            # objects collected with only_collected_fields() are deferred
+            model = undeferred_model(model)
+            if model._meta.auto_created or not has_listeners(signal, model):
+                continue
+            logicaldelete_meta = getattr(model, '_logicaldelete_meta', None)
+            skip_logical = (logicaldelete_meta is not None and
+                            not logicaldelete_meta.instance_signals)
+            for obj in instances:
+                logical = self.get_delete_method(self.get_node(obj))
+                if logical is None or (logical and skip_logical):
+                    continue
+                signal.send(sender=model, instance=obj, using=self.using)
 
     def determine_object_delete_method(self):
         """
         Determine which delete method will be apply for object
+
+        The edge graph is walked depth-first with an explicit stack, so the
+        objects are visited in the same order as a recursive walk would do,
+        and the first visit of an object decides its delete method.
         """
+        logical_pks, delete_pks = self.logical_pks, self.delete_pks
         seen = set()
-        for root in self.edges.get(None, ()):
-            self._determine_object_delete_method(root, seen)
+        model_options = {}
+        roots = self.edges.get(None, ())
+        stack = [(root, LogicalDeleteOptions.safe_deletion,
+                  LogicalDeleteOptions.delete_related, False)
+                 for root in reversed(roots)]
+        while stack:
+            node, safe_deletion, delete_related, was_plain_object = stack.pop()
+            if node in seen:
+                continue
+            seen.add(node)
+            model = node[0]
+            try:
+                logicaldelete_meta = model_options[model]
+            except KeyError:
+                logicaldelete_meta = model_options[model] = \
+                    getattr(model, '_logicaldelete_meta', None)
+
+            child_safe_deletion = safe_deletion
+            if logicaldelete_meta is not None:
+                delete_related = logicaldelete_meta.delete_related
+                child_safe_deletion = logicaldelete_meta.safe_deletion
+            else:
+                was_plain_object = True
+
+            if delete_related:
+                children = self.edges.get(node)
+                if children:
+                    stack.extend((child, child_safe_deletion, delete_related,
+                                  was_plain_object)
+                                 for child in reversed(children))
+
+            if logicaldelete_meta is not None and not was_plain_object:
+                logical = True
+            else:
+                logical = safe_deletion
+            pks = logical_pks if logical else delete_pks
+            pks.setdefault(model, set()).add(node[1])
+
+    def plan(self, objs, max_depth=10, count=False):
+        """
+        Returns the querysets of the objects affected by the deletion of the
+        queryset ``objs``, as (queryset, logical) pairs in the order they
+        would be collected, where logical is True for objects marked as
+        deleted (or kept, for plain models) and False for objects deleted
+        ordinary, as decided by ``determine_object_delete_method``, and
+        whether relations deeper than ``max_depth`` were left out, as a
+        (steps, truncated) pair.
+
+        No object is loaded: related objects are followed along CASCADE
+        foreign keys and generic relations with subqueries, up to
+        ``max_depth`` relations deep (without limit if None).
+        Objects reachable through several relations may appear in several
+        querysets. With ``count=True`` each queryset is counted, the pairs
+        become (queryset, logical, count) triples and the relations of
+        empty querysets are not followed.
+        """
+        steps = []
+        truncated = False
+        stack = [(objs, LogicalDeleteOptions.safe_deletion,
+                  LogicalDeleteOptions.delete_related, False, ())]
+        while stack:
+            qs, safe_deletion, delete_related, was_plain_object, path = stack.pop()
+            model = qs.model
+            logicaldelete_meta = getattr(model, '_logicaldelete_meta', None)
+
+            child_safe_deletion = safe_deletion
+            if logicaldelete_meta is not None:
+                delete_related = logicaldelete_meta.delete_related
+                child_safe_deletion = logicaldelete_meta.safe_deletion
+            else:
+                was_plain_object = True
+            if logicaldelete_meta is not None and not was_plain_object:
+                logical = True
+            else:
+                logical = safe_deletion
+
+            if count:
+                total = qs.count()
+                steps.append((qs, logical, total))
+                if not total:
+                    continue
+            else:
+                steps.append((qs, logical))
+
+            # rows of auto created through models are deleted in batches
+            batches = not logical or (logicaldelete_meta is not None and
+                                      logicaldelete_meta.delete_batches)
+            path += (qs,)
+            related_objs = []
+            for related in model._meta.get_all_related_objects(include_hidden=True):
+                field = related.field
+                sub_objs = related.model._base_manager.using(self.using).filter(
+                    **{'%s__in' % field.name: qs.values(field.rel.field_name)})
+                if related.model._meta.auto_created:
+                    if batches:
+                        # relations of LogicalManyToManyField are kept
+                        marked = logical and is_logical_through(related.model)
+                        steps.append((sub_objs, marked, sub_objs.count())
+                                     if count else (sub_objs, marked))
+                    continue
+                if delete_related and field.rel.on_delete is CASCADE:
+                    related_objs.append((sub_objs, child_safe_deletion, delete_related,
+                                         was_plain_object))
+            if delete_related:
+                # generic relations, like GenericRelation.bulk_related_objects()
+                for relation in model._meta.many_to_many:
+                    if relation.rel.through:
+                        continue
+                    from django.contrib.contenttypes.models import ContentType
+                    content_type = ContentType.objects.db_manager(self.using)\
+                        .get_for_model(model)
+                    sub_objs = relation.rel.to._base_manager.using(self.using).filter(**{
+                        relation.content_type_field_name: content_type,
+                        '%s__in' % relation.object_id_field_name: qs.values('pk')})
+                    # collected without a source, so they get the delete
+                    # method of the deleted objects themselves
+                    related_objs.append((sub_objs, LogicalDeleteOptions.safe_deletion,
+                                         LogicalDeleteOptions.delete_related, False))
+            if related_objs and max_depth is not None and len(path) > max_depth:
+                truncated = True
+                continue
+
+            children = []
+            for sub_objs, sub_safe_deletion, sub_delete_related, sub_was_plain in related_objs:
+                # don't walk the same objects again in a cycle of relations
+                for ancestor in path:
+                    if ancestor.model._meta.concrete_model is sub_objs.model._meta.concrete_model:
+                        sub_objs = sub_objs.exclude(pk__in=ancestor.values('pk'))
+                children.append((sub_objs, sub_safe_deletion, sub_delete_related,
+                                 sub_was_plain, path))
+            stack.extend(reversed(children))
+        return steps, truncated
+
+    def can_cascade_update(self, objs):
+        """
+        Determines if the deletion of the queryset ``objs`` can be done
+        with one statement per relation, see ``cascade_update``. This is
+        possible when the relations followed by the deletion contain no
+        cycle, every model is reached with a single delete method, and no
+        instance or batch signal has to be sent for the affected objects.
+        Inherited models, generic relations and archive storage are not
+        supported.
+        """
+        if not hasattr(objs, 'query') or not hasattr(objs.model, '_logicaldelete_meta'):
+            return False
+        delete_methods = {}
+        stack = [(objs.model, LogicalDeleteOptions.safe_deletion,
+                  LogicalDeleteOptions.delete_related, False, ())]
+        while stack:
+            model, safe_deletion, delete_related, was_plain_object, path = stack.pop()
+            opts = model._meta
+            if model in path or opts.parents:
+                return False
+            logicaldelete_meta = getattr(model, '_logicaldelete_meta', None)
+
+            child_safe_deletion = safe_deletion
+            if logicaldelete_meta is not None:
+                delete_related = logicaldelete_meta.delete_related
+                child_safe_deletion = logicaldelete_meta.safe_deletion
+            else:
+                was_plain_object = True
+            if logicaldelete_meta is not None and not was_plain_object:
+                logical = True
+            else:
+                logical = safe_deletion
+            if delete_methods.setdefault(model, logical) != logical:
+                return False
+
+            if logicaldelete_meta is not None and logical:
+                senders = batch_signal_senders(model)
+                if (is_archived(model) or
+                        has_batch_listeners(pre_logical_delete_batch, senders) or
+                        has_batch_listeners(post_logical_delete_batch, senders)):
+                    return False
+                instance_signals = logicaldelete_meta.instance_signals
+            else:
+                instance_signals = True
+            if instance_signals and (has_listeners(signals.pre_delete, model) or
+                                     has_listeners(signals.post_delete, model)):
+                return False
+
+            if delete_related:
+                # generic relations are collected with bulk_related_objects()
+                for relation in opts.many_to_many:
+                    if not relation.rel.through:
+                        return False
+                path += (model,)
+                for related in opts.get_all_related_objects(include_hidden=True):
+                    if (not related.model._meta.auto_created and
+                            related.field.rel.on_delete is CASCADE):
+                        stack.append((related.model, child_safe_deletion,
+                                      delete_related, was_plain_object, path))
+        return True
+
+    @force_managed
+    def cascade_update(self, objs):
+        """
+        Deletes the queryset ``objs`` and the objects related to it with
+        one UPDATE or DELETE statement per relation, selecting the related
+        objects with subqueries (see ``plan``) instead of lists of primary
+        keys. The deepest relations are handled first, so the subqueries
+        still see their parents. Returns the number of objects of ``objs``
+        marked as deleted.
+        """
+        date_removed = self.date_removed or now()
+        count = 0
+        with self.stats.phase('cascade_update'):
+            steps, truncated = self.plan(objs, max_depth=None)
+            for qs, logical in reversed(steps):
+                model = qs.model
+                if not logical:
+                    # like DeleteQuery.do_query(), the subqueries need no join
+                    query = sql.DeleteQuery(model)
+                    query.tables = [model._meta.db_table]
+                    query.where = qs.query.where
+                    cursor = query.get_compiler(self.using).execute_sql(None)
+                    self.stats.add_count(model, 'deleted', cursor.rowcount if cursor else 0)
+                elif is_logical_through(model):
+                    QuerySet.update(qs.filter(date_removed=None), date_removed=date_removed)
+                elif hasattr(model, '_logicaldelete_meta'):
+                    count = QuerySet.update(qs, **logical_delete_values(
+                        model, date_removed, self.operation_id))
+                    objects_deleted(model, self.using)
+                    self.stats.add_count(model, 'logical', count)
+        self.report_stats()
+        # the objects of objs are the first step, so updated last
+        return count
+
+    def estimate(self, objs, max_depth=10):
+        """
+        Returns the number of objects the deletion of the queryset ``objs``
+        would affect, as a ``DeleteImpact`` dict mapping each model to a
+        dict with the number of objects marked as deleted (``'logical'``)
+        and deleted ordinary (``'hard'``). Only COUNT statements are run,
+        see ``plan``.
+
+        Objects reachable through several relations are counted once: the
+        querysets of a model are counted together with a single COUNT over
+        their union, or one after another excluding the objects of the
+        previous ones when they differ in delete method, since the first
+        relation reaching an object decides it.
+        """
+        steps, truncated = self.plan(objs, max_depth, count=True)
+        querysets = SortedDict()
+        for qs, logical, total in steps:
+            if total:
+                querysets.setdefault(qs.model, []).append((qs, logical, total))
+
+        impact = DeleteImpact()
+        impact.truncated = truncated
+        for model, counted in querysets.iteritems():
+            counts = {'logical': 0, 'hard': 0}
+            if len(counted) == 1:
+                qs, logical, total = counted[0]
+                counts['logical' if logical else 'hard'] = total
+            elif len(set(logical for qs, logical, total in counted)) == 1:
+                query = reduce(or_, [Q(pk__in=qs.values('pk')) for qs, logical, total in counted])
+                total = model._base_manager.using(self.using).filter(query).count()
+                counts['logical' if counted[0][1] else 'hard'] = total
+            else:
+                previous = []
+                for qs, logical, total in counted:
+                    if previous:
+                        total = qs.exclude(reduce(or_, previous)).count()
+                    counts['logical' if logical else 'hard'] += total
+                    previous.append(Q(pk__in=qs.values('pk')))
+            if not hasattr(model, '_logicaldelete_meta') and not is_logical_through(model):
+                # plain objects that are kept
+                counts['logical'] = 0
+            if counts['logical'] or counts['hard']:
+                impact[model] = counts
+        return impact
+
+    def get_delete_method(self, node):
+        """
+        Returns True if the object of ``node`` is deleted logically (or kept,
+        for plain models), False if it is deleted ordinary and None if it is
+        not affected by the deletion.
+        """
+        model, pk = node
+        if pk in self.logical_pks.get(model, ()):
+            return True
+        if pk in self.delete_pks.get(model, ()):
+            return False
+        return None
 
     @force_managed
     def delete(self):
+        stats = self.stats
+
         # sort instance collections
-        for model, instances in self.data.items():
-            self.data[model] = sorted(instances, key=attrgetter("pk"))
+        with stats.phase('sort'):
+            for model, instances in self.data.items():
+                self.data[model] = sorted(instances, key=attrgetter("pk"))
 
-        # if possible, bring the models in an order suitable for databases that
-        # don't support transactions or cannot defer constraint checks until
-        # the end of a transaction.
-        self.sort()
-        self.determine_object_delete_method()
+            # if possible, bring the models in an order suitable for databases that
+            # don't support transactions or cannot defer constraint checks until
+            # the end of a transaction.
+            self.sort()
+        with stats.phase('determine_delete_method'):
+            self.determine_object_delete_method()
+        for model, pks in self.logical_pks.iteritems():
+            stats.add_count(model, 'logical' if hasattr(model, '_logicaldelete_meta')
+                            else 'kept', len(pks))
+        for model, pks in self.delete_pks.iteritems():
+            stats.add_count(model, 'deleted', len(pks))
 
         # send pre_delete signals
-        for model, obj in self.instances_with_model():
-            if not model._meta.auto_created and obj in self.objs_for_delete:
-                signals.pre_delete.send(
-                    sender=model, instance=obj, using=self.using
-                )
+        with stats.phase('pre_delete_signals'):
+            self.send_instance_signals(signals.pre_delete)
 
         # reverse instance collections
         for instances in self.data.itervalues():
             instances.reverse()
 
+        date_removed = self.date_removed or now()
+
         # delete batches
-        for model, batches in self.batches.iteritems():
-            query = sql.DeleteQuery(model)
-            for field, instances in batches.iteritems():
-                pk_list = []
-                for obj in instances:
-                    if not obj in self.objs_for_delete:
-                        continue
-                    if not self.objs_for_delete[obj]:
-                        pk_list.append(obj.pk)
-                    elif hasattr(obj, '_logicaldelete_meta') and\
-                        obj._logicaldelete_meta.delete_batches:
-                        pk_list.append(obj.pk)
-                query.delete_batch(pk_list, self.using, field)
-
-        date_removed = now()
-        # delete instances, mark as deleted for logicaldelete
-        for model, instances in self.data.iteritems():
-            query_logical = sql.UpdateQuery(model)
-            query = sql.DeleteQuery(model)
-            pk_list_logical, pk_list = [], []
-            for obj in instances:
-                if not obj in self.objs_for_delete:
-                    continue
-                if self.objs_for_delete[obj] and hasattr(model, '_logicaldelete_meta'):
-                    pk_list_logical.append(obj.pk)
-                if not self.objs_for_delete[obj]:
-                    pk_list.append(obj.pk)
+        with stats.phase('delete_batches'):
+            for model, batches in self.batches.iteritems():
+                query = sql.DeleteQuery(model)
+                logical_through = is_logical_through(model)
+                for field, instances in batches.iteritems():
+                    pk_list = []
+                    mark_list = []
+                    for obj in instances:
+                        logical = self.get_delete_method(self.get_node(obj))
+                        if logical is None:
+                            continue
+                        if not logical:
+                            pk_list.append(obj.pk)
+                        elif hasattr(obj, '_logicaldelete_meta') and\
+                            obj._logicaldelete_meta.delete_batches:
+                            # relations of LogicalManyToManyField are kept
+                            (mark_list if logical_through else pk_list).append(obj.pk)
+                    query.delete_batch(pk_list, self.using, field)
+                    self.mark_removed(model, field, mark_list, date_removed)
 
-            if pk_list_logical:
-                query_logical.update_batch(pk_list_logical,
-                            {'date_removed': date_removed}, self.using)
+        # mark as deleted for logicaldelete
+        with stats.phase('mark_deleted'):
+            self.mark_deleted([(model, sorted(pks))
+                               for model, pks in self.logical_pks.iteritems()
+                               if hasattr(model, '_logicaldelete_meta')],
+                              date_removed)
 
-            if pk_list:
-                query.delete_batch(pk_list, self.using)
+        # delete instances
+        with stats.phase('delete_instances'):
+            for model, instances in self.data.iteritems():
+                delete_pks = self.delete_pks.get(model._meta.concrete_model, ())
+                pk_list = [obj.pk for obj in instances if obj.pk in delete_pks]
+                if pk_list:
+                    sql.DeleteQuery(model).delete_batch(pk_list, self.using)
 
         # send post_delete signals
-        for model, obj in self.instances_with_model():
-            if not model._meta.auto_created and obj in self.objs_for_delete:
-                signals.post_delete.send(
-                    sender=model, instance=obj, using=self.using
-                )
+        with stats.phase('post_delete_signals'):
+            self.send_instance_signals(signals.post_delete)
 
         # update collected instances
         for model, instances in self.data.iteritems():
+            track_operations = hasattr(model, '_logicaldelete_meta') and \
+                model._logicaldelete_meta.track_operations
             for instance in instances:
-                if not instance in self.objs_for_delete:
+                logical = self.get_delete_method(self.get_node(instance))
+                if logical is None:
                     continue
-                if self.objs_for_delete[instance]:
+                if logical:
                     setattr(instance, 'date_removed', date_removed)
+                    if track_operations:
+                        setattr(instance, 'deletion_op', self.operation_id)
                 else:
                     setattr(instance, model._meta.pk.attname, None)
+
+        self.report_stats()
@@ -0,0 +1,32 @@
+# -*- coding: utf-8; -*-
+"""
+Cursors of the feed of deleted objects, see
+LogicalDeletedManager.deleted_since().
+"""
+import base64
+import json
+
+from django.utils.dateparse import parse_datetime
+
+
+def encode_cursor(date_removed, pk):
+    """
+    Returns the cursor token of the deleted object with ``date_removed``
+    and primary key ``pk``.
+    """
+    return base64.urlsafe_b64encode(json.dumps([date_removed.isoformat(), pk]))
+
+
+def decode_cursor(cursor):
+    """
+    Returns the (date_removed, pk) tuple of the cursor token ``cursor``.
+    Raises ValueError for invalid tokens.
+    """
+    try:
+        date_removed, pk = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        date_removed = parse_datetime(date_removed)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor: %r" % cursor)
+    if date_removed is None:
+        raise ValueError("Invalid cursor: %r" % cursor)
+    return date_removed, pk
@@ -0,0 +1,239 @@
+# -*- coding: utf-8; -*-
+from django.db import connections, models, router
+from django.db.models.fields.related import (add_lazy_relation, create_many_related_manager,
+                                             ManyRelatedObjectsDescriptor,
+                                             ReverseManyRelatedObjectsDescriptor,
+                                             RECURSIVE_RELATIONSHIP_CONSTANT)
+from django.db.models import signals
+from django.db.models.query import QuerySet
+from django.db.models.sql.constants import TABLE_NAME
+from django.utils.functional import cached_property
+from django.utils.timezone import now
+
+
+def is_logical_through(model):
+    """
+    Returns True if ``model`` is the intermediary model of a
+    LogicalManyToManyField.
+    """
+    return getattr(model, '_logicaldelete_through', False)
+
+
+class MembershipQuerySet(QuerySet):
+    """
+    QuerySet of intermediary models of LogicalManyToManyField, delete()
+    marks the rows as deleted.
+    """
+
+    def delete(self):
+        self.filter(date_removed__isnull=True).update(date_removed=now())
+
+    delete.alters_data = True
+
+    def remove(self):
+        """
+        Deletes the rows in the current QuerySet.
+        """
+        QuerySet.delete(self)
+
+    remove.alters_data = True
+
+
+class MembershipManager(models.Manager):
+
+    def get_query_set(self):
+        return MembershipQuerySet(self.model, using=self._db)
+
+
+def create_logical_intermediary_model(field, klass):
+    """
+    Like ``create_many_to_many_intermediary_model``, with a date_removed
+    column marking removed relations.
+    """
+    managed = True
+    lazy = False
+    if isinstance(field.rel.to, basestring) and field.rel.to != RECURSIVE_RELATIONSHIP_CONSTANT:
+        to_model = field.rel.to
+        to = to_model.split('.')[-1]
+        lazy = True
+    elif isinstance(field.rel.to, basestring):
+        to = klass._meta.object_name
+        to_model = klass
+        managed = klass._meta.managed
+    else:
+        to = field.rel.to._meta.object_name
+        to_model = field.rel.to
+        managed = klass._meta.managed or to_model._meta.managed
+    name = '%s_%s' % (klass._meta.object_name, field.name)
+    if field.rel.to == RECURSIVE_RELATIONSHIP_CONSTANT or to == klass._meta.object_name:
+        from_ = 'from_%s' % to.lower()
+        to = 'to_%s' % to.lower()
+    else:
+        from_ = klass._meta.object_name.lower()
+        to = to.lower()
+    meta = type('Meta', (object,), {
+        'db_table': field._get_m2m_db_table(klass._meta),
+        'managed': managed,
+        'auto_created': klass,
+        'app_label': klass._meta.app_label,
+        'db_tablespace': klass._meta.db_tablespace,
+        'unique_together': (from_, to),
+        'verbose_name': '%(from)s-%(to)s relationship' % {'from': from_, 'to': to},
+        'verbose_name_plural': '%(from)s-%(to)s relationships' % {'from': from_, 'to': to},
+    })
+    through = type(name, (models.Model,), {
+        'Meta': meta,
+        '__module__': klass.__module__,
+        '_logicaldelete_through': True,
+        'objects': MembershipManager(),
+        from_: models.ForeignKey(klass, related_name='%s+' % name, db_tablespace=field.db_tablespace),
+        to: models.ForeignKey(to_model, related_name='%s+' % name, db_tablespace=field.db_tablespace),
+        'date_removed': models.DateTimeField(null=True, blank=True, editable=False),
+    })
+    if lazy:
+        # unlike create_many_to_many_intermediary_model this runs before the
+        # field is set up, so the target may be resolved right away
+        def set_managed(field, model, cls):
+            through._meta.managed = model._meta.managed or cls._meta.managed
+        add_lazy_relation(klass, field, to_model, set_managed)
+    return through
+
+
+def active_memberships(queryset, through):
+    """
+    Excludes the objects of ``queryset`` joined through removed rows of
+    ``through``, the intermediary model of a LogicalManyToManyField.
+    """
+    query = queryset.query
+    for alias in query.tables:
+        if (query.alias_refcount[alias] and
+                query.alias_map[alias][TABLE_NAME] == through._meta.db_table):
+            break
+    else:
+        return queryset
+    qn = connections[queryset.db].ops.quote_name
+    column = through._meta.get_field('date_removed').column
+    return queryset.extra(where=['%s.%s IS NULL' % (qn(alias), qn(column))])
+
+
+def create_logical_many_related_manager(superclass, rel):
+    """
+    Creates a many related manager (see ``create_many_related_manager``)
+    ignoring removed relations, that marks relations as removed instead of
+    deleting them.
+    """
+    manager_cls = create_many_related_manager(superclass, rel)
+
+    class LogicalManyRelatedManager(manager_cls):
+
+        def get_query_set(self):
+            qs = super(LogicalManyRelatedManager, self).get_query_set()
+            if self.prefetch_cache_name in getattr(self.instance, '_prefetched_objects_cache', {}):
+                return qs
+            return active_memberships(qs, self.through)
+
+        def get_prefetch_query_set(self, instances):
+            result = super(LogicalManyRelatedManager, self).get_prefetch_query_set(instances)
+            return (active_memberships(result[0], self.through),) + result[1:]
+
+        def _add_items(self, source_field_name, target_field_name, *objs):
+            # like ManyRelatedManager._add_items(), but removed relations are
+            # restored instead of added, and are part of the pk_set of the
+            # m2m_changed signals like the added ones
+            if not objs:
+                return
+            new_ids = set()
+            for obj in objs:
+                if isinstance(obj, self.model):
+                    if not router.allow_relation(obj, self.instance):
+                        raise ValueError('Cannot add "%r": instance is on database "%s", '
+                                         'value is on database "%s"' %
+                                         (obj, self.instance._state.db, obj._state.db))
+                    fk_val = self._get_fk_val(obj, target_field_name)
+                    if fk_val is None:
+                        raise ValueError('Cannot add "%r": the value for field "%s" is None' %
+                                         (obj, target_field_name))
+                    new_ids.add(fk_val)
+                elif isinstance(obj, models.Model):
+                    raise TypeError("'%s' instance expected, got %r" %
+                                    (self.model._meta.object_name, obj))
+                else:
+                    new_ids.add(obj)
+            db = router.db_for_write(self.through, instance=self.instance)
+            memberships = self.through._default_manager.using(db).filter(**{
+                source_field_name: self._fk_val,
+                '%s__in' % target_field_name: new_ids,
+            })
+            removed_ids = set()
+            for obj_id, date_removed in memberships.values_list(target_field_name,
+                                                                'date_removed'):
+                if date_removed is None:
+                    new_ids.discard(obj_id)
+                else:
+                    removed_ids.add(obj_id)
+
+            # don't send the signals for the duplicate rows of symmetrical
+            # relations
+            send_signals = self.reverse or source_field_name == self.source_field_name
+            if send_signals:
+                signals.m2m_changed.send(sender=self.through, action='pre_add',
+                                         instance=self.instance, reverse=self.reverse,
+                                         model=self.model, pk_set=new_ids, using=db)
+            if removed_ids:
+                memberships.filter(**{'%s__in' % target_field_name: removed_ids})\
+                    .update(date_removed=None)
+            self.through._default_manager.using(db).bulk_create([
+                self.through(**{
+                    '%s_id' % source_field_name: self._fk_val,
+                    '%s_id' % target_field_name: obj_id,
+                })
+                for obj_id in new_ids - removed_ids
+            ])
+            if send_signals:
+                signals.m2m_changed.send(sender=self.through, action='post_add',
+                                         instance=self.instance, reverse=self.reverse,
+                                         model=self.model, pk_set=new_ids, using=db)
+
+    return LogicalManyRelatedManager
+
+
+class LogicalManyRelatedObjectsDescriptor(ManyRelatedObjectsDescriptor):
+
+    @cached_property
+    def related_manager_cls(self):
+        return create_logical_many_related_manager(
+            self.related.model._default_manager.__class__,
+            self.related.field.rel
+        )
+
+
+class LogicalReverseManyRelatedObjectsDescriptor(ReverseManyRelatedObjectsDescriptor):
+
+    @cached_property
+    def related_manager_cls(self):
+        return create_logical_many_related_manager(
+            self.field.rel.to._default_manager.__class__,
+            self.field.rel
+        )
+
+
+class LogicalManyToManyField(models.ManyToManyField):
+    """
+    A ManyToManyField whose intermediary table has a date_removed column.
+    Removed relations (by ``remove()``, ``clear()`` or the deletion of an
+    object with the ``delete_batches`` option) are marked as removed, and
+    are restored when the object is undeleted.
+    """
+
+    def contribute_to_class(self, cls, name):
+        if not self.rel.through and not cls._meta.abstract:
+            self.set_attributes_from_name(name)
+            self.rel.through = create_logical_intermediary_model(self, cls)
+        super(LogicalManyToManyField, self).contribute_to_class(cls, name)
+        setattr(cls, self.name, LogicalReverseManyRelatedObjectsDescriptor(self))
+
+    def contribute_to_related_class(self, cls, related):
+        super(LogicalManyToManyField, self).contribute_to_related_class(cls, related)
+        if not self.rel.is_hidden():
+            setattr(cls, related.get_accessor_name(),
+                    LogicalManyRelatedObjectsDescriptor(related))
@@ -1,7 +1,9 @@
+from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.core.management.base import BaseCommand, CommandError
-from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
 from logicaldelete.base import logicaldelete_models_registry
+from logicaldelete.cleanup import Checkpoint, parse_timedelta, purge_databases
 
 from optparse import make_option
 
@@ -10,12 +12,42 @@ class Command(BaseCommand):
         make_option('--database', action='store', dest='database',
                     default=DEFAULT_DB_ALIAS, help='Nominates a specific database to cleanup '
                                                    'deleted from. Defaults to the "default" database.'),
+        make_option('--all-databases', action='store_true', dest='all_databases',
+                    default=False, help='Cleanup all databases at once, each model on '
+                    'the databases the router allows syncdb for.'),
+        make_option('--skip-database', action='append', dest='skip_databases', default=None,
+                    help='A database alias --all-databases leaves alone, like a read '
+                    'replica (use multiple --skip-database to skip several). Defaults to '
+                    'the LOGICALDELETE_CLEANUP_SKIP_DATABASES setting.'),
         make_option('-e', '--exclude', dest='exclude', action='append', default=[],
                     help='An appname or appname.ModelName to exclude (use multiple --exclude to exclude multiple apps/models).'),
         make_option('-a', '--all', action='store_true', dest='delete_all', default=False,
                     help="Cleanup all logical deleted items."),
         make_option('--noinput', action='store_false', dest='interactive', default=True,
                     help='Tells Django to NOT prompt the user for input of any kind.'),
+        make_option('--batch-size', action='store', type='int', dest='batch_size', default=1000,
+                    help='Number of items removed (and committed) at once. Defaults to 1000.'),
+        make_option('--sleep', action='store', type='float', dest='sleep', default=0,
+                    help='Seconds to sleep after each batch.'),
+        make_option('--max-rows-per-second', action='store', type='int',
+                    dest='max_rows_per_second', default=None,
+                    help='Limits the number of items removed per second.'),
+        make_option('--checkpoint', action='store', dest='checkpoint', default=None,
+                    help='File storing the progress of the cleanup, so an interrupted '
+                         'cleanup resumes where it stopped.'),
+        make_option('--older-than', action='store', dest='older_than', default=None,
+                    help='Cleanup only items deleted before the given period, like '
+                         '"3600" (seconds), "30m", "12h", "30d" or "2w".'),
+        make_option('-j', '--jobs', action='store', type='int', dest='jobs', default=1,
+                    help='Number of models cleaned up at once, each with its own '
+                         'database connection. Defaults to 1.'),
+        make_option('--coordinated', action='store_true', dest='coordinated', default=False,
+                    help='Claim the items to remove, so several cleanups can run at '
+                         'once (e.g. from cron on several hosts) without overlapping.'),
+        make_option('--lease-timeout', action='store', type='int', dest='lease_timeout',
+                    default=300, help='Seconds after which items claimed by a '
+                    '--coordinated cleanup that stopped are claimed again, on databases '
+                    'without SKIP LOCKED. Defaults to 300.'),
 
         )
     help = ("Remove already marked as deleted items (and all related) from database.")
@@ -29,6 +61,25 @@ class Command(BaseCommand):
         show_traceback = options.get('traceback')
         delete_all = options.get('delete_all')
         verbosity = options.get('verbosity')
+        batch_size = options.get('batch_size')
+        checkpoint = options.get('checkpoint')
+
+        jobs = options.get('jobs') or 1
+
+        if batch_size < 1:
+            raise CommandError('--batch-size must be a positive integer.')
+        if jobs < 1:
+            raise CommandError('--jobs must be a positive integer.')
+        coordinated = options.get('coordinated')
+        if coordinated and checkpoint:
+            raise CommandError('--checkpoint cannot be used with --coordinated.')
+        if checkpoint:
+            checkpoint = Checkpoint(checkpoint)
+        older_than = options.get('older_than')
+        if older_than is not None:
+            older_than = parse_timedelta(older_than)
+            if older_than is None:
+                raise CommandError('Invalid --older-than value: %s' % options['older_than'])
 
         excluded_apps = set()
         excluded_models = set()
@@ -94,17 +145,37 @@ Type 'yes' to continue, or 'no' to cancel: """)
         if confirm != 'yes':
             return
 
-        for model in model_list:
-            if model in excluded_models or \
-               model not in logicaldelete_models_registry:
-                continue
-
-            try:
-                if verbosity=='1':
-                    self.stdout.write("Handling model %s.%s\n" %
-                                      (model._meta.app_label, model._meta.object_name))
-                model._default_manager.only_deleted().using(using).remove()
-            except Exception, e:
-                if show_traceback:
-                    raise
-                raise CommandError("Unable to cleanup database: %s" % e)
+        model_list = [model for model in model_list
+                      if model not in excluded_models and
+                      model in logicaldelete_models_registry]
+        all_databases = options.get('all_databases')
+        if all_databases:
+            skipped = options.get('skip_databases')
+            if skipped is None:
+                skipped = getattr(settings, 'LOGICALDELETE_CLEANUP_SKIP_DATABASES', ())
+            databases = sorted(alias for alias in connections.databases
+                               if alias not in skipped)
+        else:
+            databases = [using]
+        try:
+            # a nominated database is cleaned up whatever the router says
+            results = purge_databases(model_list, databases, jobs=jobs, routed=all_databases,
+                                      batch_size=batch_size,
+                                      sleep=options.get('sleep'),
+                                      max_rows_per_second=options.get('max_rows_per_second'),
+                                      checkpoint=checkpoint, older_than=older_than,
+                                      coordinated=coordinated,
+                                      lease_timeout=options.get('lease_timeout'))
+        except Exception, e:
+            if show_traceback:
+                raise
+            raise CommandError("Unable to cleanup database: %s" % e)
+        if int(verbosity) >= 1:
+            for database in databases:
+                purged, seconds = results[database]
+                for model in model_list:
+                    if model in purged:
+                        self.stdout.write("Removed %d items of model %s.%s\n" % (
+                            purged[model], model._meta.app_label, model._meta.object_name))
+                self.stdout.write("Database %s: removed %d items in %.1f seconds\n" % (
+                    database, sum(purged.itervalues()), seconds))
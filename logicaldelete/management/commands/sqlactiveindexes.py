@@ -0,0 +1,35 @@
+from optparse import make_option
+
+from django.core.management.base import AppCommand
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import get_models
+from logicaldelete.base import logicaldelete_models_registry
+from logicaldelete.archive import is_archived
+from logicaldelete.schema import (sql_autoincrement, sql_create_archive,
+                                  sql_indexes_for_model)
+
+class Command(AppCommand):
+    help = ("Prints the CREATE INDEX SQL statements of the logical deletion indexes, "
+            "and the CREATE TABLE SQL statements of the archive tables (on SQLite "
+            "with the statements adding AUTOINCREMENT to the archived tables), for "
+            "the given app name(s).")
+
+    option_list = AppCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS, help='Nominates a database to print the '
+                'SQL for.  Defaults to the "default" database.'),
+
+    )
+
+    output_transaction = True
+
+    def handle_app(self, app, **options):
+        connection = connections[options.get('database')]
+        output = []
+        for model in get_models(app):
+            if model in logicaldelete_models_registry:
+                if is_archived(model):
+                    output.extend(sql_autoincrement(model, connection))
+                    output.extend(sql_create_archive(model, connection))
+                output.extend(sql_indexes_for_model(model, connection))
+        return u'\n'.join(output).encode('utf-8')
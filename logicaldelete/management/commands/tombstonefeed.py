@@ -0,0 +1,97 @@
+import json
+from optparse import make_option
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from logicaldelete.base import logicaldelete_models_registry
+from logicaldelete.cleanup import Checkpoint, model_key, parse_timedelta
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+                    default=DEFAULT_DB_ALIAS, help='Nominates a specific database to read '
+                                                   'deleted items from. Defaults to the "default" database.'),
+        make_option('-a', '--all', action='store_true', dest='all_models', default=False,
+                    help="Stream the deleted items of all logical deletion models."),
+        make_option('--state', action='store', dest='state', default=None,
+                    help='File storing the cursor of each model, so the next run '
+                         'streams only the items deleted since this one.'),
+        make_option('--cursor', action='store', dest='cursor', default=None,
+                    help='Cursor to start after, for a single model.'),
+        make_option('--overlap', action='store', dest='overlap', default=None,
+                    help='Stream again the items deleted in the given period before '
+                         'the cursor, like "60" (seconds), "5m" or "1h", to include '
+                         'deletions committed late.'),
+        make_option('--batch-size', action='store', type='int', dest='batch_size', default=1000,
+                    help='Number of items read at once. Defaults to 1000.'),
+        )
+    help = ("Streams the logically deleted items as JSON lines with the model, pk, "
+            "date_removed and cursor of each item, ordered by date_removed.")
+    args = '[appname appname.ModelName ...]'
+
+    def handle(self, *app_labels, **options):
+        from django.db.models import get_app, get_apps, get_model, get_models
+
+        using = options.get('database')
+        batch_size = options.get('batch_size')
+        state = options.get('state')
+
+        if batch_size < 1:
+            raise CommandError('--batch-size must be a positive integer.')
+        overlap = options.get('overlap')
+        if overlap is not None:
+            overlap = parse_timedelta(overlap)
+            if overlap is None:
+                raise CommandError('Invalid --overlap value: %s' % options['overlap'])
+
+        model_list = []
+        if not app_labels:
+            if not options.get('all_models'):
+                raise CommandError("Enter at least one appname or appname.ModelName.")
+            for app in get_apps():
+                model_list.extend(get_models(app))
+        for label in app_labels:
+            if '.' in label:
+                app_label, model_label = label.split('.', 1)
+                model = get_model(app_label, model_label)
+                if model is None:
+                    raise CommandError("Unknown model: %s" % label)
+                model_list.append(model)
+            else:
+                try:
+                    model_list.extend(get_models(get_app(label)))
+                except ImproperlyConfigured:
+                    raise CommandError("Unknown application: %s" % label)
+        model_list = [model for model in model_list
+                      if model in logicaldelete_models_registry]
+
+        if options.get('cursor') is not None and len(model_list) != 1:
+            raise CommandError('--cursor can only be used with a single model.')
+        if state:
+            state = Checkpoint(state)
+
+        for model in model_list:
+            key = model_key(model, using)
+            cursor = state.get(key) if state else options.get('cursor')
+            label = '%s.%s' % (model._meta.app_label, model._meta.object_name)
+            manager = model._default_manager.db_manager(using)
+            streamed = 0
+            last_cursor = None
+            try:
+                rows = manager.deleted_since(cursor, batch_size, overlap)
+                for pk, date_removed, last_cursor in rows:
+                    self.stdout.write(json.dumps({
+                        'model': label,
+                        'pk': pk,
+                        'date_removed': date_removed.isoformat(),
+                        'cursor': last_cursor,
+                    }, default=unicode) + '\n')
+                    streamed += 1
+                    if state and streamed % batch_size == 0:
+                        state.set(key, last_cursor)
+            except ValueError, e:
+                raise CommandError(str(e))
+            if state and last_cursor is not None:
+                state.set(key, last_cursor)
@@ -1,17 +1,45 @@
 # -*- coding: utf-8; -*-
 from django.db import models
+from django.db.models import Q
+from logicaldelete.archive import is_archived, to_model_instance
+from logicaldelete.cache import get_deleted_cache
+from logicaldelete.feed import decode_cursor, encode_cursor
 from logicaldelete.querysets import LogicalDeleteQuerySet
 
 
 class LogicalDeletedManager(models.Manager):
     use_for_related_fields = True
+    # the objects of get_query_set(): 'active', 'deleted' or 'everything',
+    # changed by prefetch_objects()
+    _objects = 'active'
 
     def get_query_set(self):
-        qs = super(LogicalDeletedManager, self).get_query_set().filter(date_removed__isnull=True)
+        qs = super(LogicalDeletedManager, self).get_query_set()
         qs.__class__ = LogicalDeleteQuerySet
-        return qs
+        if self._objects == 'everything':
+            return qs
+        return qs.filter(date_removed__isnull=self._objects == 'active')
+
+    def _prefetched(self, objects):
+        """
+        Returns the ``objects`` of a related manager cached by
+        prefetch_everything() or prefetch_deleted(), or None.
+        """
+        cache = getattr(getattr(self, 'instance', None), '_prefetched_objects_cache', None)
+        if not cache or not hasattr(self, 'get_prefetch_query_set'):
+            return None
+        cache_name = self.get_prefetch_query_set([self.instance])[4]
+        return cache.get((cache_name, objects))
 
     def everything(self):
+        """
+        Returns the active and the deleted objects. For models with archive
+        storage the deleted objects are in the archive table, so only the
+        active ones are returned, see ``archived()``.
+        """
+        prefetched = self._prefetched('everything')
+        if prefetched is not None:
+            return prefetched
         qs = super(LogicalDeletedManager, self).get_query_set()
         qs.__class__ = LogicalDeleteQuerySet
         # for related manager
@@ -20,14 +48,99 @@ class LogicalDeletedManager(models.Manager):
         return qs
 
     def only_deleted(self):
+        prefetched = self._prefetched('deleted')
+        if prefetched is not None:
+            return prefetched
+        if is_archived(self.model):
+            return self.archived()
         return self.everything().filter(date_removed__isnull=False)
 
+    def archived(self):
+        """
+        Returns the archived objects of a model with archive storage, as a
+        queryset of its archive model. The other querysets of the model,
+        including ``everything()``, only read the table of the model.
+        """
+        if not is_archived(self.model):
+            raise ValueError("%s has no archive storage." % self.model._meta.object_name)
+        qs = self.model._logicaldelete_archive._default_manager.using(self._db)
+        qs.source_model = self.model
+        # for related manager
+        return qs.filter(**getattr(self, 'core_filters', {}))
+
+    def prefetch_everything(self, *lookups):
+        return self.get_query_set().prefetch_everything(*lookups)
+
+    def prefetch_deleted(self, *lookups):
+        return self.get_query_set().prefetch_deleted(*lookups)
+
     def get(self, *args, **kwargs):
         ''' if a specific record was requested, return it even if it's deleted '''
+        if is_archived(self.model):
+            try:
+                return self.get_query_set().get(*args, **kwargs)
+            except self.model.DoesNotExist:
+                archive_model = self.model._logicaldelete_archive
+                try:
+                    archived = self.archived().get(*args, **kwargs)
+                except archive_model.DoesNotExist, e:
+                    raise self.model.DoesNotExist(*e.args)
+                return to_model_instance(self.model, archived)
         return self.everything().get(*args, **kwargs)
 
     def filter(self, *args, **kwargs):
-        ''' if pk was specified as a kwarg, return even if it's deleted '''
+        ''' if pk was specified as a kwarg, return even if it's deleted
+        (except archived objects, see everything()) '''
         if 'pk' in kwargs:
             return self.everything().filter(*args, **kwargs)
         return self.get_query_set().filter(*args, **kwargs)
+
+    def is_deleted(self, pk):
+        """
+        Returns True if the object with the primary key ``pk`` is marked as
+        deleted. For models with the cache_deleted option most checks of
+        objects that are not deleted need no query, see logicaldelete.cache.
+        """
+        if self.model._logicaldelete_meta.cache_deleted:
+            return get_deleted_cache(self.model, self.db).is_deleted(pk)
+        return self.only_deleted().filter(pk=pk).exists()
+
+    def deleted_since(self, cursor=None, batch_size=1000, overlap=None):
+        """
+        Yields a (pk, date_removed, cursor) tuple for each deleted object,
+        ordered by date_removed and primary key, starting after the object
+        of ``cursor`` (a cursor token yielded before) or at the first one.
+
+        Objects are read in batches of ``batch_size`` with keyset
+        pagination on (date_removed, pk), so memory use does not depend on
+        the number of deleted objects. See the index_date_removed option.
+
+        A deletion committed after later ones were read is behind the
+        cursor. With ``overlap`` (a timedelta) the objects deleted up to
+        ``overlap`` before ``cursor`` are read again, so those are yielded
+        too, along with the objects of that window yielded before; the
+        cursor of these objects is ``cursor`` itself.
+        """
+        queryset = self.only_deleted()
+        after = decode_cursor(cursor) if cursor is not None else None
+        start = after
+        if after is not None and overlap:
+            queryset = queryset.filter(date_removed__gte=after[0] - overlap)
+            after = None
+        while True:
+            batch = queryset
+            if after is not None:
+                date_removed, pk = after
+                batch = batch.filter(Q(date_removed__gt=date_removed) |
+                                     Q(date_removed=date_removed, pk__gt=pk))
+            rows = list(batch.order_by('date_removed', 'pk')
+                        .values_list('pk', 'date_removed')[:batch_size])
+            if not rows:
+                return
+            for pk, date_removed in rows:
+                if start is not None and (date_removed, pk) <= start:
+                    # re-read by the overlap, the cursor does not go back
+                    yield pk, date_removed, cursor
+                else:
+                    yield pk, date_removed, encode_cursor(date_removed, pk)
+            after = rows[-1][1], rows[-1][0]
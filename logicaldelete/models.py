@@ -5,6 +5,8 @@ from django.utils.timezone import now
 from deletion import LogicalDeleteCollector
 from base import LogicalDeleteModelBase
 from logicaldelete import managers
+# connects the post_syncdb handler creating logical deletion indexes
+from logicaldelete import schema
 
 
 class LogicalDeleteModel(models.Model):
@@ -28,8 +30,8 @@ class LogicalDeleteModel(models.Model):
 
     delete.alters_data = True
 
-    def undelete(self):
-        self.__class__.objects.filter(pk=self.pk).undelete()
+    def undelete(self, cascade=False):
+        self.__class__.objects.only_deleted().filter(pk=self.pk).undelete(cascade=cascade)
 
     class Meta:
         abstract = True
@@ -43,11 +45,18 @@ class AuditModel(models.Model):
         abstract = True
 
     def save(self, *args, **kwargs):
-        if not self.date_created:
-            self.date_created = now()
-        self.date_modified = now()
+        self.stamp(now())
         super(AuditModel, self).save(*args, **kwargs)
 
+    def stamp(self, timestamp):
+        """
+        Sets date_modified, and date_created if it is not set, to
+        ``timestamp``.
+        """
+        if not self.date_created:
+            self.date_created = timestamp
+        self.date_modified = timestamp
+
 
 class Model(LogicalDeleteModel, AuditModel):
     """
@@ -56,3 +65,20 @@ class Model(LogicalDeleteModel, AuditModel):
     """
     class Meta:
         abstract = True
+
+
+class CleanupLease(models.Model):
+    """
+    A claim on a chunk of logically deleted objects by a coordinated
+    cleanup, on databases without SELECT ... FOR UPDATE SKIP LOCKED.
+    """
+    resource = models.CharField(max_length=255)
+    bucket = models.BigIntegerField()
+    owner = models.CharField(max_length=32)
+    expires = models.DateTimeField()
+
+    class Meta:
+        unique_together = (('resource', 'bucket'),)
+
+    def __unicode__(self):
+        return u'%s #%d' % (self.resource, self.bucket)
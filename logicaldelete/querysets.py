@@ -1,6 +1,77 @@
 # -*- coding: utf-8; -*-
-from django.db.models import query
-from logicaldelete.deletion import LogicalDeleteCollector
+import logging
+from uuid import uuid4
+
+from django.db import router, transaction
+from django.db.models import F, query
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE
+from django.utils.timezone import now
+from logicaldelete.archive import is_archived
+from logicaldelete.base import logicaldelete_models_registry
+from logicaldelete.cache import objects_undeleted
+from logicaldelete.fields import is_logical_through
+from logicaldelete.deletion import (LogicalDeleteCollector, batch_signal_senders,
+                                    has_batch_listeners, has_listeners, send_batch_signal)
+from logicaldelete.signals import pre_undelete_batch, post_undelete_batch
+
+logger = logging.getLogger('logicaldelete')
+
+
+def undelete_operations(operations, using):
+    """
+    Marks as not deleted the objects of every model with the
+    track_operations option that were deleted by the deletion operations
+    in ``operations``, with one UPDATE (or move from the archive table) per
+    model.
+    """
+    for model in logicaldelete_models_registry:
+        if (not model._logicaldelete_meta.track_operations or
+                not router.allow_syncdb(using, model)):
+            continue
+        if is_archived(model):
+            model._default_manager.only_deleted().using(using)\
+                .filter(deletion_op__in=operations).undelete()
+        else:
+            model._default_manager.everything().using(using)\
+                .filter(deletion_op__in=operations)\
+                ._undelete(date_removed=None, deletion_op=None)
+
+
+def prefetch_objects(instances, lookup, objects):
+    """
+    Fetches the objects of the related manager ``lookup`` of all the
+    ``instances`` with one query, all of them for ``objects='everything'``
+    or the deleted ones for ``objects='deleted'``, and caches them on each
+    instance for the ``everything()`` or ``only_deleted()`` methods of its
+    related manager.
+    """
+    instances = [obj for obj in instances if obj is not None]
+    if not instances:
+        return
+    manager = getattr(instances[0], lookup, None)
+    if not (hasattr(manager, 'get_prefetch_query_set') and hasattr(manager, 'everything')):
+        raise ValueError("'%s' is not a related manager of logical deletion objects "
+                         "on %s." % (lookup, instances[0].__class__.__name__))
+    if is_archived(manager.model):
+        raise ValueError("Deleted objects of %s are archived and cannot be "
+                         "prefetched." % manager.model._meta.object_name)
+    manager._objects = objects
+    qs, rel_obj_attr, instance_attr, single, cache_name = \
+        manager.get_prefetch_query_set(instances)
+    related = {}
+    for rel_obj in qs:
+        related.setdefault(rel_obj_attr(rel_obj), []).append(rel_obj)
+    for obj in instances:
+        manager = getattr(obj, lookup)
+        if objects == 'everything':
+            qs = manager.everything()
+        else:
+            qs = manager.only_deleted()
+        qs._result_cache = related.get(instance_attr(obj), [])
+        qs._prefetch_done = True
+        if not hasattr(obj, '_prefetched_objects_cache'):
+            obj._prefetched_objects_cache = {}
+        obj._prefetched_objects_cache[cache_name, objects] = qs
 
 
 class LogicalDeleteQuerySet(query.QuerySet):
@@ -10,9 +81,48 @@ class LogicalDeleteQuerySet(query.QuerySet):
         qs.__class__ = LogicalDeleteQuerySet
         return qs
 
-    def delete(self):
+    def bulk_create(self, objs, batch_size=None):
+        """
+        Like ``QuerySet.bulk_create()``, setting the date_created and
+        date_modified fields of AuditModel objects with a single timestamp.
+        """
+        from logicaldelete.models import AuditModel
+
+        if issubclass(self.model, AuditModel):
+            timestamp = now()
+            for obj in objs:
+                obj.stamp(timestamp)
+        return super(LogicalDeleteQuerySet, self).bulk_create(objs, batch_size=batch_size)
+
+    def update(self, **kwargs):
+        """
+        Like ``QuerySet.update()``, setting date_modified of AuditModel
+        objects unless it is given.
+        """
+        from logicaldelete.models import AuditModel
+
+        if issubclass(self.model, AuditModel):
+            kwargs.setdefault('date_modified', now())
+        return super(LogicalDeleteQuerySet, self).update(**kwargs)
+
+    update.alters_data = True
+
+    def delete(self, chunk_size=None, single_transaction=False):
         """
         Mark as deleted the records in the current QuerySet.
+
+        When nothing but the records themselves is affected the records are
+        marked with a single UPDATE. When the related records can be
+        selected with subqueries, they are handled with one statement per
+        relation (see ``LogicalDeleteCollector.cascade_update``). Otherwise
+        they are collected with ``LogicalDeleteCollector``.
+
+        If ``chunk_size`` is given the records are collected and deleted in
+        chunks of that size instead of all at once, see
+        ``_delete_in_chunks``.
+
+        Returns the name of the path taken: ``'update'``, ``'cascade'``,
+        ``'collect'`` or ``'stream'``.
         """
         assert self.query.can_filter(),\
         "Cannot use 'limit' or 'offset' with delete."
@@ -30,14 +140,94 @@ class LogicalDeleteQuerySet(query.QuerySet):
         del_query.query.clear_ordering()
 
         collector = LogicalDeleteCollector(using=del_query.db)
-        collector.collect(del_query)
-        collector.delete()
+        if collector.can_fast_update(del_query):
+            path = 'update'
+            collector.fast_update(del_query)
+        elif not chunk_size and collector.can_cascade_update(del_query):
+            path = 'cascade'
+            collector.cascade_update(del_query)
+        elif chunk_size:
+            path = 'stream'
+            self._delete_in_chunks(del_query, chunk_size, single_transaction)
+        else:
+            path = 'collect'
+            collector.collect(collector.only_collected_fields(del_query))
+            collector.delete()
+        logger.debug("Deleted %s objects using the '%s' path.",
+                     self.model._meta.object_name, path)
 
         # Clear the result cache, in case this QuerySet gets reused.
         self._result_cache = None
+        return path
 
     delete.alters_data = True
 
+    def delete_impact(self, max_depth=10):
+        """
+        Returns the number of objects ``delete()`` would mark as deleted
+        and delete ordinary, per model, counted with COUNT statements only.
+        See ``LogicalDeleteCollector.estimate``.
+        """
+        assert self.query.can_filter(),\
+        "Cannot use 'limit' or 'offset' with delete."
+
+        del_query = self._clone()
+        del_query._for_write = True
+        del_query.query.clear_ordering()
+        return LogicalDeleteCollector(using=del_query.db).estimate(del_query, max_depth)
+
+    def _delete_in_chunks(self, del_query, chunk_size, single_transaction):
+        """
+        Collects and deletes the records of ``del_query`` in chunks of
+        ``chunk_size`` records, read in primary key order with keyset
+        pagination, so only one chunk and its related objects are in memory
+        at a time.
+
+        Each chunk is deleted in its own savepoint and committed, unless
+        ``single_transaction`` is True or the transaction is managed by the
+        caller. All chunks share the same deletion time and operation ID.
+        """
+        using = del_query.db
+        date_removed = now()
+        operation_id = uuid4().hex
+        forced_managed = not transaction.is_managed(using=using)
+        if forced_managed:
+            transaction.enter_transaction_management(using=using)
+            transaction.managed(True, using=using)
+        try:
+            last_pk = None
+            while True:
+                chunk = del_query
+                if last_pk is not None:
+                    chunk = chunk.filter(pk__gt=last_pk)
+                collector = LogicalDeleteCollector(using=using,
+                    date_removed=date_removed, operation_id=operation_id)
+                chunk = collector.only_collected_fields(chunk.order_by('pk'))
+                objs = list(chunk[:chunk_size])
+                if not objs:
+                    break
+                last_pk = objs[-1].pk
+                sid = transaction.savepoint(using=using)
+                try:
+                    collector.collect(objs)
+                    collector.delete()
+                except:
+                    transaction.savepoint_rollback(sid, using=using)
+                    raise
+                transaction.savepoint_commit(sid, using=using)
+                del objs, collector
+                if forced_managed and not single_transaction:
+                    transaction.commit(using=using)
+            if forced_managed:
+                transaction.commit(using=using)
+        except:
+            if forced_managed:
+                transaction.rollback(using=using)
+            raise
+        finally:
+            if forced_managed:
+                transaction.leave_transaction_management(using=using)
+
     def remove(self):
         """
         Deletes the records in the current QuerySet.
@@ -49,7 +239,95 @@ class LogicalDeleteQuerySet(query.QuerySet):
     def only_deleted(self):
         return self.filter(date_removed__isnull=False)
 
-    def undelete(self, using='default', *args, **kwargs):
-        self.update(date_removed=None)
+    def prefetch_everything(self, *lookups):
+        """
+        Like ``prefetch_related()`` for the related managers ``lookups`` of
+        the records, fetching their deleted objects too: then
+        ``everything()`` on these related managers does not query the
+        database. Each lookup takes a single query for all the records.
+        """
+        return self._prefetch_objects('everything', lookups)
+
+    def prefetch_deleted(self, *lookups):
+        """
+        Like ``prefetch_everything()``, for ``only_deleted()``.
+        """
+        return self._prefetch_objects('deleted', lookups)
+
+    def _prefetch_objects(self, objects, lookups):
+        clone = self._clone()
+        clone._prefetch_related_lookups.extend((objects, lookup) for lookup in lookups)
+        return clone
+
+    def _prefetch_related_objects(self):
+        # the lookups of prefetch_everything() and prefetch_deleted() are tuples
+        lookups = self._prefetch_related_lookups
+        query.prefetch_related_objects(self._result_cache,
+                                       [l for l in lookups if not isinstance(l, tuple)])
+        for lookup in lookups:
+            if isinstance(lookup, tuple):
+                prefetch_objects(self._result_cache, lookup[1], lookup[0])
+        self._prefetch_done = True
+
+    def undelete(self, using='default', cascade=False, *args, **kwargs):
+        """
+        Mark as not deleted the records in the current QuerySet.
+
+        With ``cascade=True`` all the objects marked as deleted by the same
+        deletion operations as these records are restored too, with one
+        UPDATE per model. Objects are matched by the operation ID stamped on
+        them, so only models with the track_operations option take part.
+        """
+        if not self.model._logicaldelete_meta.track_operations:
+            if cascade:
+                raise ValueError("Cascading undelete requires the track_operations "
+                                 "option of %s." % self.model._meta.object_name)
+            self._undelete(date_removed=None)
+            return
+
+        operations = []
+        if cascade:
+            operations = list(self.only_deleted().exclude(deletion_op=None)
+                              .values_list('deletion_op', flat=True).distinct())
+        self._undelete(date_removed=None, deletion_op=None)
+        if operations:
+            undelete_operations(operations, self.db)
 
     undelete.alters_data = True
+
+    def _undelete(self, **values):
+        """
+        Updates the records with ``values``, sending pre_undelete_batch and
+        post_undelete_batch if they have receivers.
+        """
+        model = self.model._meta.concrete_model
+        senders = batch_signal_senders(self.model)
+        self._restore_memberships()
+        if not (has_batch_listeners(pre_undelete_batch, senders) or
+                has_batch_listeners(post_undelete_batch, senders)):
+            query.QuerySet.update(self, **values)
+            objects_undeleted(model, self.db)
+            return
+        pk_list = list(self.only_deleted().values_list('pk', flat=True))
+        if not pk_list:
+            return
+        send_batch_signal(pre_undelete_batch, senders, pk_list=pk_list, using=self.db)
+        for i in range(0, len(pk_list), GET_ITERATOR_CHUNK_SIZE):
+            query.QuerySet.update(self.filter(pk__in=pk_list[i:i + GET_ITERATOR_CHUNK_SIZE]),
+                                  **values)
+        objects_undeleted(model, self.db)
+        send_batch_signal(post_undelete_batch, senders, pk_list=pk_list, using=self.db)
+
+    def _restore_memberships(self):
+        """
+        Restores the relations of LogicalManyToManyField removed together
+        with the deleted records, i.e. marked with the same date_removed.
+        """
+        for related in self.model._meta.get_all_related_objects(include_hidden=True):
+            if not is_logical_through(related.model):
+                continue
+            name = related.field.name
+            related.model._base_manager.using(self.db).filter(**{
+                '%s__in' % name: self.only_deleted().values('pk'),
+                'date_removed': F('%s__date_removed' % name),
+            }).update(date_removed=None)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8; -*-
+from django.core.management.color import no_style
+from django.db import connections, models, transaction
+from django.db.backends.util import truncate_name
+from django.db.models import get_models, signals
+
+from logicaldelete.archive import is_archived
+from logicaldelete.base import logicaldelete_models_registry
+
+
+def supports_partial_indexes(connection):
+    """
+    Returns True if the database of ``connection`` supports indexes with a
+    WHERE clause.
+    """
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        from django.db.backends.sqlite3.base import Database
+        return Database.sqlite_version_info >= (3, 8, 0)
+    return False
+
+
+def estimated_count(model, using):
+    """
+    Returns the number of rows of the table of ``model`` estimated by the
+    database from its statistics (pg_class.reltuples on PostgreSQL,
+    sqlite_stat1 on SQLite, filled by ANALYZE), or None if there is no
+    estimate.
+    """
+    connection = connections[using]
+    cursor = connection.cursor()
+    table = model._meta.db_table
+    if connection.vendor == 'postgresql':
+        cursor.execute("SELECT reltuples FROM pg_class WHERE oid = %s::regclass",
+                       [connection.ops.quote_name(table)])
+    elif connection.vendor == 'sqlite':
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+        if cursor.fetchone() is None:
+            return None
+        # the first number of each row is the number of rows of the table
+        cursor.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = %s", [table])
+    else:
+        return None
+    row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return None
+    count = int(str(row[0]).split()[0].split('.')[0])
+    # reltuples is -1 on PostgreSQL 14+ for tables never analyzed
+    return count if count >= 0 else None
+
+
+def sql_indexes_for_model(model, connection):
+    """
+    Returns the CREATE INDEX statements for the ``active_indexes`` and
+    ``index_date_removed`` options of ``model``. The date_removed index also
+    covers the primary key.
+
+    Indexes listed in ``active_indexes`` cover active objects only (WHERE
+    date_removed IS NULL) on databases that support partial indexes, and
+    get date_removed as last column elsewhere.
+    """
+    logicaldelete_meta = model._logicaldelete_meta
+    opts = model._meta
+    qn = connection.ops.quote_name
+    max_name_length = connection.ops.max_name_length()
+    date_removed = opts.get_field('date_removed').column
+    partial = supports_partial_indexes(connection)
+    output = []
+    for fields in logicaldelete_meta.active_indexes:
+        if isinstance(fields, basestring):
+            fields = (fields,)
+        columns = [opts.get_field(name).column for name in fields]
+        name = truncate_name('%s_%s_active' % (opts.db_table, '_'.join(columns)),
+                             max_name_length)
+        if partial:
+            where = ' WHERE %s IS NULL' % qn(date_removed)
+        else:
+            columns.append(date_removed)
+            where = ''
+        output.append('CREATE INDEX %s ON %s (%s)%s;' % (
+            qn(name), qn(opts.db_table), ', '.join(qn(c) for c in columns), where))
+    if logicaldelete_meta.index_date_removed:
+        # the primary key makes it usable by deleted_since()
+        name = truncate_name('%s_%s' % (opts.db_table, date_removed), max_name_length)
+        output.append('CREATE INDEX %s ON %s (%s, %s);' % (
+            qn(name), qn(opts.db_table), qn(date_removed), qn(opts.pk.column)))
+    return output
+
+
+def sql_autoincrement(model, connection, indexes=True):
+    """
+    Returns the statements rebuilding the table of ``model`` with an
+    AUTOINCREMENT primary key on SQLite, followed by the indexes Django
+    creates for it unless ``indexes`` is False. Without AUTOINCREMENT SQLite
+    gives the largest primary key again once its row is gone, e.g. moved to
+    the archive table. Returns an empty list on the other databases or if
+    the primary key is not an AutoField.
+    """
+    opts = model._meta
+    if connection.vendor != 'sqlite' or not isinstance(opts.pk, models.AutoField):
+        return []
+    qn = connection.ops.quote_name
+    style = no_style()
+    # with the referenced models known, the REFERENCES clauses are kept
+    known_models = set(f.rel.to for f in opts.local_fields if f.rel is not None)
+    output, references = connection.creation.sql_create_model(model, style, known_models)
+    table, new_table = opts.db_table, '%s__new' % opts.db_table
+    pk_definition = '%s integer NOT NULL PRIMARY KEY' % qn(opts.pk.column)
+    create = output[0].replace('CREATE TABLE %s ' % qn(table),
+                               'CREATE TABLE %s ' % qn(new_table), 1)
+    create = create.replace(pk_definition, pk_definition + ' AUTOINCREMENT', 1)
+    columns = ', '.join(qn(f.column) for f in opts.local_fields)
+    output = [
+        create,
+        'INSERT INTO %s (%s) SELECT %s FROM %s;' % (qn(new_table), columns, columns, qn(table)),
+        'DROP TABLE %s;' % qn(table),
+        'ALTER TABLE %s RENAME TO %s;' % (qn(new_table), qn(table)),
+    ]
+    if indexes:
+        output.extend(connection.creation.sql_indexes_for_model(model, style))
+    return output
+
+
+def sql_create_archive(model, connection):
+    """
+    Returns the CREATE TABLE and CREATE INDEX statements for the archive
+    table of ``model``.
+    """
+    archive_opts = model._logicaldelete_archive._meta
+    style = no_style()
+    # the archive model is unmanaged, so syncdb leaves it alone
+    archive_opts.managed = True
+    try:
+        output, references = connection.creation.sql_create_model(
+            model._logicaldelete_archive, style, set())
+        output.extend(connection.creation.sql_indexes_for_model(
+            model._logicaldelete_archive, style))
+    finally:
+        archive_opts.managed = False
+    return output
+
+
+def create_indexes(sender, app, created_models, verbosity, db, **kwargs):
+    """
+    Creates the logical deletion indexes of the models created by syncdb,
+    and the archive tables of the models with archive storage.
+    """
+    connection = connections[db]
+    cursor = connection.cursor()
+    for model in get_models(app):
+        if model not in created_models or model not in logicaldelete_models_registry:
+            continue
+        statements = sql_indexes_for_model(model, connection)
+        if is_archived(model):
+            if verbosity >= 1:
+                print "Creating archive table %s" % (
+                    model._logicaldelete_archive._meta.db_table)
+            # the table is new and empty, syncdb creates its indexes next
+            statements = (sql_autoincrement(model, connection, indexes=False) +
+                          sql_create_archive(model, connection) + statements)
+        if statements and verbosity >= 2:
+            print "Creating logical deletion indexes for %s.%s model" % (
+                model._meta.app_label, model._meta.object_name)
+        for statement in statements:
+            cursor.execute(statement)
+    transaction.commit_unless_managed(using=db)
+
+signals.post_syncdb.connect(create_indexes,
+                            dispatch_uid='logicaldelete.schema.create_indexes')
@@ -0,0 +1,15 @@
+# -*- coding: utf-8; -*-
+from django.dispatch import Signal
+
+# Sent once per model around the UPDATE marking objects as deleted, the
+# sender is the model class.
+pre_logical_delete_batch = Signal(providing_args=["pk_list", "date_removed", "using"])
+post_logical_delete_batch = Signal(providing_args=["pk_list", "date_removed", "using"])
+
+# Sent once per model around the UPDATE marking objects as not deleted.
+pre_undelete_batch = Signal(providing_args=["pk_list", "using"])
+post_undelete_batch = Signal(providing_args=["pk_list", "using"])
+
+# Sent by LogicalDeleteCollector when a deletion is done, with its
+# CollectorStats, the sender is the collector class.
+collector_stats = Signal(providing_args=["stats", "using"])
@@ -0,0 +1,75 @@
+# -*- coding: utf-8; -*-
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+
+class CollectorStats(object):
+    """
+    Statistics of a deletion by LogicalDeleteCollector: the time spent in
+    each phase (seconds), the number of affected objects per model and
+    delete method, and the number of SQL statements issued.
+
+    Statements are only counted when ``count_queries`` is True, by turning
+    on the debug cursor of the connection during each phase.
+    """
+
+    def __init__(self, using, count_queries=False):
+        self.using = using
+        self.count_queries = count_queries
+        self.timings = {}
+        # {'app_label.ObjectName': {'logical': n, 'kept': n, 'deleted': n}}
+        self.counts = {}
+        self.queries = 0
+        self.depth = 0
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Adds the time spent in the with block to the phase ``name``. Phases
+        nested in another phase (like the recursive collection of related
+        objects) are counted in the outer phase only.
+        """
+        self.depth += 1
+        try:
+            if self.depth > 1:
+                yield
+                return
+            connection = connections[self.using]
+            if self.count_queries:
+                use_debug_cursor = connection.use_debug_cursor
+                connection.use_debug_cursor = True
+                queries = len(connection.queries)
+            started = time.time()
+            try:
+                yield
+            finally:
+                self.timings[name] = self.timings.get(name, 0) + time.time() - started
+                if self.count_queries:
+                    self.queries += len(connection.queries) - queries
+                    if not (use_debug_cursor or settings.DEBUG):
+                        # forget the statements logged only to be counted
+                        del connection.queries[queries:]
+                    connection.use_debug_cursor = use_debug_cursor
+        finally:
+            self.depth -= 1
+
+    def add_count(self, model, method, count):
+        if not count:
+            return
+        label = '%s.%s' % (model._meta.app_label, model._meta.object_name)
+        counts = self.counts.setdefault(label, {})
+        counts[method] = counts.get(method, 0) + count
+
+    def as_dict(self):
+        return {
+            'timings': dict(self.timings),
+            'counts': dict((label, dict(counts))
+                           for label, counts in self.counts.iteritems()),
+            'queries': self.queries if self.count_queries else None,
+        }
+
+    def __repr__(self):
+        return '<CollectorStats: %r>' % self.as_dict()
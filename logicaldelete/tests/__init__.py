@@ -1,9 +1,67 @@
 # -*- coding: utf-8; -*-
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+
 from django.conf import settings
+from django.contrib import admin
+from django.contrib.admin.models import LogEntry
+from django.contrib.auth.models import User
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from django.core.management import call_command
-from django.db.models import loading
+from django.db import connection, connections, reset_queries, router, transaction, IntegrityError
+from django.db.models import loading, signals
 from django import test
-from models.models import TestModel, RelatedModel, Related2Model, RelatedMany
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils.timezone import now
+from logicaldelete import admin as logicaldelete_admin
+from logicaldelete.admin import (ActiveListFilter, EstimatedCountPaginator, ModelAdmin,
+                                 active_counts, register_archive_admin)
+from logicaldelete.archive import check_archive_storage
+from logicaldelete.cache import (BloomFilter, DeletedCache, DjangoCacheBackend,
+                                 LocalMemoryBackend, LRUCache, set_backend)
+from logicaldelete.base import LogicalDeleteOptions, logicaldelete_models_registry
+from logicaldelete import cleanup as logicaldelete_cleanup
+from logicaldelete.cleanup import (Checkpoint, claim_lease, conflicting_models,
+                                   dependency_graph, model_key,
+                                   model_sort_key, purge, purge_databases, release_lease,
+                                   run_in_order, supports_skip_locked)
+from logicaldelete.models import CleanupLease
+from logicaldelete.deletion import LogicalDeleteCollector
+from logicaldelete import schema
+from logicaldelete.schema import (estimated_count, sql_indexes_for_model,
+                                  supports_partial_indexes)
+from logicaldelete.signals import (pre_logical_delete_batch, post_logical_delete_batch,
+                                   pre_undelete_batch, post_undelete_batch, collector_stats)
+from models.models import TestModel, RelatedModel, Related2Model, RelatedMany, ArchivedModel
+from models.models import ProxyArchivedModel, ProxyRelated2Model
+from models.models import (CascadeModel, CascadeChildModel, CascadePlainModel,
+                           CascadeGrandchildModel, LogicalManyModel, TaggedItem, TaggedModel)
+
+
+class mock_attr(object):
+    """
+    Replaces the attribute ``name`` of ``obj`` with ``value`` in a with block.
+    """
+
+    def __init__(self, obj, name, value):
+        self.obj, self.name, self.value = obj, name, value
+
+    def __enter__(self):
+        self.original = getattr(self.obj, self.name)
+        setattr(self.obj, self.name, self.value)
+
+    def __exit__(self, *exc_info):
+        setattr(self.obj, self.name, self.original)
 
 
 class TestCase(test.TestCase):
@@ -141,3 +199,1468 @@ class DeleteBatchesTestCase(TestCase):
 
         self.assertEqual(RelatedMany.objects.get(pk=1).related.everything().count(), 0,
                          "Batches NOT deleted when delete_batches=True")
+
+
+class QuerySetDeleteTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+    fixtures = ['delete_related.json']
+
+    def test_fast_path(self):
+        """
+        Objects without related objects to handle are marked with one UPDATE.
+        """
+        self.assertEqual(Related2Model.objects.filter(pk=1).delete(), 'update')
+        self.assertTrue(Related2Model.objects.only_deleted().filter(pk=1).exists(),
+                        "Object not deleted logicaly")
+
+    def test_fast_path_skipped_for_receivers(self):
+        """
+        Objects are collected when delete signals have receivers.
+        """
+        def receiver(sender, **kwargs):
+            pass
+        signals.pre_delete.connect(receiver, sender=Related2Model)
+        try:
+            self.assertEqual(Related2Model.objects.filter(pk=1).delete(), 'collect')
+        finally:
+            signals.pre_delete.disconnect(receiver, sender=Related2Model)
+        self.assertTrue(Related2Model.objects.only_deleted().filter(pk=1).exists(),
+                        "Object not deleted logicaly")
+
+    def test_collect_path_for_related(self):
+        """
+        Objects with cascading relations are collected.
+        """
+        TestModel._logicaldelete_meta.delete_related = True
+        TestModel._logicaldelete_meta.safe_deletion = True
+        self.assertEqual(TestModel.objects.filter(pk=1).delete(), 'collect')
+        self.assertTrue(Related2Model.objects.only_deleted().filter(pk=1).exists(),
+                        "Not delete related logicaldelete model")
+
+
+class CollectorEdgesTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+
+    def _count_delete_queries(self, children):
+        instance = TestModel.objects.create(text="parent")
+        for i in range(children):
+            Related2Model.objects.create(text="child", related2=instance)
+        instance = TestModel.objects.get(pk=instance.pk)
+        reset_queries()
+        instance.delete()
+        return len(connection.queries)
+
+    def test_no_parent_fetch_per_object(self):
+        """
+        Edges are built from loaded foreign key values, so the number of
+        queries does not depend on the number of related objects.
+        """
+        TestModel._logicaldelete_meta.delete_related = True
+        TestModel._logicaldelete_meta.safe_deletion = True
+        self.assertEqual(self._count_delete_queries(1),
+                         self._count_delete_queries(5))
+        self.assertEqual(Related2Model.objects.only_deleted().count(), 6)
+
+
+def recursive_delete_methods(edges):
+    """
+    The recursive implementation of
+    ``LogicalDeleteCollector.determine_object_delete_method``, used as
+    reference for the iterative one.
+    """
+    objs_for_delete = {}
+
+    def determine(node, seen, safe_deletion=LogicalDeleteOptions.safe_deletion,
+                  delete_related=LogicalDeleteOptions.delete_related,
+                  was_plain_object=False):
+        if node in seen:
+            return
+        seen.add(node)
+        model = node[0]
+        child_safe_deletion = safe_deletion
+        if hasattr(model, '_logicaldelete_meta'):
+            delete_related = model._logicaldelete_meta.delete_related
+            child_safe_deletion = model._logicaldelete_meta.safe_deletion
+        else:
+            was_plain_object = True
+
+        if delete_related:
+            for child in edges.get(node, ()):
+                determine(child, seen, child_safe_deletion, delete_related,
+                          was_plain_object)
+
+        if hasattr(model, '_logicaldelete_meta') and not was_plain_object:
+            objs_for_delete[node] = True
+        else:
+            objs_for_delete[node] = safe_deletion
+
+    seen = set()
+    for root in edges.get(None, ()):
+        determine(root, seen)
+    return objs_for_delete
+
+
+class DetermineDeleteMethodTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+    models = (TestModel, RelatedModel, Related2Model, RelatedMany)
+    logical_models = (TestModel, Related2Model)
+
+    def setUp(self):
+        self._options = [(model, model._logicaldelete_meta.delete_related,
+                          model._logicaldelete_meta.safe_deletion)
+                         for model in self.logical_models]
+
+    def tearDown(self):
+        for model, delete_related, safe_deletion in self._options:
+            model._logicaldelete_meta.delete_related = delete_related
+            model._logicaldelete_meta.safe_deletion = safe_deletion
+
+    def _random_edges(self, rnd, size):
+        nodes = [(rnd.choice(self.models), pk) for pk in range(size)]
+        edges = {None: rnd.sample(nodes, rnd.randint(1, min(size, 3)))}
+        for i in range(size * 2):
+            edges.setdefault(rnd.choice(nodes), []).append(rnd.choice(nodes))
+        return edges
+
+    def _delete_methods(self, edges):
+        collector = LogicalDeleteCollector(using='default')
+        collector.edges = edges
+        collector.determine_object_delete_method()
+        methods = {}
+        for logical, pks_for_model in ((True, collector.logical_pks),
+                                       (False, collector.delete_pks)):
+            for model, pks in pks_for_model.iteritems():
+                for pk in pks:
+                    methods[(model, pk)] = logical
+        return methods
+
+    def test_same_as_recursive(self):
+        """
+        The iterative walk gives the same results as the recursive one.
+        """
+        rnd = random.Random(0)
+        for i in range(300):
+            for model in self.logical_models:
+                model._logicaldelete_meta.delete_related = rnd.random() < 0.7
+                model._logicaldelete_meta.safe_deletion = rnd.random() < 0.5
+            edges = self._random_edges(rnd, rnd.randint(1, 40))
+            self.assertEqual(self._delete_methods(edges),
+                             recursive_delete_methods(edges))
+
+    def test_deep_graph(self):
+        """
+        Deep graphs do not hit the recursion limit.
+        """
+        TestModel._logicaldelete_meta.delete_related = True
+        depth = sys.getrecursionlimit() * 2
+        edges = {None: [(TestModel, 0)]}
+        for pk in range(depth):
+            edges[(TestModel, pk)] = [(TestModel, pk + 1)]
+        self.assertEqual(len(self._delete_methods(edges)), depth + 1)
+
+
+class CleanupDeletedTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+
+    def setUp(self):
+        for i in range(5):
+            Related2Model.objects.create(text="deleted")
+        Related2Model.objects.create(text="active")
+        Related2Model.objects.filter(text="deleted").delete()
+        self.checkpoint_path = tempfile.mktemp()
+
+    def tearDown(self):
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def test_cleanup_in_batches(self):
+        call_command('cleanupdeleted', 'models.Related2Model', interactive=False,
+                     verbosity=0, batch_size=2, checkpoint=self.checkpoint_path)
+        self.assertEqual(Related2Model.objects.everything().count(), 1)
+        self.assertEqual(Checkpoint(self.checkpoint_path).state, {},
+                         "Checkpoint not cleared after cleanup")
+
+    def test_resume_from_checkpoint(self):
+        pks = list(Related2Model.objects.only_deleted().order_by('pk').values_list('pk', flat=True))
+        Checkpoint(self.checkpoint_path).set(model_key(Related2Model, 'default'), pks[1])
+        call_command('cleanupdeleted', 'models.Related2Model', interactive=False,
+                     verbosity=0, batch_size=2, checkpoint=self.checkpoint_path)
+        self.assertEqual(list(Related2Model.objects.only_deleted().order_by('pk').values_list('pk', flat=True)),
+                         pks[:2], "Cleanup not resumed after the checkpoint")
+
+
+class ParallelCleanupTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+
+    def test_dependency_graph(self):
+        graph = dependency_graph([TestModel, Related2Model, ArchivedModel])
+        self.assertEqual(graph[TestModel], set([Related2Model, ArchivedModel]))
+        self.assertEqual(graph[Related2Model], set())
+        self.assertEqual(graph[ArchivedModel], set())
+
+    def test_run_in_order(self):
+        graph = {TestModel: set([Related2Model, ArchivedModel]),
+                 Related2Model: set(), ArchivedModel: set()}
+        for jobs in (1, 3):
+            finished = []
+            results = run_in_order(graph, lambda model: finished.append(model) or 1, jobs)
+            self.assertEqual(results, {TestModel: 1, Related2Model: 1, ArchivedModel: 1})
+            self.assertEqual(finished[-1], TestModel,
+                             "Model purged before the models referencing it")
+
+    def test_conflicting_models(self):
+        # both referenced by the table of LogicalManyModel.related
+        conflicts = conflicting_models([TestModel, LogicalManyModel, CascadeModel])
+        self.assertEqual(conflicts, {TestModel: set([LogicalManyModel]),
+                                     LogicalManyModel: set([TestModel]),
+                                     CascadeModel: set()})
+        self.assertEqual(dependency_graph([TestModel, LogicalManyModel])[TestModel], set())
+
+    def test_run_in_order_conflicts(self):
+        graph = {TestModel: set(), LogicalManyModel: set(), CascadeModel: set()}
+        lock = threading.Lock()
+        running = set()
+        concurrent = []
+
+        def func(model):
+            with lock:
+                running.add(model)
+                concurrent.append(set(running))
+            time.sleep(0.05)
+            with lock:
+                running.discard(model)
+        run_in_order(graph, func, 3, conflicts=conflicting_models(graph.keys()))
+        self.assertTrue(any(CascadeModel in models and len(models) > 1
+                            for models in concurrent))
+        self.assertFalse(any(TestModel in models and LogicalManyModel in models
+                             for models in concurrent),
+                         "Models referenced by the same model purged at the same time")
+
+    def test_run_in_order_cycle(self):
+        graph = {TestModel: set([Related2Model]), Related2Model: set([TestModel])}
+        self.assertEqual(sorted(run_in_order(graph, lambda model: 0, 2).values()), [0, 0])
+
+    def test_run_in_order_error(self):
+        def fail(model):
+            if model is Related2Model:
+                raise ValueError(model)
+        graph = {TestModel: set([Related2Model]), Related2Model: set()}
+        called = []
+        self.assertRaises(ValueError, run_in_order, graph,
+                          lambda model: called.append(model) or fail(model), 2)
+        self.assertEqual(called, [Related2Model],
+                         "Dependent model purged after a failure")
+
+    def test_purge_databases(self):
+        Related2Model.objects.create(text="deleted").delete()
+        results = purge_databases([Related2Model, TestModel], ['default'])
+        purged, seconds = results['default']
+        self.assertEqual(purged, {Related2Model: 1, TestModel: 0})
+
+    def test_cleanup_all_databases(self):
+        Related2Model.objects.create(text="deleted").delete()
+        call_command('cleanupdeleted', 'models', interactive=False, verbosity=0,
+                     all_databases=True)
+        self.assertEqual(Related2Model.objects.everything().count(), 0)
+
+    def test_cleanup_summary(self):
+        from StringIO import StringIO
+        Related2Model.objects.create(text="deleted").delete()
+        for verbosity in ('1', '2', 2):
+            output = StringIO()
+            call_command('cleanupdeleted', 'models', interactive=False, verbosity=verbosity,
+                         stdout=output)
+            self.assertTrue("Database default: removed" in output.getvalue(),
+                            "No summary with verbosity %r" % verbosity)
+
+    def test_cleanup_jobs(self):
+        Related2Model.objects.create(text="deleted").delete()
+        call_command('cleanupdeleted', 'models', interactive=False, verbosity=0, jobs=1)
+        self.assertEqual(Related2Model.objects.everything().count(), 0)
+
+    def test_cleanup_jobs_checkpoint(self):
+        # the worker threads of an in-memory SQLite database don't see its
+        # tables, so each model is "purged" in chunks of the checkpoint only
+        checkpoint_path = tempfile.mktemp()
+        purged = []
+
+        def purge(model, using, checkpoint=None, **kwargs):
+            key = model_key(model, using)
+            for last_pk in range(1, 4):
+                checkpoint.set(key, last_pk)
+                # the checkpoint file stays readable while the others write
+                Checkpoint(checkpoint_path)
+            checkpoint.discard(key)
+            purged.append(model)
+            return 1
+
+        try:
+            with mock_attr(logicaldelete_cleanup, 'purge', purge):
+                call_command('cleanupdeleted', 'models', interactive=False, verbosity=0,
+                             jobs=3, checkpoint=checkpoint_path)
+            models = [model for model in loading.get_models(loading.get_app('models'))
+                      if model in logicaldelete_models_registry]
+            self.assertEqual(sorted(purged, key=model_sort_key),
+                             sorted(models, key=model_sort_key),
+                             "Models not purged exactly once")
+            self.assertEqual(Checkpoint(checkpoint_path).state, {},
+                             "Checkpoint not cleared after cleanup")
+        finally:
+            if os.path.exists(checkpoint_path):
+                os.remove(checkpoint_path)
+
+
+class MultipleDatabasesCleanupTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+
+    def setUp(self):
+        # a file, so the thread of the alias sees the same database
+        self.path = tempfile.mktemp()
+        connections.databases['other'] = {'ENGINE': 'django.db.backends.sqlite3',
+                                          'NAME': self.path}
+        call_command('syncdb', database='other', verbosity=0, interactive=False)
+        Related2Model.objects.create(text="deleted").delete()
+        Related2Model.objects.db_manager('other').create(text="deleted").delete()
+
+    def tearDown(self):
+        connections['other'].close()
+        del connections.databases['other']
+        delattr(connections._connections, 'other')
+        os.remove(self.path)
+
+    def deleted_counts(self):
+        return [Related2Model.objects.db_manager(using).only_deleted().count()
+                for using in ('default', 'other')]
+
+    def test_cleanup_database(self):
+        # writes routed elsewhere, or no syncdb, don't matter for a nominated database
+        with mock_attr(router, 'db_for_write', lambda model, **hints: 'default'):
+            with mock_attr(router, 'allow_syncdb', lambda db, model: db == 'default'):
+                call_command('cleanupdeleted', 'models', interactive=False, verbosity=0,
+                             database='other')
+        self.assertEqual(self.deleted_counts(), [1, 0])
+
+    def test_cleanup_all_databases(self):
+        # the in-memory "default" database is not shared with the threads
+        call_command('cleanupdeleted', 'models', interactive=False, verbosity=0,
+                     all_databases=True, skip_databases=['default'])
+        self.assertEqual(self.deleted_counts(), [1, 0])
+
+    def test_cleanup_all_databases_router(self):
+        with mock_attr(router, 'allow_syncdb', lambda db, model: db == 'default'):
+            call_command('cleanupdeleted', 'models', interactive=False, verbosity=0,
+                         all_databases=True, skip_databases=['default'])
+        self.assertEqual(self.deleted_counts(), [1, 1])
+
+    def test_skip_databases_setting(self):
+        with override_settings(LOGICALDELETE_CLEANUP_SKIP_DATABASES=['default']):
+            call_command('cleanupdeleted', 'models', interactive=False, verbosity=0,
+                         all_databases=True)
+        self.assertEqual(self.deleted_counts(), [1, 0])
+
+
+class CoordinatedCleanupTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+
+    def setUp(self):
+        for i in range(6):
+            Related2Model.objects.create(text="deleted")
+        Related2Model.objects.all().delete()
+        self.pks = list(Related2Model.objects.only_deleted().order_by('pk').values_list('pk', flat=True))
+        self.resource = model_key(Related2Model, 'default')
+
+    def test_claim_lease(self):
+        self.assertTrue(claim_lease(self.resource, 0, 'a', 60, 'default'))
+        self.assertFalse(claim_lease(self.resource, 0, 'b', 60, 'default'),
+                         "Chunk claimed twice")
+        self.assertTrue(claim_lease(self.resource, 1, 'b', 60, 'default'))
+        release_lease(self.resource, 0, 'a', 'default')
+        self.assertTrue(claim_lease(self.resource, 0, 'b', 60, 'default'))
+
+    def test_claim_expired_lease(self):
+        CleanupLease.objects.create(resource=self.resource, bucket=0, owner='a',
+                                    expires=now() - timedelta(seconds=1))
+        self.assertTrue(claim_lease(self.resource, 0, 'b', 60, 'default'))
+        self.assertEqual(CleanupLease.objects.get(bucket=0).owner, 'b')
+
+    def test_purge_skips_claimed_chunks(self):
+        batch_size = 4
+        claimed = self.pks[0] // batch_size
+        CleanupLease.objects.create(resource=self.resource, bucket=claimed, owner='other',
+                                    expires=now() + timedelta(seconds=60))
+        purge(Related2Model, 'default', batch_size=batch_size, coordinated=True)
+        self.assertEqual(list(Related2Model.objects.only_deleted().order_by('pk').values_list('pk', flat=True)),
+                         [pk for pk in self.pks if pk // batch_size == claimed])
+        self.assertEqual(CleanupLease.objects.filter(owner='other').count(), 1)
+        self.assertEqual(CleanupLease.objects.count(), 1, "Leases not released")
+
+    def test_supports_skip_locked(self):
+        class Connection(object):
+            def __init__(self, vendor, pg_version=None):
+                self.vendor = vendor
+                self.pg_version = pg_version
+
+            def cursor(self):
+                pass
+        self.assertFalse(supports_skip_locked(Connection('sqlite')))
+        self.assertFalse(supports_skip_locked(Connection('mysql')))
+        self.assertFalse(supports_skip_locked(Connection('postgresql', 90409)))
+        self.assertTrue(supports_skip_locked(Connection('postgresql', 90500)))
+        self.assertTrue(supports_skip_locked(Connection('postgresql', 100004)))
+
+    def test_coordinated_command(self):
+        call_command('cleanupdeleted', 'models.Related2Model', interactive=False,
+                     verbosity=0, batch_size=4, coordinated=True)
+        self.assertEqual(Related2Model.objects.everything().count(), 0)
+
+
+class RetentionTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+
+    def setUp(self):
+        self.now = now()
+        for days in (1, 10, 20, 30):
+            instance = Related2Model.objects.create(text="%d days" % days)
+            Related2Model.objects.filter(pk=instance.pk).update(
+                date_removed=self.now - timedelta(days=days))
+
+    def tearDown(self):
+        Related2Model._logicaldelete_meta.retain_for = None
+        Related2Model._logicaldelete_meta.max_tombstones = None
+
+    def remaining(self):
+        return sorted(Related2Model.objects.only_deleted().values_list('text', flat=True))
+
+    def test_older_than(self):
+        call_command('cleanupdeleted', 'models.Related2Model', interactive=False,
+                     verbosity=0, older_than='15d')
+        self.assertEqual(self.remaining(), ['1 days', '10 days'])
+
+    def test_retain_for(self):
+        Related2Model._logicaldelete_meta.retain_for = timedelta(days=5)
+        call_command('cleanupdeleted', 'models.Related2Model', interactive=False,
+                     verbosity=0, older_than='15d')
+        self.assertEqual(self.remaining(), ['1 days', '10 days'])
+        call_command('cleanupdeleted', 'models.Related2Model', interactive=False,
+                     verbosity=0)
+        self.assertEqual(self.remaining(), ['1 days'])
+
+    def test_max_tombstones(self):
+        Related2Model._logicaldelete_meta.max_tombstones = 3
+        call_command('cleanupdeleted', 'models.Related2Model', interactive=False,
+                     verbosity=0)
+        self.assertEqual(self.remaining(), ['1 days', '10 days', '20 days'])
+        call_command('cleanupdeleted', 'models.Related2Model', interactive=False,
+                     verbosity=0, older_than='5d')
+        self.assertEqual(self.remaining(), ['1 days', '10 days', '20 days'])
+        Related2Model._logicaldelete_meta.max_tombstones = 1
+        call_command('cleanupdeleted', 'models.Related2Model', interactive=False,
+                     verbosity=0, older_than='15d')
+        self.assertEqual(self.remaining(), ['1 days', '10 days'])
+
+    def test_max_tombstones_same_date_removed(self):
+        pks = list(Related2Model.objects.only_deleted().order_by('pk').values_list('pk', flat=True))
+        for i in range(6):
+            Related2Model.objects.create(text="bulk %d" % i)
+        # deleted together, with a single date_removed
+        Related2Model.objects.all().delete()
+        Related2Model._logicaldelete_meta.max_tombstones = 5
+        call_command('cleanupdeleted', 'models.Related2Model', interactive=False,
+                     verbosity=0)
+        self.assertEqual(self.remaining(), ['bulk %d' % i for i in range(1, 6)])
+        self.assertFalse(Related2Model.objects.only_deleted().filter(pk__in=pks).exists())
+
+
+class IndexesTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+
+    def test_indexes_created(self):
+        cursor = connection.cursor()
+        cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' "
+                       "AND tbl_name = %s", [TestModel._meta.db_table])
+        indexes = dict(cursor.fetchall())
+        self.assertIn('models_testmodel_related_id_text_active', indexes)
+        if supports_partial_indexes(connection):
+            self.assertIn('WHERE "date_removed" IS NULL',
+                          indexes['models_testmodel_related_id_text_active'])
+        self.assertIn('("date_removed", "id")', indexes['models_testmodel_date_removed'])
+
+    def test_fallback_to_composite_index(self):
+        with mock_attr(schema, 'supports_partial_indexes', lambda connection: False):
+            statements = sql_indexes_for_model(TestModel, connection)
+        self.assertEqual(statements[0],
+            'CREATE INDEX "models_testmodel_related_id_text_active" ON "models_testmodel" '
+            '("related_id", "text", "date_removed");')
+
+
+class UndeleteTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+    fixtures = ['delete_related.json']
+
+    def setUp(self):
+        TestModel._logicaldelete_meta.delete_related = True
+        TestModel._logicaldelete_meta.safe_deletion = True
+        TestModel.objects.get(pk=1).delete()
+        self.other = Related2Model.objects.create(text="other")
+        self.other.delete()
+
+    def test_operation_id(self):
+        operations = set(Related2Model.objects.only_deleted().values_list('deletion_op', flat=True))
+        self.assertEqual(len(operations), 2)
+        self.assertEqual(TestModel.objects.everything().get(pk=1).deletion_op,
+                         Related2Model.objects.everything().get(pk=1).deletion_op)
+
+    def test_undelete(self):
+        TestModel.objects.get(pk=1).undelete()
+        self.assertTrue(TestModel.objects.filter(pk=1, date_removed=None).exists())
+        self.assertFalse(Related2Model.objects.filter(pk=1, date_removed=None).exists(),
+                         "Related object undeleted without cascade")
+
+    def test_undelete_cascade(self):
+        TestModel.objects.get(pk=1).undelete(cascade=True)
+        self.assertTrue(TestModel.objects.filter(pk=1, date_removed=None).exists())
+        self.assertTrue(Related2Model.objects.filter(pk=1, date_removed=None).exists(),
+                        "Related object deleted by the same operation not undeleted")
+        self.assertFalse(Related2Model.objects.filter(pk=self.other.pk, date_removed=None).exists(),
+                         "Object deleted by another operation undeleted")
+
+
+class BatchSignalsTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+    fixtures = ['delete_related.json']
+
+    def setUp(self):
+        self.received = []
+        for signal in (pre_logical_delete_batch, post_logical_delete_batch,
+                       pre_undelete_batch, post_undelete_batch,
+                       signals.pre_delete):
+            signal.connect(self.receiver)
+        TestModel._logicaldelete_meta.delete_related = True
+        TestModel._logicaldelete_meta.safe_deletion = True
+
+    def tearDown(self):
+        for signal in (pre_logical_delete_batch, post_logical_delete_batch,
+                       pre_undelete_batch, post_undelete_batch,
+                       signals.pre_delete):
+            signal.disconnect(self.receiver)
+        TestModel._logicaldelete_meta.instance_signals = True
+        Related2Model._logicaldelete_meta.instance_signals = True
+
+    def receiver(self, signal, sender, **kwargs):
+        self.received.append((signal, sender, kwargs.get('pk_list')))
+
+    def test_delete_signals(self):
+        TestModel.objects.get(pk=1).delete()
+        self.assertIn((pre_logical_delete_batch, TestModel, [1]), self.received)
+        self.assertIn((post_logical_delete_batch, Related2Model, [1]), self.received)
+        self.assertIn((signals.pre_delete, TestModel, None), self.received)
+
+    def test_fast_path_signals(self):
+        Related2Model._logicaldelete_meta.instance_signals = False
+        self.assertEqual(Related2Model.objects.filter(pk=1).delete(), 'update')
+        self.assertEqual(self.received,
+                         [(pre_logical_delete_batch, Related2Model, [1]),
+                          (post_logical_delete_batch, Related2Model, [1])])
+
+    def test_no_instance_signals(self):
+        TestModel._logicaldelete_meta.instance_signals = False
+        TestModel.objects.get(pk=1).delete()
+        self.assertNotIn((signals.pre_delete, TestModel, None), self.received)
+        self.assertIn((signals.pre_delete, Related2Model, None), self.received)
+
+    def test_no_instance_signals_hard_delete(self):
+        # Related2Model objects are loaded with only(), and deleted ordinary
+        # through the plain RelatedModel
+        Related2Model._logicaldelete_meta.instance_signals = False
+        TestModel._logicaldelete_meta.safe_deletion = False
+        obj = TestModel.objects.create(text="root")
+        related = RelatedModel.objects.create(text="plain", related=obj)
+        related2 = Related2Model.objects.create(text="leaf", related=related)
+        received = []
+        receiver = lambda sender, instance, **kwargs: received.append(instance.pk)
+        signals.pre_delete.connect(receiver, sender=Related2Model)
+        try:
+            obj.delete()
+        finally:
+            signals.pre_delete.disconnect(receiver, sender=Related2Model)
+            TestModel._logicaldelete_meta.safe_deletion = True
+        self.assertFalse(Related2Model.objects.everything().filter(pk=related2.pk).exists())
+        self.assertEqual(received, [related2.pk], "pre_delete not sent for the real model")
+
+    def test_undelete_signals(self):
+        Related2Model.objects.filter(pk=1).delete()
+        Related2Model.objects.filter(pk=1).undelete()
+        self.assertIn((pre_undelete_batch, Related2Model, [1]), self.received)
+        self.assertIn((post_undelete_batch, Related2Model, [1]), self.received)
+        self.assertTrue(Related2Model.objects.filter(pk=1, date_removed=None).exists())
+
+    def test_proxy_model_signals(self):
+        Related2Model._logicaldelete_meta.instance_signals = False
+        ProxyRelated2Model.objects.filter(pk=1).delete()
+        ProxyRelated2Model.objects.only_deleted().filter(pk=1).undelete()
+        ProxyRelated2Model.objects.get(pk=1).delete()
+        for signal in (pre_logical_delete_batch, post_logical_delete_batch,
+                       pre_undelete_batch, post_undelete_batch):
+            self.assertIn((signal, ProxyRelated2Model, [1]), self.received)
+            self.assertIn((signal, Related2Model, [1]), self.received)
+        self.assertEqual(len([r for r in self.received if r[0] is pre_logical_delete_batch
+                              and r[1] is ProxyRelated2Model]), 2)
+
+
+class StreamingDeleteTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+
+    def setUp(self):
+        TestModel._logicaldelete_meta.delete_related = True
+        TestModel._logicaldelete_meta.safe_deletion = True
+        for i in range(5):
+            instance = TestModel.objects.create(text="test model")
+            Related2Model.objects.create(text="related2", related2=instance)
+        TestModel.objects.create(text="kept")
+
+    def test_delete_in_chunks(self):
+        self.assertEqual(TestModel.objects.filter(text="test model").delete(chunk_size=2),
+                         'stream')
+        self.assertEqual(TestModel.objects.only_deleted().count(), 5)
+        self.assertEqual(TestModel.objects.count(), 1)
+        self.assertEqual(Related2Model.objects.only_deleted().count(), 5)
+        operations = set(TestModel.objects.only_deleted().values_list('deletion_op', 'date_removed'))
+        self.assertEqual(len(operations), 1, "Chunks deleted by different operations")
+
+    def test_single_transaction(self):
+        TestModel.objects.filter(text="test model").delete(chunk_size=2,
+                                                            single_transaction=True)
+        self.assertEqual(TestModel.objects.only_deleted().count(), 5)
+
+
+class CollectedFieldsTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+    fixtures = ['delete_related.json']
+
+    def setUp(self):
+        TestModel._logicaldelete_meta.delete_related = True
+        TestModel._logicaldelete_meta.safe_deletion = True
+
+    def _delete_queries(self):
+        instance = TestModel.objects.get(pk=1)
+        reset_queries()
+        instance.delete()
+        return [query['sql'] for query in connection.queries]
+
+    def test_only_needed_fields(self):
+        """
+        Collected objects are loaded without the fields not needed for
+        the deletion.
+        """
+        queries = self._delete_queries()
+        self.assertFalse([sql for sql in queries if '"models_related2model"."text"' in sql])
+        self.assertTrue(Related2Model.objects.only_deleted().filter(pk=1).exists())
+        deferred_model = Related2Model.objects.everything().only('text')[0].__class__
+        self.assertNotIn(deferred_model, logicaldelete_models_registry)
+
+    def test_full_objects_for_receivers(self):
+        """
+        Collected objects are loaded completely for pre_delete receivers.
+        """
+        def receiver(sender, instance, **kwargs):
+            self.assertEqual(instance.text, "related2")
+        signals.pre_delete.connect(receiver, sender=Related2Model)
+        try:
+            queries = self._delete_queries()
+        finally:
+            signals.pre_delete.disconnect(receiver, sender=Related2Model)
+        self.assertTrue([sql for sql in queries if '"models_related2model"."text"' in sql])
+
+
+class ArchiveStorageTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+    fixtures = ['delete_related.json']
+
+    def setUp(self):
+        TestModel._logicaldelete_meta.delete_related = True
+        TestModel._logicaldelete_meta.safe_deletion = True
+        self.parent = TestModel.objects.get(pk=1)
+        self.first = ArchivedModel.objects.create(text="first", related=self.parent)
+        self.second = ArchivedModel.objects.create(text="second")
+
+    def test_delete_moves_rows(self):
+        self.first.delete()
+        self.assertEqual(list(ArchivedModel.objects.values_list('pk', flat=True)),
+                         [self.second.pk])
+        archived = ArchivedModel.objects.only_deleted().get(pk=self.first.pk)
+        self.assertEqual(archived.text, "first")
+        self.assertEqual(archived.related_id, self.parent.pk)
+        self.assertNotEqual(archived.date_removed, None)
+
+    def test_queryset_delete(self):
+        path = ArchivedModel.objects.all().delete()
+        self.assertEqual(path, 'update')
+        self.assertEqual(ArchivedModel.objects.count(), 0)
+        self.assertEqual(ArchivedModel.objects.only_deleted().count(), 2)
+
+    def test_everything_and_get(self):
+        self.first.delete()
+        # the table of the model only holds active objects
+        everything = ArchivedModel.objects.everything()
+        self.assertEqual(list(everything.values_list('pk', flat=True)), [self.second.pk])
+        self.assertEqual(everything.filter(text="second").count(), 1)
+        self.assertEqual(list(ArchivedModel.objects.filter(pk=self.first.pk)), [])
+        self.assertEqual([obj.pk for obj in ArchivedModel.objects.archived()], [self.first.pk])
+        self.assertEqual([obj.pk for obj in self.parent.archivedmodel_set.archived()],
+                         [self.first.pk])
+        self.assertRaises(ValueError, TestModel.objects.archived)
+        obj = ArchivedModel.objects.get(pk=self.first.pk)
+        self.assertTrue(isinstance(obj, ArchivedModel))
+        self.assertFalse(obj.active())
+        self.assertRaises(ArchivedModel.DoesNotExist, ArchivedModel.objects.get, pk=0)
+
+    def test_undelete_cascade(self):
+        self.parent.delete()
+        self.assertFalse(ArchivedModel.objects.filter(pk=self.first.pk).exists(),
+                         "Related archived object not deleted")
+        TestModel.objects.get(pk=1).undelete(cascade=True)
+        obj = ArchivedModel.objects.get(pk=self.first.pk)
+        self.assertTrue(obj.active())
+        self.assertEqual(obj.deletion_op, None)
+        self.assertEqual(ArchivedModel.objects.only_deleted().count(), 0)
+
+    def test_cleanup(self):
+        ArchivedModel.objects.all().delete()
+        call_command('cleanupdeleted', 'models.ArchivedModel', interactive=False,
+                     verbosity=0)
+        self.assertEqual(ArchivedModel.objects.only_deleted().count(), 0)
+        self.assertEqual(list(ArchivedModel.objects.everything()), [])
+
+    def test_primary_keys_not_reused(self):
+        self.second.delete()
+        obj = ArchivedModel.objects.create(text="third")
+        self.assertTrue(obj.pk > self.second.pk, "Primary key of an archived object reused")
+        ArchivedModel.objects.only_deleted().filter(pk=self.second.pk).undelete()
+        self.assertTrue(ArchivedModel.objects.get(pk=self.second.pk).active())
+
+    def test_undelete_reused_primary_key(self):
+        self.second.delete()
+        # e.g. MySQL before 8.0 after a restart
+        ArchivedModel.objects.create(pk=self.second.pk, text="reused")
+        self.assertRaises(IntegrityError,
+                          ArchivedModel.objects.only_deleted().filter(pk=self.second.pk).undelete)
+        self.assertEqual(ArchivedModel.objects.only_deleted().count(), 1)
+
+    def test_proxy_model_signals(self):
+        received = []
+        receiver = lambda signal, sender, **kwargs: received.append((signal, sender))
+        for signal in (pre_undelete_batch, post_undelete_batch):
+            signal.connect(receiver)
+        try:
+            ProxyArchivedModel.objects.filter(pk=self.first.pk).delete()
+            ProxyArchivedModel.objects.archived().filter(pk=self.first.pk).undelete()
+        finally:
+            for signal in (pre_undelete_batch, post_undelete_batch):
+                signal.disconnect(receiver)
+        for signal in (pre_undelete_batch, post_undelete_batch):
+            self.assertIn((signal, ArchivedModel), received)
+            self.assertIn((signal, ProxyArchivedModel), received)
+        self.assertTrue(ArchivedModel.objects.filter(pk=self.first.pk).exists())
+
+    def test_manager_contract(self):
+        self.first.delete()
+        manager = ArchivedModel.objects
+        # other models return deleted objects too, archived ones are only
+        # reached with get(), archived() and only_deleted()
+        self.assertEqual(manager.everything().filter(pk=self.first.pk).count(), 0)
+        self.assertFalse(manager.filter(pk=self.first.pk).exists())
+        self.assertEqual(manager.get(pk=self.first.pk).pk, self.first.pk)
+        self.assertEqual(manager.archived().filter(pk=self.first.pk).count(), 1)
+        self.assertEqual(manager.only_deleted().filter(pk=self.first.pk).count(), 1)
+        self.assertTrue(manager.is_deleted(self.first.pk))
+
+    def test_admin(self):
+        self.first.delete()
+        site = admin.AdminSite()
+        self.assertRaises(admin.sites.NotRegistered, register_archive_admin,
+                          ArchivedModel, site)
+        site.register(ArchivedModel, ModelAdmin)
+        self.assertEqual(len(site._registry), 1)
+        register_archive_admin(ArchivedModel, site)
+        self.assertRaises(ValueError, register_archive_admin, TestModel, site)
+        model_admin = site._registry[ArchivedModel]
+        archive_admin = site._registry[ArchivedModel._logicaldelete_archive]
+        self.assertTrue(archive_admin.model_admin is model_admin)
+        request = RequestFactory().post('/', {'action': 'undelete_selected'})
+        request.user = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        request._messages = CookieStorage(request)
+        self.assertEqual([obj.pk for obj in archive_admin.queryset(request)], [self.first.pk])
+        self.assertFalse('delete_selected' in archive_admin.get_actions(request))
+        archive_admin.undelete_selected(request, archive_admin.queryset(request))
+        self.assertTrue(ArchivedModel.objects.get(pk=self.first.pk).active())
+        self.assertEqual(LogEntry.objects.get().object_id, unicode(self.first.pk))
+
+    def test_referenced_model(self):
+        self.assertRaises(ImproperlyConfigured, check_archive_storage, TestModel, 'default')
+        self.assertRaises(ImproperlyConfigured, check_archive_storage, LogicalManyModel,
+                          'default')
+        check_archive_storage(ArchivedModel, 'default')
+
+
+
+class CollectorStatsTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+    fixtures = ['delete_related_and_plain_model.json']
+
+    def setUp(self):
+        TestModel._logicaldelete_meta.safe_deletion = True
+        TestModel._logicaldelete_meta.delete_related = True
+        self.received = []
+        collector_stats.connect(self.receiver, sender=LogicalDeleteCollector)
+
+    def tearDown(self):
+        collector_stats.disconnect(self.receiver, sender=LogicalDeleteCollector)
+
+    def receiver(self, sender, stats, using, **kwargs):
+        self.received.append(stats)
+
+    def test_collector_stats(self):
+        collector = LogicalDeleteCollector(using='default')
+        collector.collect([TestModel.objects.get(pk=1)])
+        collector.delete()
+        self.assertEqual(self.received, [collector.stats])
+        stats = collector.stats.as_dict()
+        for phase in ('collect', 'sort', 'determine_delete_method', 'mark_deleted'):
+            self.assertTrue(phase in stats['timings'], "No timing of %s" % phase)
+        self.assertEqual(stats['counts']['models.TestModel'], {'logical': 1})
+        self.assertEqual(stats['counts']['models.RelatedModel'], {'kept': 1})
+        self.assertEqual(stats['counts']['models.Related2Model'], {'logical': 1})
+        self.assertTrue(stats['queries'] > 0)
+
+    def test_fast_update_stats(self):
+        Related2Model.objects.all().delete()
+        self.assertEqual(len(self.received), 1)
+        self.assertEqual(self.received[0].counts, {'models.Related2Model': {'logical': 1}})
+
+    def test_count_queries_without_debug(self):
+        with mock_attr(settings, 'DEBUG', False):
+            reset_queries()
+            TestModel.objects.get(pk=1).delete()
+            self.assertTrue(self.received[0].queries > 0)
+            self.assertEqual(connection.queries, [],
+                             "Statements counted for the stats kept on the connection")
+
+    def test_stats_logger(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('logicaldelete.stats')
+        logger.addHandler(handler)
+        try:
+            with mock_attr(logger, 'level', logging.DEBUG):
+                TestModel.objects.get(pk=1).delete()
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].stats['counts']['models.TestModel'], {'logical': 1})
+
+
+
+class DeleteImpactTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+    fixtures = ['delete_related_and_plain_model.json']
+
+    def tearDown(self):
+        TestModel._logicaldelete_meta.safe_deletion = False
+        TestModel._logicaldelete_meta.delete_related = True
+
+    def collected_impact(self, queryset=None):
+        collector = LogicalDeleteCollector(using='default')
+        collector.collect(queryset if queryset is not None else TestModel.objects.filter(pk=1))
+        collector.delete()
+        impact = {}
+        for label, counts in collector.stats.counts.iteritems():
+            counts = {'logical': counts.get('logical', 0), 'hard': counts.get('deleted', 0)}
+            if counts['logical'] or counts['hard']:
+                impact[label] = counts
+        return impact
+
+    def test_delete_impact(self):
+        for safe_deletion in (True, False):
+            for delete_related in (True, False):
+                TestModel._logicaldelete_meta.safe_deletion = safe_deletion
+                TestModel._logicaldelete_meta.delete_related = delete_related
+                sid = transaction.savepoint()
+                reset_queries()
+                impact = TestModel.objects.filter(pk=1).delete_impact()
+                self.assertTrue(all(query['sql'].startswith('SELECT COUNT')
+                                    for query in connection.queries),
+                                "Objects loaded to estimate the impact")
+                impact = dict(('%s.%s' % (model._meta.app_label, model._meta.object_name), counts)
+                              for model, counts in impact.iteritems()
+                              if not model._meta.auto_created)
+                self.assertEqual(impact, self.collected_impact(),
+                                 "Wrong impact with safe_deletion=%s and delete_related=%s"
+                                 % (safe_deletion, delete_related))
+                transaction.savepoint_rollback(sid)
+
+    def test_delete_impact_cycle(self):
+        TestModel._logicaldelete_meta.safe_deletion = False
+        # TestModel 1 -> RelatedModel 1 -> TestModel 1
+        TestModel.objects.filter(pk=1).update(related=1)
+        impact = TestModel.objects.filter(pk=1).delete_impact()
+        self.assertEqual(impact[TestModel], {'logical': 1, 'hard': 0})
+        self.assertEqual(impact[RelatedModel], {'logical': 0, 'hard': 1})
+
+    def labelled(self, impact):
+        return dict(('%s.%s' % (model._meta.app_label, model._meta.object_name), counts)
+                    for model, counts in impact.iteritems() if not model._meta.auto_created)
+
+    def test_delete_impact_shared_objects(self):
+        obj = TestModel.objects.create(text="shared")
+        related = RelatedModel.objects.create(text="shared", related=obj)
+        # reachable from obj directly and through related
+        Related2Model.objects.create(text="shared", related=related, related2=obj)
+        for safe_deletion in (True, False):
+            TestModel._logicaldelete_meta.safe_deletion = safe_deletion
+            sid = transaction.savepoint()
+            impact = TestModel.objects.filter(pk=obj.pk).delete_impact()
+            self.assertEqual(self.labelled(impact),
+                             self.collected_impact(TestModel.objects.filter(pk=obj.pk)),
+                             "Wrong impact with safe_deletion=%s" % safe_deletion)
+            transaction.savepoint_rollback(sid)
+
+    def test_delete_impact_generic_relation(self):
+        obj = TaggedModel.objects.create(text="tagged")
+        for tag in ("a", "b"):
+            TaggedItem.objects.create(tag=tag, content_object=obj)
+        for safe_deletion, expected in ((True, None), (False, {'logical': 0, 'hard': 2})):
+            sid = transaction.savepoint()
+            with mock_attr(LogicalDeleteOptions, 'safe_deletion', safe_deletion):
+                impact = TaggedModel.objects.filter(pk=obj.pk).delete_impact()
+                self.assertEqual(impact.get(TaggedItem), expected)
+                self.assertEqual(self.labelled(impact),
+                                 self.collected_impact(TaggedModel.objects.filter(pk=obj.pk)))
+            transaction.savepoint_rollback(sid)
+
+    def test_delete_impact_truncated(self):
+        self.assertFalse(TestModel.objects.filter(pk=1).delete_impact().truncated)
+        impact = TestModel.objects.filter(pk=1).delete_impact(max_depth=0)
+        self.assertTrue(impact.truncated, "Truncated impact not flagged")
+        self.assertEqual(impact.keys(), [TestModel])
+
+
+
+class CascadeUpdateTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+
+    def setUp(self):
+        for i in range(3):
+            parent = CascadeModel.objects.create(text="parent")
+            CascadeChildModel.objects.create(text="child", parent=parent)
+            plain = CascadePlainModel.objects.create(text="plain", parent=parent)
+            CascadeGrandchildModel.objects.create(text="grandchild", parent=plain)
+        CascadeModel.objects.create(text="other")
+
+    def tearDown(self):
+        CascadeModel._logicaldelete_meta.safe_deletion = True
+
+    def state(self):
+        state = []
+        for model in (CascadeModel, CascadeChildModel, CascadeGrandchildModel):
+            state.append([(obj.pk, obj.active())
+                          for obj in model.objects.everything().order_by('pk')])
+        state.append(list(CascadePlainModel.objects.order_by('pk').values_list('pk', flat=True)))
+        return state
+
+    def test_cascade_update(self):
+        for safe_deletion in (True, False):
+            CascadeModel._logicaldelete_meta.safe_deletion = safe_deletion
+            sid = transaction.savepoint()
+            reset_queries()
+            path = CascadeModel.objects.filter(text="parent").delete()
+            self.assertEqual(path, 'cascade')
+            self.assertEqual(len(connection.queries), 3 if safe_deletion else 4,
+                             "Not one statement per relation")
+            cascaded = self.state()
+            transaction.savepoint_rollback(sid)
+            with mock_attr(LogicalDeleteCollector, 'can_cascade_update', lambda self, objs: False):
+                self.assertEqual(CascadeModel.objects.filter(text="parent").delete(), 'collect')
+            self.assertEqual(cascaded, self.state(),
+                             "Cascade and collector deletions differ with safe_deletion=%s"
+                             % safe_deletion)
+            transaction.savepoint_rollback(sid)
+
+    def test_cascade_update_signals(self):
+        receiver = lambda sender, **kwargs: None
+        signals.pre_delete.connect(receiver, sender=CascadeGrandchildModel)
+        try:
+            self.assertEqual(CascadeModel.objects.filter(text="parent").delete(), 'collect')
+        finally:
+            signals.pre_delete.disconnect(receiver, sender=CascadeGrandchildModel)
+
+    def test_cascade_update_cycle(self):
+        collector = LogicalDeleteCollector(using='default')
+        self.assertFalse(collector.can_cascade_update(TestModel.objects.all()))
+
+    def test_cascade_update_generic_relation(self):
+        obj = TaggedModel.objects.create(text="tagged")
+        TaggedItem.objects.create(tag="tag", content_object=obj)
+        collector = LogicalDeleteCollector(using='default')
+        self.assertFalse(collector.can_cascade_update(TaggedModel.objects.all()))
+        self.assertEqual(TaggedModel.objects.all().delete(), 'collect')
+
+
+
+class LogicalManyToManyTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+
+    def setUp(self):
+        self.tests = [TestModel.objects.create(text="test %d" % i) for i in range(3)]
+        self.obj = LogicalManyModel.objects.create(text="many")
+        self.obj.related.add(*self.tests)
+        self.through = LogicalManyModel.related.through
+
+    def related_pks(self, obj):
+        return sorted(obj.related.values_list('pk', flat=True))
+
+    def test_remove_marks_relation(self):
+        self.obj.related.remove(self.tests[0])
+        self.assertEqual(self.related_pks(self.obj), [self.tests[1].pk, self.tests[2].pk])
+        self.assertEqual(list(self.tests[0].logicalmanymodel_set.all()), [])
+        self.assertEqual(self.through.objects.count(), 3, "Relation deleted")
+
+    def test_add_restores_relation(self):
+        self.obj.related.clear()
+        self.assertEqual(self.related_pks(self.obj), [])
+        self.obj.related.add(self.tests[0])
+        self.assertEqual(self.related_pks(self.obj), [self.tests[0].pk])
+        self.assertEqual(self.through.objects.count(), 3)
+
+    def test_add_signals(self):
+        self.obj.related.remove(self.tests[0])
+        received = []
+        receiver = lambda sender, action, pk_set, **kwargs: received.append((action, pk_set))
+        signals.m2m_changed.connect(receiver, sender=self.through)
+        try:
+            extra = TestModel.objects.create(text="extra")
+            self.obj.related.add(self.tests[0], self.tests[1], extra)
+        finally:
+            signals.m2m_changed.disconnect(receiver, sender=self.through)
+        expected = set([self.tests[0].pk, extra.pk])
+        self.assertEqual(received, [('pre_add', expected), ('post_add', expected)],
+                         "Restored relation missing from pk_set")
+
+    def test_prefetch(self):
+        self.obj.related.remove(self.tests[0])
+        obj = LogicalManyModel.objects.prefetch_related('related').get(pk=self.obj.pk)
+        self.assertEqual(sorted(related.pk for related in obj.related.all()),
+                         [self.tests[1].pk, self.tests[2].pk])
+
+    def test_delete_and_undelete(self):
+        self.obj.related.remove(self.tests[0])
+        for delete in (lambda: LogicalManyModel.objects.get(pk=self.obj.pk).delete(),
+                       lambda: LogicalManyModel.objects.filter(pk=self.obj.pk).delete()):
+            delete()
+            self.assertEqual(self.through.objects.filter(date_removed=None).count(), 0)
+            self.assertEqual(self.through.objects.count(), 3, "Relations deleted")
+            LogicalManyModel.objects.get(pk=self.obj.pk).undelete()
+            self.assertEqual(self.related_pks(self.obj), [self.tests[1].pk, self.tests[2].pk],
+                             "Relations not restored, or relation removed before restored")
+
+
+
+class DeletedSinceTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+
+    def setUp(self):
+        self.state_path = tempfile.mktemp()
+        removed = now()
+        for i in range(5):
+            obj = Related2Model.objects.create(text="deleted")
+            obj.delete()
+            # two objects deleted at the same time
+            Related2Model.objects.everything().filter(pk=obj.pk)\
+                .update(date_removed=removed - timedelta(seconds=i // 2))
+        Related2Model.objects.create(text="active")
+        self.expected = list(Related2Model.objects.only_deleted()
+                             .order_by('date_removed', 'pk').values_list('pk', flat=True))
+
+    def tearDown(self):
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+    def test_deleted_since(self):
+        rows = list(Related2Model.objects.deleted_since(batch_size=2))
+        self.assertEqual([pk for pk, date_removed, cursor in rows], self.expected)
+        for i in range(len(rows)):
+            resumed = Related2Model.objects.deleted_since(rows[i][2], batch_size=2)
+            self.assertEqual([pk for pk, date_removed, cursor in resumed], self.expected[i + 1:])
+
+    def test_deleted_since_overlap(self):
+        rows = list(Related2Model.objects.deleted_since())
+        cursor = rows[2][2]
+        # deleted before the cursor, committed after it was read
+        late = Related2Model.objects.create(text="late")
+        late.delete()
+        Related2Model.objects.everything().filter(pk=late.pk)\
+            .update(date_removed=rows[2][1] - timedelta(microseconds=1))
+        resumed = list(Related2Model.objects.deleted_since(cursor))
+        self.assertEqual([pk for pk, date_removed, c in resumed], self.expected[3:])
+        resumed = list(Related2Model.objects.deleted_since(cursor, batch_size=2,
+                                                           overlap=timedelta(seconds=1)))
+        pks = [pk for pk, date_removed, c in resumed]
+        self.assertTrue(late.pk in pks, "Late deletion missed")
+        self.assertEqual(len(pks), len(set(pks)))
+        self.assertEqual(pks[-2:], self.expected[3:])
+        self.assertEqual(set(c for pk, date_removed, c in resumed[:-2]), set([cursor]),
+                         "Cursor moved back")
+
+    def test_invalid_cursor(self):
+        self.assertRaises(ValueError, list, Related2Model.objects.deleted_since('invalid'))
+
+    def test_tombstonefeed(self):
+        from StringIO import StringIO
+        output = StringIO()
+        call_command('tombstonefeed', 'models.Related2Model', state=self.state_path,
+                     batch_size=2, stdout=output)
+        lines = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([line['pk'] for line in lines], self.expected)
+        self.assertEqual(set(line['model'] for line in lines), set(['models.Related2Model']))
+
+        obj = Related2Model.objects.get(text="active")
+        obj.delete()
+        output = StringIO()
+        call_command('tombstonefeed', 'models.Related2Model', state=self.state_path,
+                     stdout=output)
+        self.assertEqual([json.loads(line)['pk'] for line in output.getvalue().splitlines()],
+                         [obj.pk], "Feed not resumed from the state file")
+        output = StringIO()
+        call_command('tombstonefeed', 'models.Related2Model', state=self.state_path,
+                     overlap='1h', stdout=output)
+        self.assertEqual([json.loads(line)['pk'] for line in output.getvalue().splitlines()],
+                         self.expected + [obj.pk])
+
+    def test_tombstonefeed_models(self):
+        from StringIO import StringIO
+        obj = TestModel.objects.create(text="deleted")
+        obj.delete()
+        TestModel.objects.everything().filter(pk=obj.pk)\
+            .update(date_removed=now() - timedelta(days=1))
+        output = StringIO()
+        call_command('tombstonefeed', 'models', stdout=output)
+        lines = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([line['pk'] for line in lines if line['model'] == 'models.Related2Model'],
+                         self.expected)
+        self.assertEqual([line['pk'] for line in lines if line['model'] == 'models.TestModel'],
+                         [obj.pk], "Model started from the cursor of the previous model")
+
+
+
+class PrefetchTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+
+    def setUp(self):
+        self.deleted = set()
+        for i in range(3):
+            parent = TestModel.objects.create(text="parent")
+            for j in range(3):
+                child = Related2Model.objects.create(text="child", related2=parent)
+                if j == 0:
+                    child.delete()
+                    self.deleted.add(child.pk)
+        many = LogicalManyModel.objects.create(text="many")
+        many.related.add(*TestModel.objects.all())
+        TestModel.objects.create(text="member", related=None).delete()
+        many.related.add(TestModel.objects.only_deleted().get())
+
+    def children(self, queryset):
+        return set(obj.pk for obj in queryset)
+
+    def test_prefetch_related(self):
+        with self.assertNumQueries(2):
+            parents = list(TestModel.objects.prefetch_related('related2model_set'))
+        with self.assertNumQueries(0):
+            for parent in parents:
+                pks = self.children(parent.related2model_set.all())
+                self.assertEqual(len(pks), 2)
+                self.assertFalse(pks & self.deleted)
+
+    def test_prefetch_everything(self):
+        with self.assertNumQueries(2):
+            parents = list(TestModel.objects.prefetch_everything('related2model_set'))
+        with self.assertNumQueries(0):
+            for parent in parents:
+                self.assertEqual(len(parent.related2model_set.everything()), 3)
+        for parent in parents:
+            self.assertEqual(self.children(parent.related2model_set.everything()),
+                             set(parent.related2model_set.everything().values_list('pk', flat=True)))
+
+    def test_prefetch_deleted(self):
+        with self.assertNumQueries(3):
+            parents = list(TestModel.objects.prefetch_related('related2model_set')
+                           .prefetch_deleted('related2model_set'))
+        with self.assertNumQueries(0):
+            for parent in parents:
+                self.assertEqual(len(parent.related2model_set.all()), 2)
+                pks = self.children(parent.related2model_set.only_deleted())
+                self.assertEqual(len(pks), 1)
+                self.assertTrue(pks <= self.deleted)
+
+    def test_prefetch_many_to_many(self):
+        with self.assertNumQueries(4):
+            many = LogicalManyModel.objects.prefetch_related('related').prefetch_deleted('related')\
+                .prefetch_everything('related').get()
+        with self.assertNumQueries(0):
+            self.assertEqual(len(many.related.all()), 3)
+            self.assertEqual([obj.text for obj in many.related.only_deleted()], ["member"])
+            self.assertEqual(len(many.related.everything()), 4)
+
+    def test_invalid_lookup(self):
+        self.assertRaises(ValueError, list, TestModel.objects.prefetch_everything('text'))
+
+
+
+class AuditStampingTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+
+    def test_save(self):
+        obj = TestModel.objects.create(text="saved")
+        self.assertEqual(obj.date_created, obj.date_modified)
+        date_created = obj.date_created
+        obj.save()
+        self.assertEqual(obj.date_created, date_created)
+        self.assertTrue(obj.date_modified >= date_created)
+
+    def test_bulk_create(self):
+        date_created = now() - timedelta(days=1)
+        TestModel.objects.bulk_create([TestModel(text="bulk"),
+                                       TestModel(text="bulk", date_created=date_created)])
+        objs = TestModel.objects.filter(text="bulk").order_by('pk')
+        self.assertEqual(len(set(obj.date_modified for obj in objs)), 1)
+        self.assertEqual(objs[0].date_created, objs[0].date_modified)
+        self.assertEqual(objs[1].date_created, date_created)
+
+    def test_update(self):
+        obj = TestModel.objects.create(text="update")
+        date_modified = now() - timedelta(days=1)
+        TestModel.objects.filter(pk=obj.pk).update(text="updated", date_modified=date_modified)
+        self.assertEqual(TestModel.objects.get(pk=obj.pk).date_modified, date_modified)
+
+        TestModel.objects.filter(pk=obj.pk).update(text="updated")
+        updated = TestModel.objects.get(pk=obj.pk)
+        self.assertTrue(updated.date_modified > date_modified)
+        self.assertEqual(updated.date_created, obj.date_created)
+
+    def test_delete_keeps_date_modified(self):
+        obj = TestModel.objects.create(text="deleted")
+        TestModel.objects.filter(pk=obj.pk).delete()
+        TestModel.objects.only_deleted().filter(pk=obj.pk).undelete()
+        self.assertEqual(TestModel.objects.get(pk=obj.pk).date_modified, obj.date_modified)
+
+
+
+class AdminCountsTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+
+    def setUp(self):
+        cache.clear()
+        for i in range(5):
+            obj = TestModel.objects.create(text="counted")
+            if i % 2:
+                obj.delete()
+        self.model_admin = ModelAdmin(TestModel, admin.site)
+        self.request = RequestFactory().get('/')
+
+    def test_active_counts(self):
+        queryset = self.model_admin.queryset(self.request)
+        with self.assertNumQueries(1):
+            self.assertEqual(active_counts(queryset), (3, 2))
+        with self.assertNumQueries(0):
+            self.assertEqual(active_counts(queryset), (3, 2))
+        self.assertEqual(active_counts(queryset.filter(text="other")), (0, 0))
+
+    def test_list_filter(self):
+        list_filter = ActiveListFilter(self.request, {}, TestModel, self.model_admin)
+        self.assertEqual([label for value, label in list_filter.lookup_choices], ['Yes', 'No'])
+        with mock_attr(self.model_admin, 'active_counts', True):
+            list_filter = ActiveListFilter(self.request, {}, TestModel, self.model_admin)
+        self.assertEqual([label for value, label in list_filter.lookup_choices],
+                         ['Yes (3)', 'No (2)'])
+
+
+    def test_estimated_count(self):
+        # there are no statistics before ANALYZE (which commits on SQLite)
+        self.assertEqual(estimated_count(TestModel, 'default'), None)
+        paginator = EstimatedCountPaginator(TestModel.objects.everything(), 10)
+        self.assertEqual(paginator.count, 5)
+
+        with mock_attr(logicaldelete_admin, 'estimated_count', lambda model, using: 1000):
+            paginator = EstimatedCountPaginator(TestModel.objects.everything(), 10)
+            self.assertEqual(paginator.count, 1000)
+            paginator = EstimatedCountPaginator(TestModel.objects.all(), 10)
+            self.assertEqual(paginator.count, 3)
+
+
+
+class UndeleteSelectedTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+
+    def setUp(self):
+        cache.clear()
+        for i in range(5):
+            TestModel.objects.create(text="undeleted %d" % i).delete()
+        TestModel.objects.create(text="active")
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.model_admin = ModelAdmin(TestModel, admin.site)
+        self.model_admin.undelete_batch_size = 2
+        self.queryset = TestModel.objects.everything()
+
+    def post(self, **data):
+        data.setdefault('action', 'undelete_selected')
+        request = RequestFactory().post('/', data)
+        request.user = self.user
+        request._messages = CookieStorage(request)
+        return request
+
+    def test_undelete_objects(self):
+        done = []
+        self.model_admin.undelete_objects(self.user.pk, self.queryset.only_deleted(), done.append)
+        self.assertEqual(done, [2, 4, 5])
+        self.assertEqual(TestModel.objects.only_deleted().count(), 0)
+        entries = LogEntry.objects.filter(user=self.user)
+        self.assertEqual(set(int(entry.object_id) for entry in entries),
+                         set(TestModel.objects.filter(text__startswith="undeleted")
+                             .values_list('pk', flat=True)))
+        self.assertEqual(entries[0].change_message, "Undeleted TestModel object")
+
+    def test_failed_batch_not_logged(self):
+        undeleted = []
+
+        def receiver(pk_list, **kwargs):
+            if undeleted:
+                raise IntegrityError("undelete failed")
+            undeleted.extend(pk_list)
+        pre_undelete_batch.connect(receiver, sender=TestModel)
+        try:
+            self.assertRaises(IntegrityError, self.model_admin.undelete_objects,
+                              self.user.pk, self.queryset.only_deleted())
+        finally:
+            pre_undelete_batch.disconnect(receiver, sender=TestModel)
+        self.assertEqual(sorted(int(entry.object_id) for entry in LogEntry.objects.all()),
+                         sorted(undeleted))
+
+    def test_action(self):
+        request = self.post(post='yes')
+        self.assertEqual(self.model_admin.undelete_selected(request, self.queryset), None)
+        self.assertEqual(TestModel.objects.only_deleted().count(), 0)
+        self.assertEqual(LogEntry.objects.count(), 5)
+
+    def test_preview(self):
+        self.model_admin.undelete_preview_size = 2
+        self.model_admin.undelete_repr_fields = ('text',)
+        response = self.model_admin.undelete_selected(self.post(), self.queryset)
+        self.assertEqual(response.context_data['count'], 5)
+        self.assertEqual([obj.text for obj in response.context_data['undeletable_objects'][0]],
+                         ["undeleted 0", "undeleted 1"])
+        response = self.model_admin.undelete_selected(self.post(preview_page='3'), self.queryset)
+        self.assertEqual(len(response.context_data['preview_page'].object_list), 1)
+        self.assertEqual(TestModel.objects.only_deleted().count(), 5)
+
+    def test_background(self):
+        # the thread would not share the in-memory test database
+        with mock_attr(logicaldelete_admin, 'run_in_thread', lambda func, *args: func(*args)):
+            task_id = self.model_admin.undelete_in_background(
+                self.post(post='yes'), self.queryset.only_deleted(), 5)
+        self.assertEqual(TestModel.objects.only_deleted().count(), 0)
+        response = self.model_admin.undelete_progress(self.post(), task_id)
+        self.assertEqual(json.loads(response.content),
+                         {'total': 5, 'done': 5, 'finished': True})
+
+
+
+class DeletedCacheTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+
+    def setUp(self):
+        self.backend = LocalMemoryBackend()
+        set_backend(self.backend)
+        self.objs = [Related2Model.objects.create(text="cached") for i in range(5)]
+        self.objs[0].delete()
+        self.cache_deleted = mock_attr(Related2Model._logicaldelete_meta, 'cache_deleted', True)
+        self.cache_deleted.__enter__()
+
+    def tearDown(self):
+        self.cache_deleted.__exit__()
+        set_backend(None)
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add(i)
+        self.assertTrue(all(i in bloom for i in range(1000)))
+        false_positives = len([i for i in range(1000, 2000) if i in bloom])
+        self.assertTrue(false_positives < 50, false_positives)
+
+    def test_lru_cache(self):
+        lru = LRUCache(2)
+        lru.set(1, True)
+        lru.set(2, False)
+        lru.get(1)
+        lru.set(3, True)
+        self.assertEqual(lru.get(2), None)
+        self.assertEqual((lru.get(1), lru.get(3)), (True, True))
+
+    def test_is_deleted(self):
+        manager = Related2Model.objects
+        self.assertTrue(manager.is_deleted(self.objs[0].pk))
+        with self.assertNumQueries(0):
+            for obj in self.objs[1:]:
+                self.assertFalse(manager.is_deleted(obj.pk))
+            self.assertTrue(manager.is_deleted(self.objs[0].pk))
+            self.assertTrue(manager.is_deleted(str(self.objs[0].pk)))
+        with mock_attr(Related2Model._logicaldelete_meta, 'cache_deleted', False):
+            self.assertTrue(manager.is_deleted(self.objs[0].pk))
+            self.assertFalse(manager.is_deleted(self.objs[1].pk))
+
+    def test_collector_and_undelete(self):
+        manager = Related2Model.objects
+        self.assertFalse(manager.is_deleted(self.objs[1].pk))
+        # the primary keys are added to the filter
+        self.objs[1].delete()
+        with self.assertNumQueries(1):
+            self.assertTrue(manager.is_deleted(self.objs[1].pk))
+        # the new deletions are read
+        Related2Model.objects.filter(pk=self.objs[2].pk).delete()
+        self.assertTrue(manager.is_deleted(self.objs[2].pk))
+        with self.assertNumQueries(0):
+            self.assertFalse(manager.is_deleted(self.objs[3].pk))
+
+        Related2Model.objects.only_deleted().filter(pk=self.objs[1].pk).undelete()
+        self.assertFalse(manager.is_deleted(self.objs[1].pk))
+        self.assertTrue(manager.is_deleted(self.objs[2].pk))
+
+    def test_django_cache_backend(self):
+        cache.clear()
+        backend = DjangoCacheBackend()
+        self.assertEqual(backend.get(['a', 'b']), [0, 0])
+        self.assertEqual((backend.incr('a'), backend.incr('a')), (1, 2))
+        self.assertEqual(backend.get(['a', 'b']), [2, 0])
+
+    def test_other_process(self):
+        other = DeletedCache(Related2Model, 'default', self.backend)
+        self.assertFalse(other.is_deleted(self.objs[1].pk))
+        self.objs[1].delete()
+        self.assertTrue(other.is_deleted(self.objs[1].pk))
+        Related2Model.objects.only_deleted().filter(pk=self.objs[1].pk).undelete()
+        self.assertFalse(other.is_deleted(self.objs[1].pk))
+
+    def test_late_commit(self):
+        other = DeletedCache(Related2Model, 'default', self.backend)
+        self.assertFalse(other.is_deleted(self.objs[1].pk))
+        # deleted by a transaction committed after a later deletion was read
+        Related2Model.objects.filter(pk=self.objs[1].pk)\
+            .update(date_removed=now() - timedelta(hours=1))
+        self.objs[2].delete()
+        self.assertTrue(other.is_deleted(self.objs[2].pk))
+        self.assertFalse(other.is_deleted(self.objs[1].pk))
+        other.built -= other.rebuild_interval + 1
+        self.assertTrue(other.is_deleted(self.objs[1].pk), "Filter not rebuilt")
+
+
+from logicaldelete.tests.benchmarks import BenchmarkTestCase
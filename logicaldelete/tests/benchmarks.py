@@ -0,0 +1,179 @@
+# -*- coding: utf-8; -*-
+"""
+Benchmarks of logical deletion, undeletion and cleanup on synthetic object
+graphs built from the test models.
+
+They are skipped unless the LOGICALDELETE_BENCHMARKS environment variable is
+set, and write their results as JSON to the file named by
+LOGICALDELETE_BENCHMARKS_OUTPUT (logicaldelete-benchmarks.json by default)::
+
+    LOGICALDELETE_BENCHMARKS=1 django-admin.py test logicaldelete.BenchmarkTestCase
+"""
+import gc
+import json
+import os
+import platform
+import random
+import time
+import unittest
+
+import django
+from django.core.management import call_command
+from django.db import connection, reset_queries
+
+from logicaldelete.tests import TestCase
+from models.models import TestModel, RelatedModel, Related2Model, RelatedMany
+
+BENCHMARKS_ENABLED = bool(os.environ.get('LOGICALDELETE_BENCHMARKS'))
+BENCHMARKS_OUTPUT = os.environ.get('LOGICALDELETE_BENCHMARKS_OUTPUT',
+                                   'logicaldelete-benchmarks.json')
+
+# parameters of build_graph()
+SCENARIOS = (
+    {'roots': 20, 'fan_out': 10, 'depth': 1, 'logical_ratio': 1.0, 'm2m_density': 0},
+    {'roots': 10, 'fan_out': 4, 'depth': 3, 'logical_ratio': 0.5, 'm2m_density': 0.2},
+    {'roots': 5, 'fan_out': 3, 'depth': 5, 'logical_ratio': 0.3, 'm2m_density': 0.5},
+)
+
+
+def build_graph(roots=10, fan_out=3, depth=2, logical_ratio=0.5, m2m_density=0.1, seed=0):
+    """
+    Creates ``roots`` TestModel objects, each the root of a tree of depth
+    ``depth`` where every TestModel has ``fan_out`` children. A child is a
+    Related2Model (a logical deletion leaf) with probability
+    ``logical_ratio``, otherwise a RelatedModel (a plain model) with a
+    TestModel of the next level below it. Each TestModel is added to a
+    RelatedMany with probability ``m2m_density``.
+
+    Returns the primary keys of the roots.
+    """
+    rnd = random.Random(seed)
+    level = [TestModel.objects.create(text="root") for i in range(roots)]
+    root_pks = [obj.pk for obj in level]
+    nodes = list(level)
+    for i in range(depth):
+        next_level = []
+        for parent in level:
+            for j in range(fan_out):
+                if rnd.random() < logical_ratio:
+                    Related2Model.objects.create(text="child", related2=parent)
+                else:
+                    plain = RelatedModel.objects.create(text="child", related=parent)
+                    child = TestModel.objects.create(text="child", related=plain)
+                    next_level.append(child)
+        nodes.extend(next_level)
+        level = next_level
+    members = [obj for obj in nodes if rnd.random() < m2m_density]
+    if members:
+        many = RelatedMany.objects.create(text="many")
+        many.related.add(*members)
+    return root_pks
+
+
+def memory_status(field):
+    """
+    Returns the ``field`` line (e.g. VmRSS) of /proc/self/status in
+    kilobytes, or None where it is not available.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """
+    Resets the peak resident memory of the process (VmHWM) to its current
+    resident memory, on Linux 4.0 and later. Returns False if it cannot.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        return False
+    return True
+
+
+def measure(func):
+    """
+    Calls ``func`` and returns its wall time in seconds, the number of SQL
+    queries it issued and how much its peak resident memory exceeded the
+    resident memory before the call, in kilobytes (None where the peak
+    cannot be reset, since the peak of the whole process would include the
+    previous benchmarks).
+    """
+    gc.collect()
+    reset_queries()
+    rss = memory_status('VmRSS') if reset_peak_rss() else None
+    started = time.time()
+    func()
+    seconds = time.time() - started
+    peak = memory_status('VmHWM') if rss is not None else None
+    return {
+        'seconds': seconds,
+        'queries': len(connection.queries),
+        'peak_rss_delta_kb': max(peak - rss, 0) if peak is not None else None,
+    }
+
+
+@unittest.skipUnless(BENCHMARKS_ENABLED, "Set LOGICALDELETE_BENCHMARKS to run the benchmarks.")
+class BenchmarkTestCase(TestCase):
+    apps = ('logicaldelete.tests.models',)
+    results = []
+
+    def setUp(self):
+        TestModel._logicaldelete_meta.delete_related = True
+        TestModel._logicaldelete_meta.safe_deletion = False
+
+    @classmethod
+    def tearDownClass(cls):
+        super(BenchmarkTestCase, cls).tearDownClass()
+        with open(BENCHMARKS_OUTPUT, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'results': cls.results,
+            }, f, indent=2)
+
+    def run_benchmark(self, name, prepare, func):
+        for scenario in SCENARIOS:
+            root_pks = build_graph(**scenario)
+            prepare(root_pks)
+            result = measure(lambda: func(root_pks))
+            result.update(benchmark=name, scenario=scenario)
+            self.results.append(result)
+            # remove the tombstones too, each scenario starts from empty tables
+            for model in (RelatedMany, Related2Model, RelatedModel, TestModel):
+                if hasattr(model, '_logicaldelete_meta'):
+                    model.objects.everything().remove()
+                else:
+                    model.objects.all().delete()
+            self.assertEqual([model.objects.everything().count()
+                              for model in (Related2Model, TestModel)], [0, 0])
+
+    def test_model_delete(self):
+        def delete(root_pks):
+            for obj in TestModel.objects.filter(pk__in=root_pks):
+                obj.delete()
+        self.run_benchmark('model_delete', lambda root_pks: None, delete)
+
+    def test_queryset_delete(self):
+        self.run_benchmark('queryset_delete', lambda root_pks: None,
+                           lambda root_pks: TestModel.objects.filter(pk__in=root_pks).delete())
+
+    def test_undelete(self):
+        self.run_benchmark('undelete',
+            lambda root_pks: TestModel.objects.filter(pk__in=root_pks).delete(),
+            lambda root_pks: TestModel.objects.only_deleted().filter(pk__in=root_pks)
+                                      .undelete(cascade=True))
+
+    def test_cleanupdeleted(self):
+        self.run_benchmark('cleanupdeleted',
+            lambda root_pks: TestModel.objects.filter(pk__in=root_pks).delete(),
+            lambda root_pks: call_command('cleanupdeleted', 'models', interactive=False,
+                                          verbosity=0))
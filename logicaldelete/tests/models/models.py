@@ -1,4 +1,7 @@
+from django.contrib.contenttypes import generic
+from django.contrib.contenttypes.models import ContentType
 from django.db import models
+from logicaldelete.fields import LogicalManyToManyField
 from logicaldelete.models import Model
 
 
@@ -7,6 +10,15 @@ class Related2Model(Model):
     related = models.ForeignKey("RelatedModel", null=True, blank=True)
     related2 = models.ForeignKey("TestModel", null=True, blank=True)
 
+    class LogicalDeleteMeta:
+        track_operations = True
+
+
+class ProxyRelated2Model(Related2Model):
+
+    class Meta:
+        proxy = True
+
 
 class RelatedModel(models.Model):
     text = models.TextField("text")
@@ -20,8 +32,65 @@ class TestModel(Model):
     class LogicalDeleteMeta:
         delete_related = True
         safe_deletion = False
+        active_indexes = (('related', 'text'),)
+        index_date_removed = True
+        track_operations = True
 
 
 class RelatedMany(models.Model):
     text = models.TextField("text")
     related = models.ManyToManyField("TestModel")
+
+
+class ArchivedModel(Model):
+    text = models.TextField("text")
+    related = models.ForeignKey("TestModel", null=True, blank=True)
+
+    class LogicalDeleteMeta:
+        storage = 'archive'
+        track_operations = True
+
+
+class ProxyArchivedModel(ArchivedModel):
+
+    class Meta:
+        proxy = True
+
+
+class CascadeModel(Model):
+    text = models.TextField("text")
+
+
+class CascadeChildModel(Model):
+    text = models.TextField("text")
+    parent = models.ForeignKey("CascadeModel")
+
+
+class CascadePlainModel(models.Model):
+    text = models.TextField("text")
+    parent = models.ForeignKey("CascadeModel")
+
+
+class CascadeGrandchildModel(Model):
+    text = models.TextField("text")
+    parent = models.ForeignKey("CascadePlainModel")
+
+
+class LogicalManyModel(Model):
+    text = models.TextField("text")
+    related = LogicalManyToManyField("TestModel")
+
+    class LogicalDeleteMeta:
+        delete_batches = True
+
+
+class TaggedItem(models.Model):
+    tag = models.TextField("tag")
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    content_object = generic.GenericForeignKey()
+
+
+class TaggedModel(Model):
+    text = models.TextField("text")
+    tags = generic.GenericRelation("TaggedItem")